@@ -0,0 +1,282 @@
+"""
+Local stand-ins for the search backend and the LLM provider, so that the
+pipeline can be benchmarked without network access or API keys.
+
+The search stand-in answers like Serper on POST /search, with links to the
+page stand-in on GET /page/<n>, which serves html with boilerplate around its
+main text and answers revalidations with a 304. The LLM stand-in answers like
+an OpenAI-compatible server on POST /v1/chat/completions, both streaming and
+not, with a configurable time to first token, token rate and failure rate.
+"""
+import collections
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rag.streaming import RELATED_MARKER
+
+WORDS = (
+    "the quote is commonly attributed to Stan Lee and first appeared in"
+    " Amazing Fantasy number fifteen although similar ideas were voiced by"
+    " Voltaire and Winston Churchill long before the comic book was published"
+).split()
+
+
+class FakeBackendConfig:
+    """
+    Knobs of the stand-in servers.
+
+    Args:
+    search_latency (float): Seconds before the search stand-in answers.
+    ttft (float): Seconds before the first streamed token.
+    tokens_per_second (float): Streaming rate of the answer.
+    answer_tokens (int): Number of tokens in a streamed answer.
+    failure_rate (float): Fraction of requests that fail with a 500.
+    page_latency (float): Seconds before the page stand-in answers.
+    page_bytes (int): Approximate size of a page in bytes.
+    page_etag (bool): Whether pages carry an ETag and can be revalidated.
+    """
+
+    def __init__(
+        self,
+        search_latency: float = 0.2,
+        ttft: float = 0.3,
+        tokens_per_second: float = 50.0,
+        answer_tokens: int = 200,
+        failure_rate: float = 0.0,
+        page_latency: float = 0.1,
+        page_bytes: int = 20000,
+        page_etag: bool = True,
+    ):
+        self.search_latency = search_latency
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.failure_rate = failure_rate
+        self.page_latency = page_latency
+        self.page_bytes = page_bytes
+        self.page_etag = page_etag
+
+
+def _usage(request, prompts, completion_tokens):
+    """
+    Usage like an OpenAI-compatible server with a prefix cache: a token is
+    about four characters, and the cached prefix of a prompt is the longest
+    one it shares with a recent prompt.
+    """
+    prompt = "".join(str(m.get("content")) for m in request.get("messages", []))
+    shared = max((len(os.path.commonprefix([p, prompt])) for p in prompts), default=0)
+    prompts.append(prompt)
+    return {
+        "prompt_tokens": len(prompt) // 4,
+        "completion_tokens": completion_tokens,
+        "total_tokens": len(prompt) // 4 + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": shared // 4},
+    }
+
+
+def _page(number: str, size: int) -> bytes:
+    """
+    A page with a navigation bar, a script and a footer around paragraphs of
+    main text, padded with paragraphs to about size bytes.
+    """
+    head = (
+        f"<html><head><title>Page {number}</title>"
+        "<script>var tracking = 'not main text, not main text';</script></head>"
+        "<body><nav>Home | Products | About us | Contact | Careers | Blog</nav><main>"
+    )
+    tail = "</main><footer>Copyright example.com, all rights reserved worldwide.</footer></body></html>"
+    paragraphs = []
+    length = len(head) + len(tail)
+    i = 0
+    while not paragraphs or length < size:
+        paragraph = f"<p>Page {number} paragraph {i}: {' '.join(WORDS)}.</p>"
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+        i += 1
+    return (head + "".join(paragraphs) + tail).encode()
+
+
+def _asks_inline_questions(request) -> bool:
+    # Like a model following the "INLINE" related questions prompt.
+    return any(RELATED_MARKER in str(m.get("content")) for m in request.get("messages", []))
+
+
+def _handler(config: FakeBackendConfig):
+    prompts = collections.deque(maxlen=16)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_chunk(self, data: bytes):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self):
+            if not self.path.startswith("/page/"):
+                self._send_json(404, {"error": "not found"})
+                return
+            self.server.requests["page"] += 1
+            time.sleep(config.page_latency)
+            if random.random() < config.failure_rate:
+                self._send_json(500, {"error": "injected failure"})
+                return
+            number = self.path[len("/page/"):]
+            etag = f'"{number}-{config.page_bytes}"'
+            if config.page_etag and self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            body = _page(number, config.page_bytes)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            if config.page_etag:
+                self.send_header("ETag", etag)
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The fetcher stopped reading at its byte limit.
+                pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if random.random() < config.failure_rate:
+                self._send_json(500, {"error": "injected failure"})
+                return
+            if self.path.endswith("/search"):
+                self.server.requests["search"] += 1
+                self._search(request)
+            elif self.path.endswith("/chat/completions"):
+                self.server.requests["llm"] += 1
+                if request.get("stream"):
+                    self._stream_completion(request)
+                else:
+                    self._completion(request)
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def _search(self, request):
+            time.sleep(config.search_latency)
+            query = request.get("q", "")
+            host, port = self.server.server_address[:2]
+            self._send_json(200, {
+                "organic": [
+                    {
+                        "title": f"Result {i} for {query}",
+                        "link": f"http://{host}:{port}/page/{i}",
+                        "snippet": f"Snippet {i}: " + " ".join(random.sample(WORDS, 20)),
+                    }
+                    for i in range(10)
+                ]
+            })
+
+        def _completion(self, request):
+            time.sleep(config.ttft)
+            questions = {
+                "questions": [
+                    {"question": f"Follow-up question {i}?"} for i in range(3)
+                ]
+            }
+            content = json.dumps(questions)
+            if _asks_inline_questions(request):
+                # An answer from /batch, with its related questions.
+                answer = " ".join(random.choice(WORDS) for _ in range(config.answer_tokens))
+                content = f"{answer}\n\n{RELATED_MARKER}\n{content}"
+            self._send_json(200, {
+                "id": "fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "fake"),
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }],
+                "usage": _usage(request, prompts, 30),
+            })
+
+        def _stream_completion(self, request):
+            trailer = []
+            if _asks_inline_questions(request):
+                questions = {"questions": [{"question": f"Follow-up question {i}?"} for i in range(3)]}
+                marker = f"\n\n{RELATED_MARKER}\n"
+                trailer = [marker[:8], marker[8:]] + [w + " " for w in json.dumps(questions).split(" ")]
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            time.sleep(config.ttft)
+            interval = 1.0 / config.tokens_per_second if config.tokens_per_second else 0
+            try:
+                tokens = []
+                for i in range(config.answer_tokens):
+                    token = random.choice(WORDS) + " "
+                    if i % 25 == 24:
+                        token += f"[citation:{i % 8 + 1}]. "
+                    tokens.append(token)
+                tokens += trailer
+                for token in tokens:
+                    chunk = {
+                        "id": "fake",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": request.get("model", "fake"),
+                        "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                    }
+                    self._send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+                    if interval:
+                        time.sleep(interval)
+                if (request.get("stream_options") or {}).get("include_usage"):
+                    chunk = {
+                        "id": "fake",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": request.get("model", "fake"),
+                        "choices": [],
+                        "usage": _usage(request, prompts, len(tokens)),
+                    }
+                    self._send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+                self._send_chunk(b"data: [DONE]\n\n")
+                self._send_chunk(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away, e.g. a cancelled request.
+                pass
+
+    return Handler
+
+
+def start_fake_backend(config: FakeBackendConfig, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Starts the stand-in servers on a background thread. Both the search and
+    the LLM endpoints are served by the same server; the bound port is
+    server.server_address[1], and server.requests counts the requests each
+    stand-in received.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), _handler(config))
+    server.daemon_threads = True
+    server.requests = collections.Counter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
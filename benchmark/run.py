@@ -0,0 +1,371 @@
+"""
+Offline benchmark of the RAG pipeline.
+
+Starts the stand-in search and LLM servers from benchmark.fake_backends,
+serves the photon against them in a subprocess, replays a query corpus at a
+fixed rate (--qps) or a fixed concurrency (--concurrency), and writes the
+results as JSON:
+
+    python -m benchmark.run --concurrency 8 --requests 200 --output results.json
+    python -m benchmark.run --qps 5 --duration 60 --baseline results.json
+
+Extra settings for the photon can be passed with --env, e.g.
+--env ASYNC_PIPELINE=true --env STREAM_FORMAT=legacy.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from benchmark.fake_backends import FakeBackendConfig, start_fake_backend
+from rag.streaming import LLM_SPLIT
+
+QUERIES_FILE = os.path.join(os.path.dirname(__file__), "queries.txt")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def check_fake_backends(fake, result: dict) -> None:
+    """
+    Exits unless a query was answered by the stand-in search and LLM servers,
+    so that a photon configured for real backends is never benchmarked, and
+    never runs up a bill.
+    """
+    if not result["ok"] or not fake.requests["search"] or not fake.requests["llm"]:
+        sys.exit(
+            "The photon did not answer from the stand-in backends"
+            f" (status {result.get('status')}, requests {dict(fake.requests)})."
+        )
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(p):
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": at(50),
+        "p90": at(90),
+        "p95": at(95),
+        "p99": at(99),
+        "max": values[-1],
+    }
+
+
+class MemorySampler:
+    """
+    Samples the resident set size of a process on a background thread.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.samples.append(_rss_bytes(self.pid))
+            except OSError:
+                return
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class InFlight:
+    """
+    Tracks the number of requests in flight and its peak.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self.current -= 1
+
+
+def run_query(client: httpx.Client, url: str, query: str, stream_format: str) -> dict:
+    """
+    Runs one query and times the first byte, the first answer token and the
+    end of the stream, in seconds from the start of the request.
+    """
+    result = {"query": query, "ok": False, "ttfb": None, "ttft": None, "latency": None}
+    start = time.perf_counter()
+    buffer = ""
+    try:
+        with client.stream(
+            "POST", url, json={"query": query, "search_uuid": uuid.uuid4().hex}
+        ) as response:
+            result["status"] = response.status_code
+            for chunk in response.iter_text():
+                now = time.perf_counter() - start
+                if result["ttfb"] is None:
+                    result["ttfb"] = now
+                if result["ttft"] is None:
+                    buffer += chunk
+                    if stream_format == "events":
+                        if '{"type": "delta"' in buffer:
+                            result["ttft"] = now
+                    elif LLM_SPLIT in buffer and buffer.split(LLM_SPLIT, 1)[1]:
+                        result["ttft"] = now
+            result["ok"] = response.status_code == 200
+    except httpx.HTTPError as e:
+        result["error"] = repr(e)
+    result["latency"] = time.perf_counter() - start
+    return result
+
+
+def run_load(args, url: str, queries, stream_format: str, in_flight: InFlight):
+    results = []
+    lock = threading.Lock()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    client = httpx.Client(timeout=httpx.Timeout(args.timeout), limits=limits)
+
+    def one(i):
+        with in_flight:
+            result = run_query(client, url, queries[i % len(queries)], stream_format)
+        with lock:
+            results.append(result)
+
+    start = time.perf_counter()
+    deadline = start + args.duration if args.duration else None
+    total = args.requests if not args.duration else sys.maxsize
+    if args.qps:
+        # Open loop: requests start on schedule whether or not earlier ones
+        # have finished, so queueing delay shows up in the latencies.
+        with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+            i = 0
+            while i < total:
+                next_start = start + i / args.qps
+                if deadline and next_start >= deadline:
+                    break
+                time.sleep(max(0.0, next_start - time.perf_counter()))
+                executor.submit(one, i)
+                i += 1
+    else:
+        # Closed loop: each worker starts its next request when the previous
+        # one is done.
+        counter = iter(range(total))
+        counter_lock = threading.Lock()
+
+        def worker():
+            while not deadline or time.perf_counter() < deadline:
+                with counter_lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                one(i)
+
+        threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+    client.close()
+    return results, elapsed
+
+
+def summarize(results, elapsed, memory: MemorySampler, baseline_rss: int, in_flight: InFlight):
+    ok = [r for r in results if r["ok"]]
+    peak_rss = max(memory.samples, default=baseline_rss)
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "failed": len(results) - len(ok),
+        "elapsed": elapsed,
+        "throughput": len(ok) / elapsed if elapsed else 0.0,
+        "ttfb": percentiles([r["ttfb"] for r in ok if r["ttfb"] is not None]),
+        "ttft": percentiles([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "latency": percentiles([r["latency"] for r in ok]),
+        "memory": {
+            "baseline_rss": baseline_rss,
+            "peak_rss": peak_rss,
+            "peak_in_flight": in_flight.peak,
+            # The growth of the server over its idle size, spread over the
+            # requests that were in flight at the peak.
+            "per_request": (peak_rss - baseline_rss) / max(in_flight.peak, 1),
+        },
+    }
+
+
+def compare(summary: dict, baseline: dict):
+    """
+    Prints the relative change of the headline numbers against an earlier run.
+    """
+    rows = [("throughput", ("throughput",))]
+    for metric in ("ttfb", "ttft", "latency"):
+        for p in ("p50", "p95", "p99"):
+            rows.append((f"{metric} {p}", (metric, p)))
+    rows.append(("memory per request", ("memory", "per_request")))
+    for name, path in rows:
+        old, new = baseline["summary"], summary
+        for key in path:
+            old = old.get(key) if isinstance(old, dict) else None
+            new = new.get(key) if isinstance(new, dict) else None
+        if not old or new is None:
+            continue
+        print(f"{name:>20}: {old:10.4f} -> {new:10.4f} ({(new - old) / old:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--qps", type=float, help="Start requests at a fixed rate.")
+    load.add_argument("--concurrency", type=int, default=4, help="Keep a fixed number of requests in flight.")
+    parser.add_argument("--requests", type=int, default=100, help="Number of requests to run.")
+    parser.add_argument("--duration", type=float, help="Run for this many seconds instead of --requests.")
+    parser.add_argument("--queries", default=QUERIES_FILE, help="A file with one query per line.")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="An earlier output file to compare against.")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--max-workers", type=int, default=256, help="Client threads in --qps mode.")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE settings for the photon.")
+    parser.add_argument("--search-latency", type=float, default=0.2)
+    parser.add_argument("--ttft", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--page-latency", type=float, default=0.1)
+    parser.add_argument("--page-bytes", type=int, default=20000)
+    parser.add_argument("--no-page-etag", dest="page_etag", action="store_false")
+    args = parser.parse_args()
+    if args.qps:
+        args.concurrency = None
+
+    with open(args.queries) as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    fake_config = FakeBackendConfig(
+        search_latency=args.search_latency,
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        answer_tokens=args.answer_tokens,
+        failure_rate=args.failure_rate,
+        page_latency=args.page_latency,
+        page_bytes=args.page_bytes,
+        page_etag=args.page_etag,
+    )
+    fake = start_fake_backend(fake_config)
+    fake_url = f"http://127.0.0.1:{fake.server_address[1]}"
+
+    env = dict(os.environ)
+    env.update({
+        "SEARCH_BACKEND": "SERPER",
+        "SERPER_SEARCH_ENDPOINT": f"{fake_url}/search",
+        "SERPER_SEARCH_API_KEY": "benchmark",
+        "CLIENT": "OLLAMA",
+        "OLLAMA_HOST": f"{fake_url}/v1",
+        "OLLAMA_LLM": "benchmark",
+        "RESULT_STORE": "NONE",
+        "SEARCH_CACHE": "false",
+        # The settings above must not be overridden by a .env file.
+        "LLAMASEARCH_NO_DOTENV": "1",
+    })
+    env.update(dict(setting.split("=", 1) for setting in args.env))
+    stream_format = env.get("STREAM_FORMAT", "events")
+
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmark.serve", "--port", str(port)],
+        cwd=REPO_ROOT,
+        env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(600):
+            if server.poll() is not None:
+                sys.exit(f"The photon exited with {server.returncode}")
+            try:
+                if httpx.get(f"{base_url}/healthz").status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        else:
+            sys.exit("The photon did not come up")
+
+        # One request to load lazily initialized state, then measure the idle size.
+        check_fake_backends(fake, run_query(
+            httpx.Client(timeout=args.timeout), f"{base_url}/query", queries[0], stream_format
+        ))
+        baseline_rss = _rss_bytes(server.pid)
+        memory = MemorySampler(server.pid)
+        memory.start()
+        in_flight = InFlight()
+        results, elapsed = run_load(args, f"{base_url}/query", queries, stream_format, in_flight)
+        memory.stop()
+    finally:
+        server.terminate()
+        server.wait()
+        fake.shutdown()
+
+    summary = summarize(results, elapsed, memory, baseline_rss, in_flight)
+    output = {
+        "timestamp": time.time(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "load": {
+            "qps": args.qps,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "duration": args.duration,
+        },
+        "fake_backends": vars(fake_config),
+        "env": dict(setting.split("=", 1) for setting in args.env),
+        "summary": summary,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+
+    print(json.dumps(summary, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(summary, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Serves the RAG photon without the web ui, for benchmarking:
+
+    python -m benchmark.serve --port 8484
+    python -m benchmark.serve --port 8484 --workers 4
+
+The number of workers defaults to WORKERS, so that benchmark.run can compare
+worker counts with --env WORKERS=4.
+"""
+import argparse
+import os
+
+import uvicorn
+
+from rag.rag import RAG
+from utils.workers import serve_workers
+
+
+def create_app():
+    rag = RAG()
+    rag._call_init_once()
+    app = rag._create_app(load_mount=False)
+
+    @app.get("/healthz", include_in_schema=False)
+    def healthz():
+        return {"status": "ok"}
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8484)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", 1)))
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        serve_workers(
+            lambda sock: uvicorn.Server(
+                uvicorn.Config(create_app(), log_level="warning")
+            ).run(sockets=[sock]),
+            "127.0.0.1",
+            args.port,
+            args.workers,
+        )
+    else:
+        uvicorn.run(create_app(), host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,230 @@
+"""
+Cold start benchmark of the photon.
+
+Each run starts a fresh server against the stand-in backends from
+benchmark.fake_backends and times how long it takes until /healthz answers,
+and the first and the second query after that. The time to import rag.rag,
+and the modules that take the most of it, come from python -X importtime. The
+results are written as JSON:
+
+    python -m benchmark.startup --runs 5 --output startup.json
+    python -m benchmark.startup --baseline startup.json --max-regression 0.2
+
+With --max-regression, the benchmark exits with status 1 when a headline
+number got slower than the baseline by more than that fraction, so that it
+can guard startup in CI.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmark.fake_backends import FakeBackendConfig, start_fake_backend
+from benchmark.run import QUERIES_FILE, REPO_ROOT, _free_port, check_fake_backends, run_query
+
+
+def import_profile(env: dict, top: int):
+    """
+    Imports rag.rag in a fresh interpreter with -X importtime. Returns the
+    seconds the import took and the modules that took the most of it on their
+    own, slowest first.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import rag.rag"],
+        cwd=REPO_ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total, modules = None, []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            # The header line.
+            continue
+        name = name.strip()
+        modules.append((name, int(self_us) / 1e6))
+        if name == "rag.rag":
+            total = int(cumulative_us) / 1e6
+    modules.sort(key=lambda module: module[1], reverse=True)
+    return total, [{"module": name, "seconds": seconds} for name, seconds in modules[:top]]
+
+
+def startup_phases(metrics: str) -> dict:
+    """
+    The startup_seconds gauges the server reports on /metrics.
+    """
+    phases = {}
+    for line in metrics.splitlines():
+        if line.startswith('startup_seconds{phase="'):
+            labels, value = line.rsplit(" ", 1)
+            phases[labels.split('"')[1]] = float(value)
+    return phases
+
+
+def cold_start(env: dict, fake, queries, stream_format: str, timeout: float) -> dict:
+    """
+    Starts the photon and times it until it is ready and through its first
+    two queries.
+    """
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmark.serve", "--port", str(port)],
+        cwd=REPO_ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            if server.poll() is not None:
+                sys.exit(f"The photon exited with {server.returncode}")
+            if time.perf_counter() - start > timeout:
+                sys.exit("The photon did not come up")
+            try:
+                if httpx.get(f"{base_url}/healthz").status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.01)
+        ready = time.perf_counter() - start
+        with httpx.Client(timeout=timeout) as client:
+            first = run_query(client, f"{base_url}/query", queries[0], stream_format)
+            check_fake_backends(fake, first)
+            second = run_query(client, f"{base_url}/query", queries[1 % len(queries)], stream_format)
+            phases = startup_phases(client.get(f"{base_url}/metrics").text)
+    finally:
+        server.terminate()
+        server.wait()
+    return {"ready": ready, "first_query": first, "second_query": second, "phases": phases}
+
+
+def summarize(imports, runs) -> dict:
+    def median(values):
+        values = [v for v in values if v is not None]
+        return statistics.median(values) if values else None
+
+    phases = sorted({phase for run in runs for phase in run["phases"]})
+    return {
+        "import": median(imports),
+        "ready": median(run["ready"] for run in runs),
+        "first_query": {
+            metric: median(run["first_query"][metric] for run in runs)
+            for metric in ("ttfb", "ttft", "latency")
+        },
+        "second_query": {
+            metric: median(run["second_query"][metric] for run in runs)
+            for metric in ("ttfb", "ttft", "latency")
+        },
+        "phases": {phase: median(run["phases"].get(phase) for run in runs) for phase in phases},
+    }
+
+
+def compare(summary: dict, baseline: dict, max_regression: float = None):
+    """
+    Prints the relative change of the headline numbers against an earlier run,
+    and returns the ones that got slower by more than max_regression.
+    """
+    rows = [
+        ("import", ("import",)),
+        ("ready", ("ready",)),
+        ("first query ttft", ("first_query", "ttft")),
+        ("first query latency", ("first_query", "latency")),
+        ("second query latency", ("second_query", "latency")),
+    ]
+    regressions = []
+    for name, path in rows:
+        old, new = baseline["summary"], summary
+        for key in path:
+            old = old.get(key) if isinstance(old, dict) else None
+            new = new.get(key) if isinstance(new, dict) else None
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        print(f"{name:>20}: {old:10.4f} -> {new:10.4f} ({change:+.1%})")
+        if max_regression is not None and change > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="Number of cold starts to take the median of.")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest imports to report.")
+    parser.add_argument("--queries", default=QUERIES_FILE, help="A file with one query per line.")
+    parser.add_argument("--output", default="startup_results.json")
+    parser.add_argument("--baseline", help="An earlier output file to compare against.")
+    parser.add_argument(
+        "--max-regression", type=float,
+        help="Exit with status 1 if a number is slower than the baseline by more than this fraction.",
+    )
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE settings for the photon.")
+    args = parser.parse_args()
+
+    with open(args.queries) as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    fake_config = FakeBackendConfig(search_latency=0.05, ttft=0.05, tokens_per_second=0, answer_tokens=50)
+    fake = start_fake_backend(fake_config)
+    fake_url = f"http://127.0.0.1:{fake.server_address[1]}"
+
+    env = dict(os.environ)
+    env.update({
+        "SEARCH_BACKEND": "SERPER",
+        "SERPER_SEARCH_ENDPOINT": f"{fake_url}/search",
+        "SERPER_SEARCH_API_KEY": "benchmark",
+        "CLIENT": "OLLAMA",
+        "OLLAMA_HOST": f"{fake_url}/v1",
+        "OLLAMA_LLM": "benchmark",
+        "RESULT_STORE": "NONE",
+        "SEARCH_CACHE": "false",
+        # The settings above must not be overridden by a .env file.
+        "LLAMASEARCH_NO_DOTENV": "1",
+    })
+    env.update(dict(setting.split("=", 1) for setting in args.env))
+    stream_format = env.get("STREAM_FORMAT", "events")
+
+    imports, runs = [], []
+    try:
+        for _ in range(args.runs):
+            seconds, slowest = import_profile(env, args.top)
+            imports.append(seconds)
+            runs.append(cold_start(env, fake, queries, stream_format, args.timeout))
+    finally:
+        fake.shutdown()
+
+    summary = summarize(imports, runs)
+    output = {
+        "timestamp": time.time(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "env": dict(setting.split("=", 1) for setting in args.env),
+        "summary": summary,
+        "slowest_imports": slowest,
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+
+    print(json.dumps(summary, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summary, json.load(f), args.max_regression)
+        if regressions:
+            sys.exit(f"Startup regressed: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
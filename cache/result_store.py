@@ -0,0 +1,160 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+from cache.ttl_cache import TTLCache
+
+# Results of a finished query are kept for a day by default, which covers
+# shared links and page reloads.
+DEFAULT_RESULT_TTL = 24 * 60 * 60
+DEFAULT_RESULT_STORE_SIZE = 1024
+DEFAULT_RESULT_STORE_PATH = "results.db"
+
+
+class ResultStore:
+    """
+    Stores the full streamed response of a query, keyed by its search_uuid,
+    so that the same search can be replayed without searching or calling the
+    LLM again.
+    """
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str) -> None:
+        raise NotImplementedError
+
+
+class NullResultStore(ResultStore):
+    """
+    A store that keeps nothing. Used when RESULT_STORE is set to NONE.
+    """
+
+    def get(self, key: str) -> Optional[str]:
+        return None
+
+    def set(self, key: str, value: str) -> None:
+        pass
+
+
+class MemoryResultStore(ResultStore):
+    """
+    An in-process LRU store with TTL eviction.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_RESULT_STORE_SIZE, ttl: float = DEFAULT_RESULT_TTL):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: str) -> None:
+        self._cache.set(key, value)
+
+
+class SQLiteResultStore(ResultStore):
+    """
+    An on-disk store backed by SQLite, so that results survive restarts.
+    Expired rows are never returned and are purged from time to time on write.
+    """
+
+    # Run the purge of expired rows once every this many writes.
+    PURGE_EVERY = 100
+
+    def __init__(
+        self,
+        path: str = DEFAULT_RESULT_STORE_PATH,
+        ttl: float = DEFAULT_RESULT_TTL,
+        max_entries: Optional[int] = None,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        self._write_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_expires_at ON results (expires_at)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections may not be shared across threads, so every
+        # executor thread gets its own.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            # WAL lets the workers of a multi-worker server read while one
+            # of them writes.
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connection().execute(
+            "SELECT value FROM results WHERE key = ? AND expires_at > ?",
+            (key, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, created_at, expires_at)"
+                " VALUES (?, ?, ?, ?)",
+                (key, value, now, now + self.ttl),
+            )
+        with self._write_lock:
+            self._writes += 1
+            purge = self._writes % self.PURGE_EVERY == 0
+        if purge:
+            self.purge()
+
+    def purge(self) -> None:
+        """
+        Deletes expired rows and, if max_entries is set, the oldest rows above it.
+        """
+        with self._connection() as conn:
+            conn.execute("DELETE FROM results WHERE expires_at <= ?", (time.time(),))
+            if self.max_entries:
+                conn.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results"
+                    " ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+
+def get_result_store() -> ResultStore:
+    """
+    Builds the result store configured by the environment.
+
+    RESULT_STORE selects the backend: MEMORY (default), SQLITE or NONE.
+    RESULT_STORE_TTL is the time to live of a result in seconds,
+    RESULT_STORE_SIZE the maximum number of stored results and
+    RESULT_STORE_PATH the database file of the SQLITE backend.
+    """
+    kind = os.getenv("RESULT_STORE", "MEMORY").upper()
+    ttl = float(os.getenv("RESULT_STORE_TTL", DEFAULT_RESULT_TTL))
+    size = int(os.getenv("RESULT_STORE_SIZE", DEFAULT_RESULT_STORE_SIZE))
+    if kind == "MEMORY":
+        return MemoryResultStore(maxsize=size, ttl=ttl)
+    elif kind == "SQLITE":
+        path = os.getenv("RESULT_STORE_PATH", DEFAULT_RESULT_STORE_PATH)
+        return SQLiteResultStore(path=path, ttl=ttl, max_entries=size)
+    elif kind == "NONE":
+        return NullResultStore()
+    else:
+        logger.error(f"Unknown RESULT_STORE {kind}, results will not be stored.")
+        return NullResultStore()
@@ -0,0 +1,204 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import Awaitable, Callable, List, Optional
+
+from loguru import logger
+
+from cache.shared_cache import SharedCache
+from cache.ttl_cache import TTLCache
+
+DEFAULT_SEARCH_CACHE_SIZE = 1024
+# Fresh entries are served as is for this many seconds.
+DEFAULT_SEARCH_CACHE_TTL = 10 * 60
+# After that, entries are still served for this many seconds while a refresh
+# runs in the background.
+DEFAULT_SEARCH_CACHE_STALE_TTL = 60 * 60
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a query for cache lookups: case and whitespace do not change the
+    search results in any meaningful way.
+    """
+    return " ".join(query.lower().split())
+
+
+class SearchCache:
+    """
+    A query-keyed cache in front of any search function.
+
+    Entries are keyed on the search backend plus the normalized query. Concurrent
+    lookups of the same key are collapsed into a single in-flight request, and
+    entries older than ttl (but younger than ttl + stale_ttl) are served while a
+    refresh runs in the background (on the executor, or as a task on the event
+    loop for async search functions).
+
+    Args:
+    executor (concurrent.futures.Executor): The executor used for background refreshes.
+    maxsize (int): The maximum number of cached queries.
+    ttl (float): The number of seconds an entry is fresh.
+    stale_ttl (float): The number of seconds a stale entry may still be served.
+    shared_path (str): A SharedCache database to keep the entries in, so that
+        every worker process of the host shares them, or None to keep them
+        in this process.
+    """
+
+    def __init__(
+        self,
+        executor: concurrent.futures.Executor,
+        maxsize: int = DEFAULT_SEARCH_CACHE_SIZE,
+        ttl: float = DEFAULT_SEARCH_CACHE_TTL,
+        stale_ttl: float = DEFAULT_SEARCH_CACHE_STALE_TTL,
+        shared_path: Optional[str] = None,
+    ):
+        self.executor = executor
+        self.ttl = ttl
+        self.shared = bool(shared_path)
+        if shared_path:
+            self._cache = SharedCache(
+                shared_path, namespace="search", maxsize=maxsize, ttl=ttl + stale_ttl
+            )
+        else:
+            self._cache = TTLCache(maxsize=maxsize, ttl=ttl + stale_ttl)
+        self._inflight = {}
+        self._async_inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _count(self, counter: str) -> None:
+        # The counters are bumped from the executor threads and the event
+        # loop alike.
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    async def _get_entry_async(self, key):
+        # A shared cache reads SQLite, which must not block the event loop.
+        if self.shared:
+            return await asyncio.to_thread(self._cache.get_entry, key)
+        return self._cache.get_entry(key)
+
+    async def _set_async(self, key, contexts) -> None:
+        if self.shared:
+            await asyncio.to_thread(self._cache.set, key, contexts)
+        else:
+            self._cache.set(key, contexts)
+
+    def wrap(self, backend: str, search_function: Callable[[str], List[dict]]) -> Callable[[str], List[dict]]:
+        """
+        Returns a search function with the same signature that goes through the cache.
+        """
+        return lambda query: self.search(backend, query, search_function)
+
+    def wrap_async(
+        self, backend: str, search_function: Callable[[str], Awaitable[List[dict]]]
+    ) -> Callable[[str], Awaitable[List[dict]]]:
+        """
+        Same as wrap, for async search functions. Entries are shared with the
+        sync path.
+        """
+        return lambda query: self.search_async(backend, query, search_function)
+
+    def search(self, backend: str, query: str, search_function: Callable[[str], List[dict]]) -> List[dict]:
+        key = (backend, normalize_query(query))
+        entry = self._cache.get_entry(key)
+        if entry is not None:
+            contexts, age = entry
+            if age < self.ttl:
+                self._count("hits")
+            else:
+                self._count("stale_hits")
+                self._fetch(key, query, search_function, wait=False)
+            return self._copy(contexts)
+        self._count("misses")
+        return self._copy(self._fetch(key, query, search_function, wait=True))
+
+    def _fetch(self, key, query, search_function, wait):
+        """
+        Runs the search for key, unless the same key is already in flight, in
+        which case the caller waits for that request instead. With wait set to
+        False the search runs on the executor and nothing is returned.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result() if wait else None
+        if wait:
+            self._run(key, query, search_function, future)
+            return future.result()
+        self.executor.submit(self._run, key, query, search_function, future)
+        return None
+
+    def _run(self, key, query, search_function, future):
+        try:
+            contexts = search_function(query)
+            # Empty results usually mean the backend failed softly, so we do not
+            # pin them in the cache.
+            if contexts:
+                self._cache.set(key, contexts)
+            future.set_result(contexts)
+        except Exception as e:
+            logger.error(f"encountered error while searching for {key}: {e}")
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def search_async(
+        self, backend: str, query: str, search_function: Callable[[str], Awaitable[List[dict]]]
+    ) -> List[dict]:
+        key = (backend, normalize_query(query))
+        entry = await self._get_entry_async(key)
+        if entry is not None:
+            contexts, age = entry
+            if age < self.ttl:
+                self._count("hits")
+            else:
+                self._count("stale_hits")
+                refresh = self._fetch_async(key, query, search_function)
+                # Nobody awaits the refresh, so retrieve its error here.
+                refresh.add_done_callback(lambda f: f.cancelled() or f.exception())
+            return self._copy(contexts)
+        self._count("misses")
+        return self._copy(await self._fetch_async(key, query, search_function))
+
+    def _fetch_async(self, key, query, search_function) -> asyncio.Future:
+        """
+        Returns the in-flight task for key, starting one if there is none. The
+        task is shielded so that a cancelled caller does not cancel the search
+        for the others.
+        """
+        task = self._async_inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run_async(key, query, search_function))
+            self._async_inflight[key] = task
+        else:
+            self._count("coalesced")
+        return asyncio.shield(task)
+
+    async def _run_async(self, key, query, search_function):
+        try:
+            contexts = await search_function(query)
+            if contexts:
+                await self._set_async(key, contexts)
+            return contexts
+        except Exception as e:
+            logger.error(f"encountered error while searching for {key}: {e}")
+            raise
+        finally:
+            self._async_inflight.pop(key, None)
+
+    @staticmethod
+    def _copy(contexts):
+        # Later stages annotate the contexts in place, so every caller gets
+        # its own copy of the cached list.
+        return [dict(c) for c in contexts] if contexts else []
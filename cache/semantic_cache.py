@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+from prometheus_client import Counter, Histogram
+
+from utils.embeddings import Embedder
+
+SEMANTIC_CACHE_LOOKUPS = Counter(
+    "semantic_cache_lookups_total",
+    "Semantic answer cache lookups, by result.",
+    ["result"],
+)
+SEMANTIC_CACHE_SIMILARITY = Histogram(
+    "semantic_cache_best_similarity",
+    "Cosine similarity of the nearest cached query on each lookup.",
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.92, 0.94, 0.96, 0.98, 0.99, 1.0),
+)
+
+
+class SemanticCache:
+    """
+    An answer cache keyed by query embedding, so that paraphrases of a query
+    that was already answered replay the stored answer.
+
+    The index is a brute-force matrix of L2-normalized query embeddings; a
+    lookup is one matrix-vector product. When the index is full, the oldest
+    slot is overwritten. With a path, the matrix is a memory-mapped .npy file
+    and the entries are appended to a JSON lines file next to it, so the cache
+    survives restarts.
+
+    Args:
+    embedder (Embedder): The embedding model.
+    threshold (float): The minimum cosine similarity of a hit.
+    ttl (float): The number of seconds an entry may be replayed.
+    max_entries (int): The capacity of the index.
+    path (str): The directory to persist the index to, or None.
+    """
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        threshold: float = 0.92,
+        ttl: float = 24 * 60 * 60,
+        max_entries: int = 10000,
+        path: Optional[str] = None,
+    ):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._expires_at = np.zeros(max_entries, dtype="float64")
+        self._queries = [None] * max_entries
+        self._values = [None] * max_entries
+        self._next = 0
+        self._size = 0
+        if path:
+            self._load()
+
+    def _reset(self):
+        """
+        Drops every entry, including those on disk, whose slots would no
+        longer match the new index.
+        """
+        self._matrix = None
+        self._expires_at[:] = 0
+        self._queries = [None] * self.max_entries
+        self._values = [None] * self.max_entries
+        self._next = 0
+        self._size = 0
+        if self.path:
+            entries_path = os.path.join(self.path, "entries.jsonl")
+            if os.path.exists(entries_path):
+                open(entries_path, "w").close()
+
+    def _matrix_for(self, dimension: int):
+        if self._matrix is not None and self._matrix.shape[1] != dimension:
+            logger.warning("Semantic cache embedding dimension changed, starting empty.")
+            self._reset()
+        if self._matrix is None:
+            if self.path:
+                os.makedirs(self.path, exist_ok=True)
+                self._matrix = np.lib.format.open_memmap(
+                    os.path.join(self.path, "embeddings.npy"),
+                    mode="w+",
+                    dtype="float32",
+                    shape=(self.max_entries, dimension),
+                )
+            else:
+                self._matrix = np.zeros((self.max_entries, dimension), dtype="float32")
+        return self._matrix
+
+    def _load(self):
+        matrix_path = os.path.join(self.path, "embeddings.npy")
+        entries_path = os.path.join(self.path, "entries.jsonl")
+        if not (os.path.exists(matrix_path) and os.path.exists(entries_path)):
+            return
+        try:
+            matrix = np.load(matrix_path, mmap_mode="r+")
+            if matrix.shape[0] != self.max_entries:
+                logger.warning("Semantic cache capacity changed, starting empty.")
+                del matrix
+                self._reset()
+                return
+            self._matrix = matrix
+            now = time.time()
+            with open(entries_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    slot = entry["slot"]
+                    self._queries[slot] = entry["query"]
+                    self._values[slot] = entry["value"]
+                    self._expires_at[slot] = entry["expires_at"]
+                    self._next = (slot + 1) % self.max_entries
+                    self._size = min(self.max_entries, max(self._size, slot + 1))
+            self._expires_at[self._expires_at <= now] = 0
+            # The entries file is append-only, so rewrite it with the live
+            # entries, oldest first, to keep it from growing without bound.
+            order = [
+                (self._next + i) % self.max_entries for i in range(self.max_entries)
+            ]
+            with open(entries_path + ".tmp", "w") as f:
+                for slot in order:
+                    if self._expires_at[slot] > 0:
+                        f.write(json.dumps({
+                            "slot": slot,
+                            "query": self._queries[slot],
+                            "value": self._values[slot],
+                            "expires_at": self._expires_at[slot],
+                        }) + "\n")
+            os.replace(entries_path + ".tmp", entries_path)
+            logger.info(f"Loaded {int((self._expires_at > 0).sum())} semantic cache entries")
+        except Exception as e:
+            logger.error(f"Could not load the semantic cache, starting empty: {e}")
+            self._reset()
+
+    def lookup(self, query: str) -> Optional[str]:
+        """
+        Returns the stored value of the nearest cached query if it is similar
+        enough and still fresh, otherwise None.
+        """
+        if self._size == 0:
+            SEMANTIC_CACHE_LOOKUPS.labels("miss").inc()
+            return None
+        embedding = self.embedder.embed([query])[0]
+        with self._lock:
+            if self._size == 0 or self._matrix.shape[1] != embedding.shape[0]:
+                # Emptied meanwhile, or indexed with another embedding model;
+                # the next add starts over.
+                SEMANTIC_CACHE_LOOKUPS.labels("miss").inc()
+                return None
+            similarities = self._matrix[: self._size] @ embedding
+            similarities[self._expires_at[: self._size] <= time.time()] = -1.0
+            slot = int(np.argmax(similarities))
+            similarity = float(similarities[slot])
+            value = self._values[slot]
+        SEMANTIC_CACHE_SIMILARITY.observe(max(similarity, 0.0))
+        if similarity >= self.threshold:
+            SEMANTIC_CACHE_LOOKUPS.labels("hit").inc()
+            logger.info(
+                f"Semantic cache hit for {query!r}: {self._queries[slot]!r}"
+                f" ({similarity:.3f})"
+            )
+            return value
+        SEMANTIC_CACHE_LOOKUPS.labels("miss").inc()
+        return None
+
+    def add(self, query: str, value: str) -> None:
+        embedding = self.embedder.embed([query])[0]
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            matrix = self._matrix_for(embedding.shape[0])
+            slot = self._next
+            matrix[slot] = embedding
+            self._queries[slot] = query
+            self._values[slot] = value
+            self._expires_at[slot] = expires_at
+            self._next = (slot + 1) % self.max_entries
+            self._size = min(self.max_entries, self._size + 1)
+            if self.path:
+                with open(os.path.join(self.path, "entries.jsonl"), "a") as f:
+                    f.write(json.dumps({
+                        "slot": slot,
+                        "query": query,
+                        "value": value,
+                        "expires_at": expires_at,
+                    }) + "\n")
@@ -0,0 +1,179 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Hashable, Optional, Tuple
+
+from loguru import logger
+
+DEFAULT_SHARED_CACHE_PATH = "shared_cache.db"
+
+
+class SharedCache:
+    """
+    A cache that every worker process on the host reads and writes, kept in
+    a SQLite database in WAL mode, so that readers never wait for a writer.
+    It has the interface of TTLCache and stands in for one where entries
+    should be shared: a query cached by one worker is a hit in all of them.
+    Since the database is a file, a restarted server starts with the entries
+    it had.
+
+    Entries are evicted in the database, so every worker sees the same ones:
+    expired entries first, then the least recently used beyond maxsize.
+    Keys and values must be JSON-serializable; tuples come back as lists.
+
+    Args:
+    path (str): The database file. Caches with different namespaces can
+        share it.
+    namespace (str): Keeps the entries of this cache apart from the others
+        in the same file.
+    maxsize (int): The maximum number of entries of this namespace.
+    ttl (float): The default time to live of an entry, in seconds.
+    """
+
+    # Run the eviction once every this many writes of a process.
+    EVICT_EVERY = 100
+    # Seconds between the recorded accesses of an entry, which spares most
+    # reads a write.
+    TOUCH_INTERVAL = 10.0
+
+    def __init__(
+        self,
+        path: str = DEFAULT_SHARED_CACHE_PATH,
+        namespace: str = "",
+        maxsize: int = 1024,
+        ttl: Optional[float] = None,
+    ):
+        self.path = path
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        self._write_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL,"
+                " expires_at REAL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed_at"
+                " ON entries (namespace, accessed_at)"
+            )
+        # Starting warm means starting from the entries that are still good.
+        self.evict()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections may not be shared across threads, so every
+        # thread gets its own.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            # WAL is a property of the file, the synchronous level of the
+            # connection: a cache can lose its last writes to a power cut.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _key(key: Hashable) -> str:
+        return json.dumps(key)
+
+    def get_entry(self, key: Hashable, allow_expired: bool = False) -> Optional[Tuple[Any, float]]:
+        """
+        Returns (value, age in seconds) for the key, or None if it is missing
+        or, unless allow_expired is set, expired.
+        """
+        now = time.time()
+        row = self._connection().execute(
+            "SELECT value, created_at, accessed_at, expires_at FROM entries"
+            " WHERE namespace = ? AND key = ?",
+            (self.namespace, self._key(key)),
+        ).fetchone()
+        if row is None:
+            return None
+        value, created_at, accessed_at, expires_at = row
+        if expires_at is not None and now >= expires_at and not allow_expired:
+            return None
+        if now - accessed_at > self.TOUCH_INTERVAL:
+            try:
+                with self._connection() as conn:
+                    conn.execute(
+                        "UPDATE entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                        (now, self.namespace, self._key(key)),
+                    )
+            except sqlite3.Error as e:
+                # Only the eviction order suffers.
+                logger.debug(f"encountered error while touching a shared cache entry: {e}")
+        return json.loads(value), now - created_at
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries"
+                " (namespace, key, value, created_at, accessed_at, expires_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self.namespace, self._key(key), json.dumps(value),
+                    now, now, now + ttl if ttl is not None else None,
+                ),
+            )
+        with self._write_lock:
+            self._writes += 1
+            evict = self._writes % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value FROM entries WHERE namespace = ? AND key = ?",
+                (self.namespace, self._key(key)),
+            ).fetchone()
+            conn.execute(
+                "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                (self.namespace, self._key(key)),
+            )
+        return default if row is None else json.loads(row[0])
+
+    def clear(self) -> None:
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries WHERE namespace = ?", (self.namespace,))
+
+    def evict(self) -> None:
+        """
+        Deletes the expired entries of this namespace and the least recently
+        used ones beyond maxsize.
+        """
+        with self._connection() as conn:
+            conn.execute(
+                "DELETE FROM entries WHERE namespace = ? AND expires_at <= ?",
+                (self.namespace, time.time()),
+            )
+            conn.execute(
+                "DELETE FROM entries WHERE namespace = ? AND key IN (SELECT key"
+                " FROM entries WHERE namespace = ? ORDER BY accessed_at DESC"
+                " LIMIT -1 OFFSET ?)",
+                (self.namespace, self.namespace, self.maxsize),
+            )
+
+    def __len__(self) -> int:
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM entries WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get_entry(key) is not None
@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    A thread-safe, size-bounded LRU cache whose entries expire after a TTL.
+
+    Args:
+    maxsize (int): The maximum number of entries kept in memory.
+    ttl (float): The default time to live of an entry, in seconds. None means
+        entries never expire and are only evicted by the LRU policy.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (value, created_at, expires_at)
+        self._data = OrderedDict()
+
+    def get_entry(self, key: Hashable, allow_expired: bool = False) -> Optional[Tuple[Any, float]]:
+        """
+        Returns (value, age in seconds) for the key, or None if it is missing.
+        Expired entries are dropped unless allow_expired is set, in which case
+        the caller decides what to do with a stale value.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, created_at, expires_at = entry
+            if expires_at is not None and now >= expires_at and not allow_expired:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value, now - created_at
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        now = time.monotonic()
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = now + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, now, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get_entry(key) is not None
@@ -0,0 +1,218 @@
+import functools
+import math
+import os
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+from prometheus_client import Counter, Histogram
+
+BUDGET_PROMPT_TOKENS = Histogram(
+    "llm_budget_prompt_tokens",
+    "Prompt tokens counted before sending, by prompt.",
+    ["prompt"],
+    buckets=(256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072),
+)
+BUDGET_MAX_TOKENS = Histogram(
+    "llm_budget_max_tokens",
+    "max_tokens set on requests, by prompt.",
+    ["prompt"],
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+BUDGET_CONTEXTS = Counter(
+    "llm_budget_contexts_total",
+    "Contexts cut to fit the context window, by prompt and action.",
+    ["prompt", "action"],
+)
+
+# Tokens of the chat template around the messages, which the prompt text
+# does not include.
+TEMPLATE_TOKENS = 32
+# A context is only trimmed, rather than dropped, if this many of its tokens fit.
+MIN_TRIMMED_TOKENS = 64
+# Characters per token when no tokenizer is available.
+CHARS_PER_TOKEN = 4
+
+
+class TokenCounter:
+    """
+    Counts tokens with a `tokenizers` tokenizer, loaded from a tokenizer.json
+    file or by name from the Hugging Face hub. Counts are memoized per text,
+    so the contexts of a repeated search are only encoded once. Without a
+    tokenizer, or if it cannot be loaded, tokens are estimated from the length
+    of the text.
+
+    Args:
+    name (str): A tokenizer.json path or hub name, or None to estimate.
+    cache_size (int): The number of texts whose counts are kept.
+    """
+
+    def __init__(self, name: Optional[str] = None, cache_size: int = 4096):
+        self.name = name
+        self.tokenizer = None
+        if name:
+            try:
+                from tokenizers import Tokenizer
+
+                if os.path.exists(name):
+                    self.tokenizer = Tokenizer.from_file(name)
+                else:
+                    self.tokenizer = Tokenizer.from_pretrained(name)
+            except Exception as e:
+                logger.warning(f"Could not load tokenizer {name}, estimating tokens instead: {e}")
+        self.count = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        if self.tokenizer is None:
+            return math.ceil(len(text) / CHARS_PER_TOKEN)
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def truncate(self, text: str, tokens: int) -> str:
+        """
+        Returns the start of text that is at most the given number of tokens.
+        """
+        if self.tokenizer is None:
+            return text[:tokens * CHARS_PER_TOKEN]
+        offsets = self.tokenizer.encode(text, add_special_tokens=False).offsets
+        if len(offsets) <= tokens:
+            return text
+        return text[:offsets[tokens - 1][1]] if tokens > 0 else ""
+
+
+class ModelPolicy(NamedTuple):
+    """
+    The context window of a model and the most tokens it may be asked to
+    generate. A context window of 0 means unknown, and nothing is cut.
+    """
+    context_window: int
+    max_tokens: int
+
+
+def parse_model_policies(spec: str, max_tokens: int) -> Dict[str, ModelPolicy]:
+    """
+    Parses per-model policies from a comma separated list of
+    model=context_window or model=context_window/max_tokens entries, e.g.
+    "llama3.2:1b-instruct-q8_0=8192/1024,gpt-4o=128000".
+    """
+    policies = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        model, _, policy = entry.strip().rpartition("=")
+        window, _, limit = policy.partition("/")
+        policies[model] = ModelPolicy(int(window), int(limit) if limit else max_tokens)
+    return policies
+
+
+class BudgetFit(NamedTuple):
+    """
+    The contexts that fit a prompt into the model's context window, and the
+    max_tokens left for the answer.
+    """
+    texts: Tuple[str, ...]
+    max_tokens: int
+    prompt_tokens: int
+    trimmed: int
+    dropped: int
+
+
+class ContextBudget:
+    """
+    Fits prompts into the context window of the model they are sent to.
+    Contexts are kept in rank order until the prompt would leave less than
+    min_answer_tokens for the answer; the context that crosses the line is
+    trimmed if enough of it fits, and it and the rest are dropped otherwise.
+    max_tokens is then what is left of the window, up to the model's limit,
+    so that small local models are not overflowed and self-hosted servers do
+    not reserve more than the answer can use.
+
+    Args:
+    counter (TokenCounter): Counts the prompt tokens.
+    context_window (int): The context window of models without a policy, 0 if unknown.
+    max_tokens (int): The most tokens to generate for models without a policy.
+    min_answer_tokens (int): Tokens kept free for the answer when cutting contexts.
+    policies (dict): ModelPolicy by model name.
+    """
+
+    def __init__(
+        self,
+        counter: TokenCounter,
+        context_window: int = 0,
+        max_tokens: int = 4000,
+        min_answer_tokens: int = 512,
+        policies: Optional[Dict[str, ModelPolicy]] = None,
+    ):
+        self.counter = counter
+        self.default_policy = ModelPolicy(context_window, max_tokens)
+        self.min_answer_tokens = min_answer_tokens
+        self.policies = policies or {}
+        # The citation prefix and separator around each context.
+        self._context_overhead = counter.count("[[citation:10]] \n\n")
+
+    def policy(self, model: str) -> ModelPolicy:
+        return self.policies.get(model, self.default_policy)
+
+    def fit(
+        self,
+        prompt: str,
+        model: str,
+        fixed_text: str,
+        texts: List[str],
+        max_tokens: Optional[int] = None,
+    ) -> BudgetFit:
+        """
+        Fits the contexts of a prompt. fixed_text is all of the prompt but the
+        contexts, and max_tokens an optional lower limit for this prompt.
+        """
+        window, limit = self.policy(model)
+        if max_tokens:
+            limit = min(limit, max_tokens)
+        fixed = self.counter.count(fixed_text) + TEMPLATE_TOKENS
+        reserved = min(limit, self.min_answer_tokens)
+        room = window - fixed - reserved if window else math.inf
+        kept = []
+        used = 0
+        trimmed = 0
+        for text in texts:
+            tokens = self.counter.count(text) + self._context_overhead
+            if used + tokens <= room:
+                kept.append(text)
+                used += tokens
+                continue
+            left = room - used - self._context_overhead
+            if left >= MIN_TRIMMED_TOKENS:
+                kept.append(self.counter.truncate(text, int(left)))
+                used += int(left) + self._context_overhead
+                trimmed = 1
+            break
+        dropped = len(texts) - len(kept)
+        prompt_tokens = fixed + used
+        if window:
+            if window - prompt_tokens < limit:
+                limit = max(1, window - prompt_tokens)
+            if window - prompt_tokens < reserved:
+                logger.warning(
+                    f"The {prompt} prompt leaves {window - prompt_tokens} tokens of"
+                    f" the {window} token window of {model}."
+                )
+        BUDGET_PROMPT_TOKENS.labels(prompt).observe(prompt_tokens)
+        BUDGET_MAX_TOKENS.labels(prompt).observe(limit)
+        if trimmed:
+            BUDGET_CONTEXTS.labels(prompt, "trimmed").inc(trimmed)
+        if dropped:
+            BUDGET_CONTEXTS.labels(prompt, "dropped").inc(dropped)
+        return BudgetFit(tuple(kept), limit, prompt_tokens, trimmed, dropped)
+
+
+def get_context_budget() -> ContextBudget:
+    """
+    Returns the budget configured by TOKENIZER, LLM_CONTEXT_WINDOW,
+    LLM_MAX_TOKENS, LLM_MIN_ANSWER_TOKENS and LLM_CONTEXT_WINDOWS.
+    """
+    max_tokens = int(os.getenv("LLM_MAX_TOKENS", 4000))
+    return ContextBudget(
+        TokenCounter(os.getenv("TOKENIZER") or None),
+        context_window=int(os.getenv("LLM_CONTEXT_WINDOW", 0)),
+        max_tokens=max_tokens,
+        min_answer_tokens=int(os.getenv("LLM_MIN_ANSWER_TOKENS", 512)),
+        policies=parse_model_policies(os.getenv("LLM_CONTEXT_WINDOWS", ""), max_tokens),
+    )
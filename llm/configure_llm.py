@@ -1,59 +1,125 @@
 import os
 import threading
 import httpx
-# from openai import OpenAI
-from langfuse.openai import openai
-
-
-def get_thread_local_client(model, base_url, api_key, timeout):
-    thread_local = threading.local()
-    try:
-        return thread_local.client
-    except AttributeError:
-        thread_local.client = openai.OpenAI(
-            timeout=timeout,
-            base_url=base_url,
-            api_key=api_key,
-        )
-        return thread_local.client
-
-def openai_client():
+
+from utils.http_pool import get_http_client, warm_up, warm_up_async
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _openai():
+    """
+    Returns the openai module to build clients with: the one patched by
+    langfuse, which traces every call, if langfuse is configured, and plain
+    openai otherwise. Both are imported here rather than at module level, as
+    they take a large share of the startup time and langfuse starts
+    background threads on import.
+    """
+    if os.getenv("LANGFUSE_PUBLIC_KEY"):
+        from langfuse.openai import openai
+    else:
+        import openai
+    return openai
+
+
+def get_shared_client(model, base_url, api_key, timeout, use_async=False):
+    """
+    Returns the per-process client for the provider, creating it on first use.
+    Clients are keyed by endpoint and key, and sit on a pooled keep-alive http
+    client from utils.http_pool, so connections are reused across queries and
+    threads.
+    """
+    key = (base_url, api_key, use_async)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            openai = _openai()
+            client_class = openai.AsyncOpenAI if use_async else openai.OpenAI
+            client = client_class(
+                timeout=timeout,
+                base_url=base_url,
+                api_key=api_key,
+                http_client=get_http_client(
+                    f"llm:{base_url}", use_async=use_async, timeout=timeout
+                ),
+            )
+            _clients[key] = client
+        return client
+
+
+def warm_up_client(client):
+    """
+    Opens a pooled connection to the provider of a sync client.
+    """
+    # openai keeps the http client it was given as _client.
+    warm_up(client._client, str(client.base_url))
+
+async def warm_up_client_async(client):
+    """
+    Opens a pooled connection to the provider of an async client.
+    """
+    await warm_up_async(client._client, str(client.base_url))
+
+def openai_client(use_async=False):
     openai_llm = os.getenv('OPENAI_LLM')
     openai_api_key_gpt35 = os.getenv('OPENAI_API_KEY')
-    return get_thread_local_client(
+    return get_shared_client(
         model=openai_llm,
         base_url=None,
         api_key=openai_api_key_gpt35,
-        timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10)
+        timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
+        use_async=use_async,
     )
 
-def togetherai_client():
+def togetherai_client(use_async=False):
     together_llm = os.getenv('TOGETHER_LLM')
     together_endpoint = os.getenv('TOGETHER_ENDPOINT')
     together_api_key = os.getenv('TOGETHER_API_KEY')
 
-    return get_thread_local_client(
+    return get_shared_client(
         model=together_llm,
         base_url=together_endpoint,
         api_key=together_api_key,
-        timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10)
+        timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
+        use_async=use_async,
     )
 
-def hf_tgi_client():
+def hf_tgi_client(use_async=False):
     hf_tgi_host = os.getenv('HF_TGI_HOST')
-    return get_thread_local_client(
+    return get_shared_client(
         model="",
         base_url=hf_tgi_host,
         api_key="EMPTY",
-        timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10)
+        timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
+        use_async=use_async,
     )
 
-def ollama_client():
+def ollama_client(use_async=False):
     ollama_host = os.getenv('OLLAMA_HOST')
     ollama_llm = os.getenv('OLLAMA_LLM')
-    return get_thread_local_client(
+    return get_shared_client(
         model=ollama_llm,
         base_url=ollama_host,
         api_key="EMPTY",
-        timeout=httpx.Timeout(connect=100, read=120, write=120, pool=100)
-    )
\ No newline at end of file
+        timeout=httpx.Timeout(connect=100, read=120, write=120, pool=100),
+        use_async=use_async,
+    )
+
+# The client function and the model variable of each provider.
+CLIENT_FUNCTIONS = {
+    "OPENAI": openai_client,
+    "TOGETHER": togetherai_client,
+    "HF_TGI": hf_tgi_client,
+    "OLLAMA": ollama_client,
+}
+LLM_MODEL_VARIABLES = {
+    "OPENAI": "OPENAI_LLM",
+    "TOGETHER": "TOGETHER_LLM",
+    "HF_TGI": "HF_TGI_LLM",
+    "OLLAMA": "OLLAMA_LLM",
+}
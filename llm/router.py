@@ -0,0 +1,500 @@
+import asyncio
+import collections
+import concurrent.futures
+import os
+import socket
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import httpx
+from loguru import logger
+from prometheus_client import Counter, Gauge
+
+from llm.configure_llm import CLIENT_FUNCTIONS, LLM_MODEL_VARIABLES
+
+ROUTER_REQUESTS = Counter(
+    "llm_router_requests_total",
+    "LLM requests by provider and outcome.",
+    ["router", "provider", "outcome"],
+)
+ROUTER_CIRCUIT_OPEN = Gauge(
+    "llm_router_circuit_open",
+    "Whether the circuit of a provider is open.",
+    ["router", "provider"],
+)
+
+# Until a provider has this many first-token samples, it is ranked as if it
+# were the fastest, so that every configured provider gets measured.
+MIN_LATENCY_SAMPLES = 5
+# How much a provider's error rate inflates its latency score.
+ERROR_PENALTY = 4.0
+
+
+class NoProviderAvailable(Exception):
+    """
+    Every provider failed or has an open circuit.
+    """
+
+
+class Provider:
+    """
+    One LLM provider and model, with the rolling health the router ranks it by.
+
+    The circuit opens after failure_threshold consecutive failures and stays
+    open for cooldown seconds. After that a single trial request is let
+    through: its success closes the circuit, its failure opens it again.
+
+    Args:
+    name (str): The provider, one of CLIENT_FUNCTIONS.
+    model (str): The model to ask for.
+    client_function: Returns the provider's shared openai client, sync or
+        with use_async=True async. The clients are created on first use,
+        which keeps importing openai out of startup.
+    use_async (bool): Whether the async client is used.
+    window (int): The number of recent requests the health is computed over.
+    failure_threshold (int): Consecutive failures that open the circuit.
+    cooldown (float): Seconds the circuit stays open.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        client_function,
+        use_async: bool = False,
+        window: int = 50,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+    ):
+        self.name = name
+        self.model = model
+        self.client_function = client_function
+        self.use_async = use_async
+        self._client = None
+        self._async_client = None
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._first_token_latencies = collections.deque(maxlen=window)
+        self._outcomes = collections.deque(maxlen=window)
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def label(self) -> str:
+        return f"{self.name}:{self.model}"
+
+    @property
+    def client(self):
+        # The shared clients are memoized by client_function, so a race here
+        # only looks the same client up twice.
+        if self._client is None:
+            self._client = self.client_function()
+        return self._client
+
+    @property
+    def async_client(self):
+        if not self.use_async:
+            return None
+        if self._async_client is None:
+            self._async_client = self.client_function(use_async=True)
+        return self._async_client
+
+    @property
+    def supports_tools(self) -> bool:
+        return self.name == "OPENAI"
+
+    @property
+    def supports_stream_usage(self) -> bool:
+        # Whether the provider takes stream_options to report the usage of a
+        # streamed completion.
+        return self.name == "OPENAI"
+
+    @property
+    def max_stop_sequences(self) -> Optional[int]:
+        # The stop sequences the provider takes. OpenAI takes four, as does
+        # text-generation-inference by default; None means no limit.
+        return 4 if self.name in ("OPENAI", "HF_TGI") else None
+
+    def available(self) -> bool:
+        """
+        Whether a request may be sent, claiming the trial request of a
+        half-open circuit.
+        """
+        with self._lock:
+            if self._consecutive_failures < self.failure_threshold:
+                return True
+            if time.monotonic() < self._open_until or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def release(self) -> None:
+        """
+        Gives back the trial request claimed by available() when no request
+        was sent or it was cancelled, so that it counts neither way.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def score(self) -> float:
+        """
+        The median time to first token, inflated by the recent error rate.
+        For non-streamed requests, the whole response is the first token.
+        Lower is better.
+        """
+        with self._lock:
+            latencies = sorted(self._first_token_latencies)
+            errors = self._outcomes.count(False) / len(self._outcomes) if self._outcomes else 0.0
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return 0.0
+        return latencies[len(latencies) // 2] * (1 + ERROR_PENALTY * errors)
+
+    def record_success(self, first_token_latency: Optional[float] = None) -> None:
+        with self._lock:
+            if first_token_latency is not None:
+                self._first_token_latencies.append(first_token_latency)
+            self._outcomes.append(True)
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._outcomes.append(False)
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+            if self._consecutive_failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.cooldown
+
+    def circuit_open(self) -> bool:
+        with self._lock:
+            return self._consecutive_failures >= self.failure_threshold
+
+
+def parse_providers(spec: str, use_async: bool = False, **health) -> List[Provider]:
+    """
+    Builds providers from a comma separated list of PROVIDER or
+    PROVIDER:model entries, e.g. "OPENAI,OLLAMA:llama3". Without a model, the
+    provider's model variable (OPENAI_LLM, ...) is used.
+    """
+    providers = []
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        name, _, model = entry.strip().partition(":")
+        name = name.upper()
+        if name not in CLIENT_FUNCTIONS:
+            raise RuntimeError(
+                f"Unknown LLM provider {name}, must be one of {list(CLIENT_FUNCTIONS)}."
+            )
+        providers.append(Provider(
+            name,
+            model or os.getenv(LLM_MODEL_VARIABLES[name], ""),
+            CLIENT_FUNCTIONS[name],
+            use_async,
+            **health,
+        ))
+    if not providers:
+        raise RuntimeError("No LLM provider configured.")
+    return providers
+
+
+def close_stream(stream, iterator=None) -> None:
+    """
+    Closes a streamed completion and its connection, whether it is an openai
+    Stream or the langfuse wrapper around one, and the iterator over it.
+    """
+    # The connection first: that also unblocks a read in another thread.
+    for close in (getattr(stream, "response", stream).close, getattr(iterator, "close", None)):
+        try:
+            if close is not None:
+                close()
+        except Exception as e:
+            logger.debug(f"encountered error while closing stream: {e}")
+
+
+async def aclose_stream(stream, iterator=None) -> None:
+    """
+    Async version of close_stream.
+    """
+    # The httpx response of a plain openai AsyncStream closes with aclose,
+    # the langfuse wrapper holds the AsyncStream, which closes with close.
+    response = getattr(stream, "response", stream)
+    for close in (getattr(response, "aclose", None) or response.close, getattr(iterator, "aclose", None)):
+        try:
+            if close is not None:
+                await close()
+        except Exception as e:
+            logger.debug(f"encountered error while closing stream: {e}")
+
+
+def interrupt_stream(stream) -> None:
+    """
+    Stops a streamed completion that another thread may be reading. Its socket
+    is shut down, which wakes a read blocked on the next chunk and tells the
+    provider to stop generating; closing the response would only take effect
+    once that read returns. A response that has been read to its end is left
+    alone, as its connection may be back in the pool.
+    """
+    # The openai Stream, or the langfuse wrapper around one, holds the
+    # httpx response.
+    response = stream
+    for _ in range(3):
+        if isinstance(response, httpx.Response):
+            break
+        response = getattr(response, "response", None)
+    else:
+        response = None
+    if response is None or response.is_closed:
+        return
+    network_stream = response.extensions.get("network_stream")
+    sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+    if sock is None:
+        close_stream(stream)
+        return
+    try:
+        # The plain socket's shutdown, which leaves the TLS state of a TLS
+        # socket to the reading thread.
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError as e:
+        logger.debug(f"encountered error while interrupting stream: {e}")
+
+
+class CompletionStream:
+    """
+    The chunks of a streamed completion, from the first one on. It can be
+    interrupted from another thread, even while a read waits for the next
+    chunk; the chunks then end as if the completion had.
+
+    Args:
+    first: The first chunk, already read, or None.
+    iterator: The iterator over the rest of the chunks.
+    stream: The openai Stream, closed at the end.
+    """
+
+    def __init__(self, first, iterator, stream):
+        self.first = first
+        self.iterator = iterator
+        self.stream = stream
+        self.interrupted = False
+
+    def __iter__(self):
+        try:
+            if self.first is not None:
+                yield self.first
+            yield from self.iterator
+        except Exception:
+            # The read that the interruption cut short.
+            if not self.interrupted:
+                raise
+        finally:
+            close_stream(self.stream, self.iterator)
+
+    def interrupt(self) -> None:
+        self.interrupted = True
+        interrupt_stream(self.stream)
+
+
+class LLMRouter:
+    """
+    Sends each request to the best available provider and fails over to the
+    next one on errors.
+
+    Providers are ranked by their score (median time to first token, inflated
+    by their error rate), ties keeping the configured order. Providers with an
+    open circuit are skipped. For streamed requests, a provider that has not
+    produced its first chunk within first_token_deadline seconds is abandoned
+    and the request goes to the next one, so a stalled provider costs at most
+    that long. Once the first chunk is in, the stream is committed to its
+    provider.
+
+    Args:
+    name (str): The name of the router in metrics and logs.
+    providers (list): The providers, in order of preference.
+    first_token_deadline (float): Seconds to wait for the first chunk of a stream.
+    max_workers (int): Threads opening sync streams.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        providers: List[Provider],
+        first_token_deadline: float = 10.0,
+        max_workers: int = 32,
+    ):
+        self.name = name
+        self.providers = providers
+        self.first_token_deadline = first_token_deadline
+        # Opening a sync stream blocks, so it runs here to be able to give up
+        # on it at the deadline. A stalled provider holds its thread until it
+        # answers or times out, hence the headroom.
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"llm-router-{name}"
+        )
+
+    def _candidates(self):
+        """
+        Yields the available providers, best first. Availability is checked
+        lazily, so that a half-open circuit's trial is only claimed by a
+        request that actually goes to it.
+        """
+        ranked = sorted(
+            enumerate(self.providers), key=lambda item: (item[1].score(), item[0])
+        )
+        for _, provider in ranked:
+            if provider.available():
+                yield provider
+
+    @staticmethod
+    def _build_request(provider: Provider, build_request: Callable[[Provider], dict]) -> dict:
+        # An error building the request is not the provider's, but the
+        # trial of a half-open circuit it may have claimed must be given
+        # back.
+        try:
+            return build_request(provider)
+        except BaseException:
+            provider.release()
+            raise
+
+    def _success(self, provider: Provider, first_token_latency: Optional[float] = None) -> None:
+        provider.record_success(first_token_latency)
+        ROUTER_REQUESTS.labels(self.name, provider.label, "ok").inc()
+        ROUTER_CIRCUIT_OPEN.labels(self.name, provider.label).set(0)
+
+    def _failure(self, provider: Provider, outcome: str, e: Exception) -> None:
+        logger.warning(f"LLM provider {provider.label} failed ({outcome}): {e!r}")
+        provider.record_failure()
+        ROUTER_REQUESTS.labels(self.name, provider.label, outcome).inc()
+        ROUTER_CIRCUIT_OPEN.labels(self.name, provider.label).set(
+            int(provider.circuit_open())
+        )
+
+    def create(self, build_request: Callable[[Provider], dict]) -> Tuple[Provider, object]:
+        """
+        Sends a non-streamed completion. build_request returns the arguments
+        of chat.completions.create for a provider, without the model.
+        """
+        for provider in self._candidates():
+            request = self._build_request(provider, build_request)
+            start = time.perf_counter()
+            try:
+                response = provider.client.chat.completions.create(
+                    model=provider.model, **request
+                )
+            except Exception as e:
+                self._failure(provider, "error", e)
+                continue
+            self._success(provider, time.perf_counter() - start)
+            return provider, response
+        raise NoProviderAvailable(f"No {self.name} provider is available.")
+
+    async def create_async(self, build_request: Callable[[Provider], dict]) -> Tuple[Provider, object]:
+        """
+        Async version of create.
+        """
+        for provider in self._candidates():
+            request = self._build_request(provider, build_request)
+            start = time.perf_counter()
+            try:
+                response = await provider.async_client.chat.completions.create(
+                    model=provider.model, **request
+                )
+            except asyncio.CancelledError:
+                provider.release()
+                raise
+            except Exception as e:
+                self._failure(provider, "error", e)
+                continue
+            self._success(provider, time.perf_counter() - start)
+            return provider, response
+        raise NoProviderAvailable(f"No {self.name} provider is available.")
+
+    @staticmethod
+    def _open_stream(provider: Provider, request: dict, opened: list):
+        stream = provider.client.chat.completions.create(
+            model=provider.model, stream=True, **request
+        )
+        opened.append(stream)
+        iterator = iter(stream)
+        return stream, iterator, next(iterator, None)
+
+    def stream(self, build_request: Callable[[Provider], dict]) -> Tuple[Provider, object]:
+        """
+        Opens a streamed completion and waits for its first chunk. Returns the
+        provider and a CompletionStream over all the chunks.
+        """
+        for provider in self._candidates():
+            request = self._build_request(provider, build_request)
+            start = time.perf_counter()
+            opened = []
+            future = self._executor.submit(self._open_stream, provider, request, opened)
+            try:
+                stream, iterator, first = future.result(timeout=self.first_token_deadline)
+            except concurrent.futures.TimeoutError as e:
+                # Close the stalled stream, now or once it has been opened.
+                if opened:
+                    close_stream(opened[0])
+                future.add_done_callback(
+                    lambda f: f.exception() is None and close_stream(f.result()[0], f.result()[1])
+                )
+                self._failure(provider, "deadline", e)
+                continue
+            except Exception as e:
+                self._failure(provider, "error", e)
+                continue
+            self._success(provider, time.perf_counter() - start)
+            return provider, CompletionStream(first, iterator, stream)
+        raise NoProviderAvailable(f"No {self.name} provider is available.")
+
+    @staticmethod
+    async def _open_stream_async(provider: Provider, request: dict, opened: list):
+        stream = await provider.async_client.chat.completions.create(
+            model=provider.model, stream=True, **request
+        )
+        iterator = stream.__aiter__()
+        opened.append((stream, iterator))
+        try:
+            first = await iterator.__anext__()
+        except StopAsyncIteration:
+            first = None
+        return stream, iterator, first
+
+    async def stream_async(self, build_request: Callable[[Provider], dict]) -> Tuple[Provider, object]:
+        """
+        Async version of stream.
+        """
+        for provider in self._candidates():
+            request = self._build_request(provider, build_request)
+            start = time.perf_counter()
+            opened = []
+            try:
+                stream, iterator, first = await asyncio.wait_for(
+                    self._open_stream_async(provider, request, opened),
+                    self.first_token_deadline,
+                )
+            except asyncio.CancelledError:
+                provider.release()
+                if opened:
+                    await aclose_stream(*opened[0])
+                raise
+            except Exception as e:
+                if opened:
+                    await aclose_stream(*opened[0])
+                outcome = "deadline" if isinstance(e, asyncio.TimeoutError) else "error"
+                self._failure(provider, outcome, e)
+                continue
+            self._success(provider, time.perf_counter() - start)
+            return provider, self._chain_async(first, iterator, stream)
+        raise NoProviderAvailable(f"No {self.name} provider is available.")
+
+    @staticmethod
+    async def _chain_async(first, iterator, stream):
+        try:
+            if first is not None:
+                yield first
+            async for chunk in iterator:
+                yield chunk
+        finally:
+            await aclose_stream(stream, iterator)
@@ -0,0 +1,160 @@
+import threading
+from collections import OrderedDict
+from typing import List, NamedTuple
+
+from prometheus_client import Counter
+
+from llm.budget import BudgetFit, ContextBudget
+
+from prompt.prompt import (
+    _rag_query_text,
+    _rag_query_contexts,
+    _more_questions_prompt,
+    _more_questions_prompt_no_tool_call,
+    _more_questions_contexts,
+    _inline_questions_prompt,
+)
+
+PROMPT_TOKENS = Counter(
+    "llm_prompt_tokens_total",
+    "Prompt tokens sent, as reported by the provider.",
+    ["prompt", "provider"],
+)
+PROMPT_CACHED_TOKENS = Counter(
+    "llm_prompt_cached_tokens_total",
+    "Prompt tokens the provider served from its prefix cache.",
+    ["prompt", "provider"],
+)
+
+
+class Prompt(NamedTuple):
+    """
+    The messages of a prompt and how its contexts were fitted, with the
+    max_tokens to send.
+    """
+    messages: List[dict]
+    fit: BudgetFit
+
+
+class PromptAssembler:
+    """
+    Builds the chat messages of the answer and related questions prompts,
+    with their contexts fitted to the model by the budget.
+
+    Each system prompt is its fixed instructions followed by the rendered
+    contexts, so that every prompt of a kind shares the instructions as a
+    prefix that the provider can cache. The query goes last, in the user
+    message. Rendered system prompts are memoized per kind and search result
+    set, so a repeated or replayed search reuses the string instead of
+    rebuilding it; the key is the tuple of context texts, whose hashes Python
+    caches on the strings themselves.
+
+    Args:
+    inline_questions_marker (str): The marker line before the related
+        questions in answers that also write them.
+    budget (ContextBudget): Fits the contexts into the model's context window.
+    cache_size (int): The number of rendered prompts kept.
+    """
+
+    def __init__(self, inline_questions_marker: str, budget: ContextBudget, cache_size: int = 256):
+        self.budget = budget
+        self._instructions = {
+            "answer": _rag_query_text,
+            "answer_inline": _rag_query_text + _inline_questions_prompt.format(
+                marker=inline_questions_marker
+            ).lstrip("\n") + "\n",
+            "related": _more_questions_prompt,
+            "related_json": _more_questions_prompt_no_tool_call,
+        }
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _system_prompt(self, kind: str, texts: tuple) -> str:
+        key = (kind, texts)
+        with self._lock:
+            prompt = self._cache.get(key)
+            if prompt is not None:
+                self._cache.move_to_end(key)
+                return prompt
+        if kind.startswith("answer"):
+            context = "\n\n".join(
+                f"[[citation:{i+1}]] {text}" for i, text in enumerate(texts)
+            )
+            prompt = self._instructions[kind] + _rag_query_contexts.format(context=context)
+        else:
+            prompt = self._instructions[kind] + _more_questions_contexts.format(
+                context="\n\n".join(texts)
+            )
+        with self._lock:
+            self._cache[key] = prompt
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return prompt
+
+    def answer_prompt(
+        self, query: str, contexts: List[dict], model: str, inline_questions: bool = False
+    ) -> Prompt:
+        """
+        The answer prompt for the model, also asking for the related questions
+        at the end of the answer if inline_questions is set.
+        """
+        kind = "answer_inline" if inline_questions else "answer"
+        fit = self.budget.fit(
+            "answer",
+            model,
+            self._instructions[kind] + _rag_query_contexts + query,
+            [c.get("content") or c["snippet"] for c in contexts],
+        )
+        return Prompt([
+            {"role": "system", "content": self._system_prompt(kind, fit.texts)},  # for mixtral change this to user
+            {"role": "user", "content": query},   # for mixtral change this to assistant
+        ], fit)
+
+    def related_prompt(
+        self, query: str, contexts: List[dict], model: str, tools: bool, max_tokens: int
+    ) -> Prompt:
+        """
+        The related questions prompt for the model, for a tool call or, without
+        tools, for a JSON-formatted answer. It only uses the snippets of the
+        contexts.
+        """
+        kind = "related" if tools else "related_json"
+        fit = self.budget.fit(
+            "related",
+            model,
+            self._instructions[kind] + _more_questions_contexts + query,
+            [c["snippet"] for c in contexts],
+            max_tokens,
+        )
+        return Prompt([
+            {"role": "system", "content": self._system_prompt(kind, fit.texts)},
+            {"role": "user", "content": query},
+        ], fit)
+
+
+def observe_prompt_usage(prompt: str, provider: str, usage, trace=None) -> None:
+    """
+    Records the prompt tokens of a response and how many of them hit the
+    provider's prefix cache, where the provider reports it (OpenAI and vLLM
+    do, as usage.prompt_tokens_details.cached_tokens).
+    """
+    prompt_tokens = _field(usage, "prompt_tokens")
+    if not prompt_tokens:
+        return
+    PROMPT_TOKENS.labels(prompt, provider).inc(prompt_tokens)
+    cached = _field(_field(usage, "prompt_tokens_details"), "cached_tokens")
+    if cached is not None:
+        PROMPT_CACHED_TOKENS.labels(prompt, provider).inc(cached)
+    if trace is not None:
+        trace.set(**{
+            f"{prompt}_prompt_tokens": prompt_tokens,
+            f"{prompt}_cached_prompt_tokens": cached,
+        })
+
+
+def _field(value, name):
+    # Fields the openai client does not know yet come as plain dicts.
+    if isinstance(value, dict):
+        return value.get(name)
+    return getattr(value, name, None)
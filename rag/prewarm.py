@@ -0,0 +1,229 @@
+import concurrent.futures
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from loguru import logger
+from prometheus_client import Counter
+
+from cache.search_cache import normalize_query
+from cache.shared_cache import SharedCache
+from cache.ttl_cache import TTLCache
+
+PREWARM_JOBS = Counter(
+    "prewarm_jobs_total",
+    "Related questions handed to the pre-warmer, by what became of them:"
+    " searched, answered, or dropped for a full queue, foreground load or an"
+    " error.",
+    ["result"],
+)
+PREWARM_HITS = Counter(
+    "prewarm_hits_total",
+    "Queries for a pre-warmed related question, by what was pre-warmed: its"
+    " search or its whole answer.",
+    ["kind"],
+)
+PREWARM_TOKENS = Counter(
+    "prewarm_tokens_total",
+    "LLM tokens spent answering related questions ahead of time.",
+)
+
+
+def _lower_priority() -> None:
+    # Linux applies nice values per thread, so this only slows down the
+    # pre-warmer's own threads when the CPU is contended.
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+    except (AttributeError, OSError):
+        pass
+
+
+class _Bucket:
+    """
+    A token bucket that refills at rate per second up to capacity. take()
+    may overdraw it, for costs that are only known afterwards; nothing is
+    available again until the debt is paid off.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def available(self) -> bool:
+        with self._lock:
+            self._refill()
+            return self._level > 0
+
+    def take(self, amount: float) -> None:
+        with self._lock:
+            self._refill()
+            self._level -= amount
+
+    def wait(self) -> float:
+        """
+        Seconds until a whole unit is available, infinite if the bucket
+        never refills.
+        """
+        with self._lock:
+            self._refill()
+            if self._level >= 1:
+                return 0.0
+            return (1 - self._level) / self.rate if self.rate else float("inf")
+
+
+class Prewarmer:
+    """
+    Runs the related questions of finished answers ahead of time, since users
+    click them often and each click would otherwise start a cold search and
+    generation. Searches go through the search cache; answers, if enabled,
+    are kept here as the stream a query would have sent, and served by
+    claim().
+
+    The work runs on its own small pool of low priority threads, behind a
+    bounded queue, and never competes with foreground queries: jobs are
+    started at most qps times per second, wait while foreground_load() is at
+    or above max_foreground, and answers stop once tokens_per_minute is
+    spent.
+
+    Args:
+    search (Callable[[str], List[dict]]): The cached search function.
+    answer (Callable[[str, List[dict]], Tuple[str, int]]): Answers a query
+        from its contexts, returning the stream and the LLM tokens it took,
+        or None to only pre-warm searches.
+    foreground_load (Callable[[], int]): The foreground queries in flight.
+    top_k (int): The related questions of each answer that are pre-warmed.
+    max_concurrency (int): The jobs run at once.
+    max_queue (int): The jobs waiting to run; more are dropped.
+    qps (float): The jobs started per second, more than 0.
+    tokens_per_minute (float): The LLM tokens answers may spend per minute.
+    max_foreground (int): The foreground load at which jobs pause.
+    max_pause (float): Seconds a job waits for the load to drop before it is
+        dropped.
+    ttl (float): Seconds a pre-warmed answer is kept.
+    maxsize (int): The pre-warmed queries remembered.
+    shared_path (str): A SharedCache database to keep the pre-warmed answers
+        in, so that a click served by another worker process finds them, or
+        None to keep them in this process.
+    """
+
+    def __init__(
+        self,
+        search: Callable[[str], List[dict]],
+        answer: Optional[Callable[[str, List[dict]], Tuple[str, int]]],
+        foreground_load: Callable[[], int],
+        top_k: int = 2,
+        max_concurrency: int = 2,
+        max_queue: int = 32,
+        qps: float = 1.0,
+        tokens_per_minute: float = 20000,
+        max_foreground: int = 4,
+        max_pause: float = 10.0,
+        ttl: float = 600,
+        maxsize: int = 1024,
+        shared_path: Optional[str] = None,
+    ):
+        self.search = search
+        self.answer = answer
+        self.foreground_load = foreground_load
+        self.top_k = top_k
+        self.max_queue = max_queue
+        self.max_foreground = max_foreground
+        self.max_pause = max_pause
+        self._jobs = _Bucket(qps, max(1.0, qps))
+        self._tokens = _Bucket(tokens_per_minute / 60, tokens_per_minute)
+        # normalized query -> the pre-warmed answer stream, or None while it
+        # is in flight or if only its search was pre-warmed.
+        if shared_path:
+            self._entries = SharedCache(shared_path, namespace="prewarm", maxsize=maxsize, ttl=ttl)
+        else:
+            self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._queued = 0
+        self._lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="prewarm",
+            initializer=_lower_priority,
+        )
+
+    def submit(self, related_questions: Optional[list]) -> None:
+        """
+        Queues the top related questions of a finished answer. Questions that
+        are already pre-warmed or queued are skipped.
+        """
+        for item in (related_questions or [])[:self.top_k]:
+            query = item.get("question") if isinstance(item, dict) else None
+            if not query:
+                continue
+            key = normalize_query(query)
+            with self._lock:
+                if self._entries.get_entry(key) is not None:
+                    continue
+                if self._queued >= self.max_queue:
+                    PREWARM_JOBS.labels("dropped_queue").inc()
+                    continue
+                self._queued += 1
+                self._entries.set(key, None)
+            self.executor.submit(self._run, key, query)
+
+    def claim(self, query: str) -> Optional[str]:
+        """
+        Counts a foreground query for a pre-warmed question, and returns its
+        pre-warmed answer stream, if there is one.
+        """
+        entry = self._entries.get_entry(normalize_query(query))
+        if entry is None:
+            return None
+        answer = entry[0]
+        PREWARM_HITS.labels("answer" if answer is not None else "search").inc()
+        return answer
+
+    def _wait_for_capacity(self) -> bool:
+        """
+        Paces the job to the qps budget and waits while the foreground is
+        busy. Returns False if the load did not drop within max_pause.
+        """
+        deadline = time.monotonic() + self.max_pause
+        while True:
+            delay = self._jobs.wait()
+            if delay == 0 and self.foreground_load() < self.max_foreground:
+                self._jobs.take(1)
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(max(delay, 0.1), remaining))
+
+    def _run(self, key: str, query: str) -> None:
+        with self._lock:
+            self._queued -= 1
+        try:
+            if not self._wait_for_capacity():
+                self._entries.pop(key)
+                PREWARM_JOBS.labels("dropped_load").inc()
+                return
+            contexts = self.search(query)
+            if (
+                self.answer is None
+                or not self._tokens.available()
+                or self.foreground_load() >= self.max_foreground
+            ):
+                PREWARM_JOBS.labels("searched").inc()
+                return
+            result, tokens = self.answer(query, contexts)
+            self._tokens.take(tokens)
+            PREWARM_TOKENS.inc(tokens)
+            self._entries.set(key, result)
+            PREWARM_JOBS.labels("answered").inc()
+        except Exception as e:
+            self._entries.pop(key)
+            PREWARM_JOBS.labels("failed").inc()
+            logger.error(f"encountered error while pre-warming {query}: {e}")
@@ -1,78 +1,434 @@
-from dotenv import load_dotenv
-load_dotenv(override=True)
+import time
+_import_started = time.perf_counter()
 
+from utils.config import load_config
+load_config()
+
+import asyncio
 import concurrent.futures
+import functools
 import glob
+import inspect
 import json
 import os
 import re
+import threading
 import traceback
-from typing import Annotated, List, Generator, Optional
+from typing import Annotated, AsyncGenerator, List, Generator, Optional
 
-from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse
+import anyio
+import uvicorn
+from fastapi.responses import FileResponse, Response, StreamingResponse, RedirectResponse
 from loguru import logger
 
+from leptonai.config import DEFAULT_TIMEOUT_KEEP_ALIVE
 from leptonai.photon import Photon, StaticFiles
 from leptonai.photon.types import to_bool
 from leptonai.util import tool
 
-from utils.utils import extract_all_json
+from utils.utils import handler_max_concurrency, stop_words
+from utils.json_stream import parse_json_object
+
+from cache.result_store import MemoryResultStore, get_result_store
+from cache.search_cache import SearchCache, normalize_query
+
+from rag.streaming import STREAM_FORMATS, MEDIA_TYPES, LLM_SPLIT, RELATED_SPLIT, RELATED_MARKER, ChunkCoalescer, RelatedQuestions, InlineRelatedQuestions, StopSequenceGuard, encode_event, validate_related_questions
+from rag.streaming import FLUSH, CancellableStreamingResponse, StreamCancelled, STREAM_CANCELLED, STREAM_TOKENS_SAVED
+from rag.prewarm import Prewarmer
 
-from llm.configure_llm import togetherai_client, openai_client, hf_tgi_client, ollama_client
+from llm.configure_llm import CLIENT_FUNCTIONS, warm_up_client, warm_up_client_async
+from llm.router import LLMRouter, parse_providers
 
-from retrieval.search import search_with_google, search_with_serper,search_with_duckduckgo
-from prompt.prompt import _rag_query_text, _more_questions_prompt, _default_query, _more_questions_prompt_no_tool_call
+from retrieval.search import search_with_google, search_with_serper,search_with_duckduckgo, search_with_bing
+from retrieval.search import async_search_with_google, async_search_with_serper, async_search_with_duckduckgo, async_search_with_bing
+from retrieval.federated import FederatedSearch
+from retrieval.fetch import PageFetcher
+from utils.embeddings import get_embedder
+from utils.tracing import Trace, get_trace_sink
+from utils.startup import record_phase, record_ready, record_first_query
+from utils.admission import AdmissionController, AdmissionMiddleware, ConcurrencyLimit, Rejected
+from retrieval.search import warm_up_search, warm_up_search_async
+from prompt.prompt import _default_query
+from prompt.assembly import PromptAssembler, observe_prompt_usage
+from llm.budget import get_context_budget
 
 class RAG(Photon):
- 
+
+    # The number of concurrent handler calls. In the async pipeline a handler
+    # call only awaits sockets, so this can be set much higher than the
+    # number of threads.
+    handler_max_concurrency = int(
+        os.getenv("HANDLER_MAX_CONCURRENCY", handler_max_concurrency)
+    )
+
     def init(self):
         """
         Initializes photon configs.
         """
+        init_started = time.perf_counter()
         self.backend = os.environ["SEARCH_BACKEND"].upper() #"DUCKDUCKGO"
         print("SEARCH_BACKEND: ",self.backend)
 
-        if self.backend == "GOOGLE":
-            self.search_api_key = os.environ["GOOGLE_SEARCH_API_KEY"]
-            self.search_function = lambda query: search_with_google(
-                query,
-                self.search_api_key,
-                os.environ["GOOGLE_SEARCH_CX"],
+        # An executor to carry out async tasks, such as uploading to KV.
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.handler_max_concurrency * 2
+        )
+
+        # With WORKERS above 1, thesearch.py serves from that many pre-forked
+        # processes and WORKER_ID is the index of this one. Budgets are split
+        # between them, and with SHARED_CACHE_PATH set they share the search
+        # cache and pre-warmed answers through a SQLite database.
+        self.workers = int(os.getenv("WORKERS", 1))
+        self.worker_id = os.getenv("WORKER_ID")
+        self.shared_cache_path = os.getenv("SHARED_CACHE_PATH") or None
+        print("WORKERS: ",self.workers)
+        print("SHARED_CACHE_PATH: ",self.shared_cache_path)
+
+        # Optionally bound the /query requests in progress, with a short
+        # queue, per-client rate limits and fair admission between clients.
+        # Requests beyond that are shed with a 429 or 503 and a Retry-After.
+        if to_bool(os.getenv("ADMISSION_CONTROL", "false")):
+            self.admission = AdmissionController(
+                max_concurrency=int(
+                    os.getenv("ADMISSION_MAX_CONCURRENCY", self.handler_max_concurrency)
+                ),
+                max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", 64)),
+                max_wait=float(os.getenv("ADMISSION_MAX_WAIT", 5)),
+                rate_limit=os.getenv("RATE_LIMIT") or None,
             )
-        elif self.backend == "SERPER":
-            self.search_api_key = os.environ["SERPER_SEARCH_API_KEY"]
-            self.search_function = lambda query: search_with_serper(
-                query,
-                self.search_api_key,
+        else:
+            self.admission = None
+        # Concurrent calls allowed per search backend, and concurrent answer
+        # streams allowed for the llm provider; 0 means no limit.
+        self.search_max_concurrency = int(os.getenv("SEARCH_MAX_CONCURRENCY", 0))
+        self.llm_limit = ConcurrencyLimit(
+            "llm", int(os.getenv("LLM_MAX_CONCURRENCY", 0))
+        )
+        # /batch queues its queries behind its own limits instead of being
+        # shed, so that a large batch runs at a steady rate.
+        self.batch_max_queries = int(os.getenv("BATCH_MAX_QUERIES", 1000))
+        self.batch_search_limit = asyncio.Semaphore(
+            int(os.getenv("BATCH_SEARCH_CONCURRENCY", 8))
+        )
+        self.batch_llm_limit = asyncio.Semaphore(
+            int(os.getenv("BATCH_LLM_CONCURRENCY", 4))
+        )
+
+        if self.backend == "FEDERATED":
+            # Query several backends at once and merge their rankings.
+            self.search_backends = [
+                b.strip().upper()
+                for b in os.getenv("FEDERATED_BACKENDS", "DUCKDUCKGO").split(",")
+                if b.strip()
+            ]
+            print("FEDERATED_BACKENDS: ",self.search_backends)
+            self.federated_search = FederatedSearch(
+                {b: self._search_functions(b)[0] for b in self.search_backends},
+                max_searches=self.handler_max_concurrency,
+                deadline=float(os.getenv("FEDERATED_DEADLINE", 10)),
+                hedge_percentile=float(os.getenv("FEDERATED_HEDGE_PERCENTILE", 95)),
+                hedge_after=float(os.getenv("FEDERATED_HEDGE_AFTER", 2)),
+                min_backends=int(os.getenv("FEDERATED_MIN_BACKENDS", 1)),
             )
-        elif self.backend == "DUCKDUCKGO":
-            self.search_function = lambda query: search_with_duckduckgo(
-                query
+            self.search_function = self.federated_search
+            # The fan-out is thread based, so the async pipeline runs it in a
+            # worker thread.
+            self.async_search_function = lambda query: anyio.to_thread.run_sync(
+                self.federated_search, query
             )
         else:
-            raise RuntimeError("Backend must be DUCKDUCKGO, SERPER or GOOGLE.")
-        
-        # An executor to carry out async tasks, such as uploading to KV.
+            self.search_backends = [self.backend]
+            self.search_function, self.async_search_function = self._search_functions(
+                self.backend
+            )
 
-        self.executor = concurrent.futures.ThreadPoolExecutor(
-            max_workers=self.handler_max_concurrency * 2
+        # Optionally fetch the top result pages, so that the answer is built
+        # from their text rather than from the search snippets alone.
+        if to_bool(os.getenv("FETCH_PAGES", "false")):
+            self.page_fetcher = PageFetcher(
+                max_searches=self.handler_max_concurrency,
+                top_n=int(os.getenv("FETCH_TOP_N", 4)),
+                deadline=float(os.getenv("FETCH_DEADLINE", 3)),
+                max_bytes=int(os.getenv("FETCH_MAX_BYTES", 1024 * 1024)),
+                max_chars=int(os.getenv("FETCH_MAX_CHARS", 4000)),
+                per_host=int(os.getenv("FETCH_PER_HOST", 2)),
+                cache_dir=os.getenv("FETCH_CACHE_DIR", ".page_cache") or None,
+                cache_size=int(os.getenv("FETCH_CACHE_SIZE", 10000)),
+                cache_max_age=float(os.getenv("FETCH_CACHE_MAX_AGE", 7 * 24 * 60 * 60)),
+            )
+        else:
+            self.page_fetcher = None
+
+        # Optionally rerank passages against the query and pack the best ones
+        # into a token budget, so the prompt size no longer depends on what
+        # the search backend happened to return.
+        if to_bool(os.getenv("RERANK", "false")):
+            # Imported here, like the other numpy-backed components, so that
+            # startup only pays for the ones that are enabled.
+            from retrieval.rerank import PassageReranker
+            self.reranker = PassageReranker(
+                get_embedder(),
+                token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500)),
+                passage_words=int(os.getenv("RERANK_PASSAGE_WORDS", 80)),
+                dedup_threshold=float(os.getenv("RERANK_DEDUP_THRESHOLD", 0.92)),
+            )
+        else:
+            self.reranker = None
+
+        # With ASYNC_PIPELINE set, queries run on the event loop end to end:
+        # async search, the async LLM client and an async response stream.
+        self.async_pipeline = to_bool(os.getenv("ASYNC_PIPELINE", "false"))
+        print("ASYNC_PIPELINE: ",self.async_pipeline)
+
+        # The wire format of /query: "events", one JSON event per line, which
+        # can carry sections out of order, or the "legacy" sentinels for
+        # clients that predate it.
+        self.stream_format = os.getenv("STREAM_FORMAT", "events").lower()
+        if self.stream_format not in STREAM_FORMATS:
+            raise RuntimeError(f"STREAM_FORMAT must be one of {STREAM_FORMATS}.")
+        # Related questions come from a second LLM call ("SEPARATE") or from
+        # a trailing section of the answer ("INLINE"), which saves sending the
+        # contexts to the LLM twice.
+        self.related_questions_mode = os.getenv("RELATED_QUESTIONS_MODE", "SEPARATE").upper()
+        if self.related_questions_mode not in ("SEPARATE", "INLINE"):
+            raise RuntimeError("RELATED_QUESTIONS_MODE must be SEPARATE or INLINE.")
+        print("RELATED_QUESTIONS_MODE: ",self.related_questions_mode)
+        # Answers end at the first stop sequence, which is also sent to the
+        # provider, or as soon as the model starts repeating itself.
+        self.stop_guard = to_bool(os.getenv("STOP_GUARD", "true"))
+        print("STOP_GUARD: ",self.stop_guard)
+        # Prompts put the fixed instructions first, for provider prefix
+        # caches, and are memoized per search result set. Their contexts are
+        # fitted to the context window of each model, which also sets
+        # max_tokens.
+        self.prompts = PromptAssembler(
+            RELATED_MARKER, get_context_budget(), int(os.getenv("PROMPT_CACHE_SIZE", 256))
         )
+        print("TOKENIZER: ",self.prompts.budget.counter.name or "estimate")
+        # Related questions that are not ready this many seconds after the
+        # search finished are dropped instead of holding the stream open.
+        self.related_questions_deadline = float(
+            os.getenv("RELATED_QUESTIONS_DEADLINE", 15)
+        )
+        # Answer deltas are batched into chunks of up to STREAM_CHUNK_BYTES,
+        # or whatever arrived within STREAM_FLUSH_INTERVAL seconds.
+        self.stream_chunk_bytes = int(os.getenv("STREAM_CHUNK_BYTES", 1024))
+        self.stream_flush_interval = float(os.getenv("STREAM_FLUSH_INTERVAL", 0.03))
+
+        # Finished responses keyed by search_uuid, so that shared links and
+        # reloads replay the stored result instead of searching again.
+        self.result_store = get_result_store()
+        print("RESULT_STORE: ",type(self.result_store).__name__)
+        if self.workers > 1 and isinstance(self.result_store, MemoryResultStore):
+            logger.warning(
+                "Each worker has its own MEMORY result store, so a shared link only"
+                " replays on the worker that answered it. Use RESULT_STORE=SQLITE."
+            )
+
+        # Replay answers to paraphrases of already answered queries.
+        if to_bool(os.getenv("SEMANTIC_CACHE", "false")):
+            from cache.semantic_cache import SemanticCache
+            semantic_cache_path = os.getenv("SEMANTIC_CACHE_PATH")
+            self.semantic_cache = SemanticCache(
+                get_embedder(),
+                threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92)),
+                ttl=float(os.getenv("SEMANTIC_CACHE_TTL", 86400)),
+                max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", 10000)),
+                # Streams of different formats are kept apart on disk, and
+                # so are workers, whose indexes are written in place.
+                path=(
+                    os.path.join(
+                        semantic_cache_path, self.stream_format,
+                        *([f"worker-{self.worker_id}"] if self.worker_id else []),
+                    )
+                    if semantic_cache_path
+                    else None
+                ),
+            )
+        else:
+            self.semantic_cache = None
+
+        # Cache search results by backend and normalized query, so that hot
+        # queries do not pay for a search API call every time.
+        if to_bool(os.getenv("SEARCH_CACHE", "true")):
+            self.search_cache = SearchCache(
+                self.executor,
+                maxsize=int(os.getenv("SEARCH_CACHE_SIZE", 1024)),
+                ttl=float(os.getenv("SEARCH_CACHE_TTL", 600)),
+                stale_ttl=float(os.getenv("SEARCH_CACHE_STALE_TTL", 3600)),
+                shared_path=self.shared_cache_path,
+            )
+            self.search_function = self.search_cache.wrap(
+                self.backend, self.search_function
+            )
+            self.async_search_function = self.search_cache.wrap_async(
+                self.backend, self.async_search_function
+            )
+        else:
+            self.search_cache = None
 
         self.CLIENT=os.environ["CLIENT"].upper()
         print("LLM_CLIENT: ",self.CLIENT)
 
-        if self.CLIENT=="OPENAI":
-            self.client=openai_client()
-        elif self.CLIENT=="TOGETHER":
-            self.client=togetherai_client()
-        elif self.CLIENT=="HF_TGI":
-            self.client=hf_tgi_client()
-        elif self.CLIENT=="OLLAMA":
-            self.client=ollama_client()
+        if self.CLIENT not in CLIENT_FUNCTIONS:
+            raise RuntimeError("Client must be OPENAI, TOGETHER, HF_TGI or OLLAMA.")
 
-    def get_related_questions(self, query, contexts):
+        # The answer goes to the best healthy provider of LLM_PROVIDERS (by
+        # default just CLIENT), failing over to the next one on errors and, if
+        # there is one to fail over to, on a first token later than
+        # LLM_FIRST_TOKEN_DEADLINE. Related questions can go to cheaper or
+        # faster providers and models of their own.
+        provider_health = dict(
+            failure_threshold=int(os.getenv("LLM_CIRCUIT_FAILURES", 3)),
+            cooldown=float(os.getenv("LLM_CIRCUIT_COOLDOWN", 30)),
+        )
+        llm_providers = os.getenv("LLM_PROVIDERS") or self.CLIENT
+        self.router = self._llm_router("answer", llm_providers, provider_health)
+        self.related_router = self._llm_router(
+            "related",
+            os.getenv("RELATED_QUESTIONS_PROVIDERS") or llm_providers,
+            provider_health,
+        )
+        print("LLM_PROVIDERS: ",[p.label for p in self.router.providers])
+        print("RELATED_QUESTIONS_PROVIDERS: ",[p.label for p in self.related_router.providers])
+
+        # Stage timings are exported as Prometheus metrics on /metrics, and
+        # every query's trace goes to TRACE_SINK.
+        self.trace_sink = get_trace_sink()
+        print("TRACE_SINK: ",type(self.trace_sink).__name__)
+
+        # Optionally search, and with PREWARM_ANSWERS answer, the top related
+        # questions of each finished answer ahead of the click, on spare
+        # capacity and within a token budget. A PREWARM_QPS of 0 disables it.
+        prewarm_qps = float(os.getenv("PREWARM_QPS", 1))
+        if to_bool(os.getenv("PREWARM", "false")) and prewarm_qps > 0:
+            self.prewarmer = Prewarmer(
+                self.search_function,
+                self._prewarm_answer if to_bool(os.getenv("PREWARM_ANSWERS", "false")) else None,
+                lambda: self.llm_limit.active,
+                top_k=int(os.getenv("PREWARM_TOP_K", 2)),
+                max_concurrency=int(os.getenv("PREWARM_CONCURRENCY", 2)),
+                qps=prewarm_qps / self.workers,
+                tokens_per_minute=float(os.getenv("PREWARM_TOKENS_PER_MINUTE", 20000)) / self.workers,
+                max_foreground=int(os.getenv("PREWARM_MAX_FOREGROUND", 4)),
+                ttl=float(os.getenv("PREWARM_TTL", 600)),
+                shared_path=self.shared_cache_path,
+            )
+            print("PREWARM_ANSWERS: ",self.prewarmer.answer is not None)
+        else:
+            self.prewarmer = None
+
+        # Open the pooled connections to the search backend and the LLM
+        # provider in the background, so the first query skips the handshakes.
+        # The async pipeline only uses the async clients, whose connections
+        # must be opened on the server's event loop, by the startup hook
+        # _create_app adds.
+        self.warm_connections = to_bool(os.getenv("WARM_CONNECTIONS", "true"))
+        self._warm_up_task = None
+        if self.warm_connections and not self.async_pipeline:
+            for backend in self.search_backends:
+                self.executor.submit(warm_up_search, backend)
+            self.executor.submit(self._warm_up_clients)
+
+        record_phase("init", time.perf_counter() - init_started)
+        record_ready()
+
+    def _warm_up_clients(self):
+        # Creating the clients imports openai, which is why it is done here
+        # in the background rather than in init.
+        clients = {
+            id(p.client): p.client
+            for p in self.router.providers + self.related_router.providers
+        }
+        for client in clients.values():
+            self.executor.submit(warm_up_client, client)
+
+    async def _warm_up_async_clients(self):
+        # Creating the clients imports openai, which would block the event
+        # loop, so it is done in a thread.
+        def async_clients():
+            return list({
+                id(p.async_client): p.async_client
+                for p in self.router.providers + self.related_router.providers
+            }.values())
+
+        clients = await anyio.to_thread.run_sync(async_clients)
+        await asyncio.gather(
+            *(warm_up_search_async(backend) for backend in self.search_backends),
+            *(warm_up_client_async(client) for client in clients),
+        )
+
+    def _llm_router(self, name, providers, provider_health) -> LLMRouter:
+        providers = parse_providers(providers, self.async_pipeline, **provider_health)
+        first_token_deadline = float(
+            os.getenv("LLM_FIRST_TOKEN_DEADLINE") or (10 if len(providers) > 1 else 0)
+        )
+        return LLMRouter(
+            name,
+            providers,
+            first_token_deadline=first_token_deadline or None,
+            max_workers=self.handler_max_concurrency * 2,
+        )
+
+    def _search_functions(self, backend):
         """
-        Gets related questions based on the query and context.
+        Returns the (sync, async) search functions of a single search backend,
+        limited to SEARCH_MAX_CONCURRENCY concurrent calls.
+        """
+        limit = ConcurrencyLimit(f"search:{backend}", self.search_max_concurrency)
+        search_function, async_search_function = self._backend_search_functions(backend)
+        return limit.wrap(search_function), limit.wrap_async(async_search_function)
+
+    def _backend_search_functions(self, backend):
+        if backend == "GOOGLE":
+            search_api_key = os.environ["GOOGLE_SEARCH_API_KEY"]
+            cx = os.environ["GOOGLE_SEARCH_CX"]
+            return (
+                lambda query: search_with_google(query, search_api_key, cx),
+                lambda query: async_search_with_google(query, search_api_key, cx),
+            )
+        elif backend == "SERPER":
+            search_api_key = os.environ["SERPER_SEARCH_API_KEY"]
+            return (
+                lambda query: search_with_serper(query, search_api_key),
+                lambda query: async_search_with_serper(query, search_api_key),
+            )
+        elif backend == "BING":
+            search_api_key = os.environ["BING_SEARCH_API_KEY"]
+            return (
+                lambda query: search_with_bing(query, search_api_key),
+                lambda query: async_search_with_bing(query, search_api_key),
+            )
+        elif backend == "DUCKDUCKGO":
+            return (
+                lambda query: search_with_duckduckgo(query),
+                lambda query: async_search_with_duckduckgo(query),
+            )
+        elif backend == "LOCAL":
+            # Searches the index built by `python -m retrieval.local_index`.
+            mode = os.getenv("LOCAL_SEARCH_MODE", "HYBRID").upper()
+            print("LOCAL_SEARCH_MODE: ",mode)
+            from retrieval.local_index import LocalIndex
+            index = LocalIndex(
+                os.getenv("LOCAL_INDEX_PATH", ".local_index"),
+                embedder=get_embedder() if mode != "BM25" else None,
+                mode=mode,
+            )
+            return (
+                index.search,
+                lambda query: anyio.to_thread.run_sync(index.search, query),
+            )
+        else:
+            raise RuntimeError(
+                "Backend must be DUCKDUCKGO, SERPER, GOOGLE, BING, LOCAL or FEDERATED."
+            )
+
+    def _related_questions_request(self, query, contexts, provider) -> dict:
+        """
+        Builds the chat completion arguments that ask the provider for related
+        questions. OpenAI gets a tool call, the other clients a JSON-formatted
+        answer.
         """
 
         def ask_related_questions(
@@ -90,133 +446,449 @@ class RAG(Photon):
             ask further questions that are related to the input and output.
             """
             pass
-        
-        if  self.CLIENT=='OPENAI':
-            try:
-                response = self.client.chat.completions.create(
-                    model=os.environ["OPENAI_LLM"],
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": _more_questions_prompt.format(
-                                context="\n\n".join([c["snippet"] for c in contexts])
-                            ),
-                        },
-                        {
-                            "role": "user",
-                            "content": query,
-                        },
-                    ],
-                    tools=[{
-                        "type": "function",
-                        "function": tool.get_tools_spec(ask_related_questions),
-                    }],
-                    max_tokens=512,
-                )
-                related = response.choices[0].message.tool_calls[0].function.arguments
-                logger.error(f"related*****: {related}")
-
 
-                if isinstance(related, str):
-                    related = json.loads(related)
-                logger.trace(f"Related questions: {related}")
-                return related["questions"][:5]
-            except Exception as e:
-                # For any exceptions, we will just return an empty list.
+        prompt = self.prompts.related_prompt(
+            query, contexts, provider.model, provider.supports_tools, 512
+        )
+        if provider.supports_tools:
+            return dict(
+                messages=prompt.messages,
+                tools=[{
+                    "type": "function",
+                    "function": tool.get_tools_spec(ask_related_questions),
+                }],
+                max_tokens=prompt.fit.max_tokens,
+            )
+        return dict(
+            messages=prompt.messages,
+            max_tokens=prompt.fit.max_tokens,
+        )
 
-                logger.error(
-                    "encountered error while generating related questions:"
-                    f" {e}\n{traceback.format_exc()}"
-                )
-                return []
+    def _parse_related_questions(self, response, provider) -> List:
+        """
+        Extracts the related questions from the chat completion response.
+        """
+        observe_prompt_usage("related", provider.label, getattr(response, "usage", None))
+        if provider.supports_tools:
+            related = response.choices[0].message.tool_calls[0].function.arguments
         else:
-            try:
-                if self.CLIENT == "OLLAMA":
-                    llm_model = os.environ["OLLAMA_LLM"]
-                elif self.CLIENT == "HF_TGI":
-                    llm_model = os.environ["HF_TGI_LLM"]
-                else:
-                    llm_model = os.environ["TOGETHER_LLM"]
-                response = self.client.chat.completions.create(
-                    model=llm_model,
-                    messages=[
-                        {
-                            "role": "system", # for llama3 change this to system
-                            "content": _more_questions_prompt_no_tool_call.format(
-                                context="\n\n".join([c["snippet"] for c in contexts])
-                            ),
-                        },
-                        {
-                            "role": "user",  # for llama3 change this to user
-                            "content": query,
-                        },
-                    ],
-                    max_tokens=512,
-                )
-                related = response.choices[0].message.content
-                #some post processing on the response
+            related = response.choices[0].message.content
+        # The model may wrap the JSON in prose or code fences.
+        related = validate_related_questions(parse_json_object(related))
+        if related is None:
+            raise ValueError("The response has no valid related questions.")
+        logger.trace(f"Related questions: {related}")
+        return related
 
-                related=extract_all_json(related)
+    def get_related_questions(self, query, contexts):
+        """
+        Gets related questions based on the query and context.
+        """
+        try:
+            provider, response = self.related_router.create(
+                lambda provider: self._related_questions_request(query, contexts, provider)
+            )
+            return self._parse_related_questions(response, provider)
+        except Exception as e:
+            # For any exceptions, we will just return an empty list.
 
-                logger.error(f"related*****: {related}")
+            logger.error(
+                "encountered error while generating related questions:"
+                f" {e}\n{traceback.format_exc()}"
+            )
+            return []
 
-                if isinstance(related, str):
-                    related = json.loads(related)
-                logger.trace(f"Related questions: {related}")
-                return related["questions"][:5]
-            except Exception as e:
-                logger.error(
-                    "encountered error while generating related questions:"
-                    f" {e}\n{traceback.format_exc()}"
-                )
-                return []   
+    async def get_related_questions_async(self, query, contexts):
+        """
+        Async version of get_related_questions, on the async LLM client.
+        """
+        try:
+            provider, response = await self.related_router.create_async(
+                lambda provider: self._related_questions_request(query, contexts, provider)
+            )
+            return self._parse_related_questions(response, provider)
+        except Exception as e:
+            logger.error(
+                "encountered error while generating related questions:"
+                f" {e}\n{traceback.format_exc()}"
+            )
+            return []
 
-    def _raw_stream_response(
-        self, contexts, llm_response, related_questions_future
-    ) -> Generator[str, None, None]:
+    def _stream_head(self, contexts) -> Generator[str, None, None]:
         """
-        A generator that yields the raw stream response. You do not need to call
-        this directly.
+        Yields the part of the stream that precedes the llm response.
         """
-        # First, yield the contexts.
-        yield json.dumps(contexts)
-        yield "\n\n__LLM_RESPONSE__\n\n"
+        # First, yield the contexts. Fetched page text only feeds the prompt and
+        # is not sent to the client.
+        sources = [{k: v for k, v in c.items() if k != "content"} for c in contexts]
+        if self.stream_format == "events":
+            yield encode_event("sources", sources)
+        else:
+            yield json.dumps(sources) + LLM_SPLIT
         # Second, yield the llm response.
         if not contexts:
             # Prepend a warning to the user
-            yield (
+            yield self._stream_delta(
                 "(The search engine returned nothing for this query. Please take the"
                 " answer with a grain of salt.)\n\n"
             )
+
+    def _stream_delta(self, text) -> str:
+        """
+        Frames a piece of the llm response.
+        """
+        if self.stream_format == "events":
+            return encode_event("delta", text) if text else ""
+        return text
+
+    def _stream_related(self, related_questions) -> Generator[str, None, None]:
+        """
+        Yields the related questions section of the stream. Related questions
+        that missed their deadline (None) are dropped; the legacy format still
+        gets an empty section, since its client waits for one.
+        """
+        if self.stream_format == "events":
+            if related_questions is not None:
+                yield encode_event("related", related_questions)
+            return
+        try:
+            result = json.dumps(related_questions or [])
+        except Exception as e:
+            logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
+            result = "[]"
+        yield RELATED_SPLIT
+        yield result
+
+    def _related_ready(self, related_questions) -> bool:
+        # Only the events format can emit related questions before the answer
+        # has finished.
+        return (
+            related_questions is not None
+            and self.stream_format == "events"
+            and related_questions.ready()
+        )
+
+    def _observe_answer_usage(self, usage, trace) -> None:
+        observe_prompt_usage(
+            "answer", trace.attributes.get("llm_provider", self.CLIENT), usage, trace
+        )
+
+    @staticmethod
+    def _inline_related(related_questions) -> Optional[InlineRelatedQuestions]:
+        if isinstance(related_questions, InlineRelatedQuestions):
+            return related_questions
+        return None
+
+    @staticmethod
+    def _answer_text(inline, text) -> str:
+        # In the "INLINE" mode, the related questions section is cut out of
+        # the answer.
+        return inline.feed(text) if inline is not None else text
+
+    def _stop_guard(self) -> StopSequenceGuard:
+        if self.stop_guard:
+            return StopSequenceGuard(stop_words)
+        return StopSequenceGuard([], max_period=0)
+
+    def _chunk_coalescer(self) -> ChunkCoalescer:
+        return ChunkCoalescer(
+            max_bytes=self.stream_chunk_bytes, max_delay=self.stream_flush_interval
+        )
+
+    def _stream_error(self, e) -> str:
+        """
+        Reports an error that happened after the response started. The events
+        format ends the stream with an error event; the legacy format has no
+        way to signal one, so the error is raised and the connection dropped.
+        A failed stream is never stored.
+        """
+        if self.stream_format != "events":
+            raise e
+        logger.error(f"encountered error while streaming: {e}\n{traceback.format_exc()}")
+        return encode_event("error", {"message": "The answer could not be completed."})
+
+    def _raw_stream_response(
+        self, contexts, llm_response, related_questions, trace, disconnected
+    ) -> Generator[str, None, None]:
+        """
+        A generator that yields the raw stream response. You do not need to call
+        this directly.
+        """
+        yield from self._stream_head(contexts)
+        inline = self._inline_related(related_questions)
+        guard = self._stop_guard()
         for chunk in llm_response:
-            if chunk.choices:
-                yield chunk.choices[0].delta.content or ""
-        if related_questions_future is not None:
-            related_questions = related_questions_future.result()
-            try:
-                result = json.dumps(related_questions)
-            except Exception as e:
-                logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
-                result = "[]"
-            yield "\n\n__RELATED_QUESTIONS__\n\n"
+            if getattr(chunk, "usage", None) is not None:
+                self._observe_answer_usage(chunk.usage, trace)
+            if chunk.choices and chunk.choices[0].delta.content:
+                trace.token()
+                text = guard.feed(chunk.choices[0].delta.content)
+                yield self._stream_delta(self._answer_text(inline, text))
+                if guard.stopped:
+                    # Closing the stream ends the generation upstream.
+                    llm_response.close()
+                    trace.set(answer_stopped=guard.stopped)
+                    break
+            if self._related_ready(related_questions):
+                yield from self._stream_related(related_questions.result())
+                related_questions = None
+        # An interrupted completion ends early, as if it were complete.
+        if disconnected.is_set():
+            raise StreamCancelled()
+        trace.mark("llm_done")
+        yield self._stream_delta(self._answer_text(inline, guard.finish()))
+        if inline is not None:
+            yield self._stream_delta(inline.finish())
+        if related_questions is not None:
+            # The end of the answer is not held back while the related
+            # questions are awaited.
+            yield FLUSH
+            yield from self._stream_related(related_questions.result())
+        if self.stream_format == "events":
+            yield encode_event("done", None)
+
+    async def _raw_stream_response_async(
+        self, contexts, llm_response, related_questions, trace
+    ) -> AsyncGenerator[str, None]:
+        """
+        Async version of _raw_stream_response.
+        """
+        for result in self._stream_head(contexts):
             yield result
+        inline = self._inline_related(related_questions)
+        guard = self._stop_guard()
+        async for chunk in llm_response:
+            if getattr(chunk, "usage", None) is not None:
+                self._observe_answer_usage(chunk.usage, trace)
+            if chunk.choices and chunk.choices[0].delta.content:
+                trace.token()
+                text = guard.feed(chunk.choices[0].delta.content)
+                yield self._stream_delta(self._answer_text(inline, text))
+                if guard.stopped:
+                    await llm_response.aclose()
+                    trace.set(answer_stopped=guard.stopped)
+                    break
+            if self._related_ready(related_questions):
+                for result in self._stream_related(await related_questions.result_async()):
+                    yield result
+                related_questions = None
+        trace.mark("llm_done")
+        yield self._stream_delta(self._answer_text(inline, guard.finish()))
+        if inline is not None:
+            yield self._stream_delta(inline.finish())
+        if related_questions is not None:
+            yield FLUSH
+            for result in self._stream_related(await related_questions.result_async()):
+                yield result
+        if self.stream_format == "events":
+            yield encode_event("done", None)
 
     def stream_response(
-        self, contexts, llm_response, related_questions_future, search_uuid
+        self, contexts, llm_response, related_questions, search_uuid, query, trace, disconnected
     ) -> Generator[str, None, None]:
         """
         Streams the result and uploads to KV.
         """
         # First, stream and yield the results.
         all_yielded_results = []
-        for result in self._raw_stream_response(
-            contexts, llm_response, related_questions_future
-        ):
-            all_yielded_results.append(result)
-            yield result
+        coalescer = self._chunk_coalescer()
+        # A stream that is closed before its end was dropped by the client.
+        outcome = "cancelled"
+        try:
+            with trace.span("stream"):
+                for result in coalescer.coalesce(
+                    self._raw_stream_response(
+                        contexts, llm_response, related_questions, trace, disconnected
+                    )
+                ):
+                    all_yielded_results.append(result)
+                    yield result
+            outcome = "ok"
+        except StreamCancelled:
+            return
+        except Exception as e:
+            outcome = "error"
+            yield self._stream_error(e)
+            return
+        finally:
+            coalescer.observe()
+            trace.finish(outcome)
+        # Second, upload to the result stores. This only runs when the stream
+        # finished cleanly, and is done off the request path.
+        self.executor.submit(
+            self._store_result,
+            search_uuid,
+            query,
+            "".join(all_yielded_results),
+            bool(contexts) and related_questions is not None,
+        )
+        if self.prewarmer is not None and related_questions is not None:
+            self.prewarmer.submit(related_questions.done_result())
+
+    async def stream_response_async(
+        self, contexts, llm_response, related_questions, search_uuid, query, trace
+    ) -> AsyncGenerator[str, None]:
+        """
+        Async version of stream_response.
+        """
+        all_yielded_results = []
+        coalescer = self._chunk_coalescer()
+        outcome = "cancelled"
+        try:
+            with trace.span("stream"):
+                async for result in coalescer.coalesce_async(
+                    self._raw_stream_response_async(
+                        contexts, llm_response, related_questions, trace
+                    )
+                ):
+                    all_yielded_results.append(result)
+                    yield result
+            outcome = "ok"
+        except Exception as e:
+            outcome = "error"
+            yield self._stream_error(e)
+            return
+        finally:
+            coalescer.observe()
+            trace.finish(outcome)
+        self.executor.submit(
+            self._store_result,
+            search_uuid,
+            query,
+            "".join(all_yielded_results),
+            bool(contexts) and related_questions is not None,
+        )
+        if self.prewarmer is not None and related_questions is not None:
+            # A shared pre-warmer reads and writes SQLite, which must not
+            # block the event loop.
+            self.executor.submit(self.prewarmer.submit, related_questions.done_result())
+
+    def _result_key(self, search_uuid) -> str:
+        # Results are stored per stream format, so that a format change never
+        # replays a stream the client cannot parse.
+        return f"{self.stream_format}:{search_uuid}"
+
+    def _store_result(self, search_uuid, query, result, complete):
+        """
+        Stores a finished response by search_uuid and, if it is a complete
+        answer (it had contexts and related questions), in the semantic cache.
+        """
+        if search_uuid:
+            try:
+                self.result_store.set(self._result_key(search_uuid), result)
+            except Exception as e:
+                logger.error(f"encountered error while storing result: {e}")
+        if self.semantic_cache is not None and complete:
+            try:
+                self.semantic_cache.add(query, result)
+            except Exception as e:
+                logger.error(f"encountered error while caching answer: {e}")
+
+    def _stored_result(self, search_uuid, query) -> Optional[str]:
+        """
+        Returns the stored result for the search_uuid or, failing that, the
+        answer to a query similar enough to this one, if any. Errors are
+        swallowed in favor of availability.
+        """
+        if search_uuid:
+            try:
+                result = self.result_store.get(self._result_key(search_uuid))
+                if result is not None:
+                    logger.info(f"Replaying stored result for {search_uuid}")
+                    return result
+            except Exception as e:
+                logger.error(f"encountered error while reading stored result: {e}")
+        if self.prewarmer is not None:
+            result = self.prewarmer.claim(query)
+            if result is not None:
+                logger.info(f"Replaying pre-warmed answer for {query}")
+                return result
+        if self.semantic_cache is not None:
+            try:
+                return self.semantic_cache.lookup(query)
+            except Exception as e:
+                logger.error(f"encountered error while reading semantic cache: {e}")
+        return None
+
+    def _prewarm_answer(self, query, contexts):
+        """
+        Answers a related question ahead of time, for the pre-warmer, with one
+        non-streamed completion that brings its related questions along.
+        Returns the stream the query would have sent and the tokens it took.
+        """
+        trace = Trace(self.trace_sink, self.backend, self.CLIENT)
+        trace.set(query=query, prewarm=True)
+        try:
+            contexts = self._enrich_contexts(query, contexts)
+            provider, response = self.router.create(
+                lambda provider: self._answer_request(
+                    query, contexts, True, provider, trace, stream=False
+                )
+            )
+            observe_prompt_usage("prewarm", provider.label, response.usage, trace)
+            guard = self._stop_guard()
+            inline = InlineRelatedQuestions()
+            answer = response.choices[0].message.content or ""
+            answer = guard.feed(answer) + guard.finish()
+            answer = inline.feed(answer) + inline.finish()
+            result = "".join(self._stream_head(contexts))
+            result += self._stream_delta(answer)
+            result += "".join(self._stream_related(inline.result()))
+            if self.stream_format == "events":
+                result += encode_event("done", None)
+        except BaseException:
+            trace.finish("error")
+            raise
+        trace.finish("prewarmed")
+        return result, getattr(response.usage, "total_tokens", 0) or 0
+
+    def _enrich_contexts(self, query, contexts) -> List[dict]:
+        """
+        Runs the optional stages between search and prompt: page fetching and
+        passage reranking. Errors fall back to the contexts as they were.
+        """
+        if self.page_fetcher is not None:
+            contexts = self.page_fetcher.fetch_contexts(contexts)
+        if self.reranker is not None and contexts:
+            try:
+                contexts = self.reranker.rerank(query, contexts)
+            except Exception as e:
+                logger.error(f"encountered error while reranking: {e}\n{traceback.format_exc()}")
+        return contexts
+
+    def _prepare_query(self, query) -> str:
+        query = query or _default_query
+        # logger.error(f"query*****: {query}")
+        return re.sub(r"\[/?INST\]", "", query)
+
+    def _answer_request(self, query, contexts, inline_questions, provider, trace, stream=True) -> dict:
+        """
+        The arguments of the answer completion, without the model.
+        """
+        with trace.span("prompt"):
+            prompt = self.prompts.answer_prompt(
+                query, contexts, provider.model, inline_questions
+            )
+        trace.set(answer_budget=dict(
+            prompt_tokens=prompt.fit.prompt_tokens,
+            max_tokens=prompt.fit.max_tokens,
+            contexts=len(prompt.fit.texts),
+            trimmed=prompt.fit.trimmed,
+            dropped=prompt.fit.dropped,
+        ))
+        request = dict(
+            messages=prompt.messages, max_tokens=prompt.fit.max_tokens, temperature=0.7
+        )
+        if self.stop_guard:
+            request["stop"] = stop_words[:provider.max_stop_sequences]
+        if stream and provider.supports_stream_usage:
+            # The usage, with the cached prompt tokens, comes in a last chunk.
+            # The pinned openai client predates stream_options.
+            request["extra_body"] = {"stream_options": {"include_usage": True}}
+        return request
 
     @Photon.handler(method="POST", path="/query")
-    def query_function(
+    async def query_function(
         self,
         query: str,
         search_uuid: str,
@@ -235,60 +907,431 @@ class RAG(Photon):
                 questions. Otherwise, will depend on the environment variable
                 RELATED_QUESTIONS. Default: true.
         """
+        started = time.perf_counter()
+        query = self._prepare_query(query)
+        trace = Trace(self.trace_sink, self.backend, self.CLIENT)
+        trace.set(query=query, search_uuid=search_uuid)
 
-        # First, do a search query.
-        query = query or _default_query
-        # logger.error(f"query*****: {query}")
-        query = re.sub(r"\[/?INST\]", "", query)
-        contexts = self.search_function(query)
-
-        system_prompt = _rag_query_text.format(
-            context="\n\n".join(
-                [f"[[citation:{i+1}]] {c['snippet']}" for i, c in enumerate(contexts)]
+        # If the search_uuid or a similar query has already been answered,
+        # replay it.
+        with trace.span("lookup"):
+            stored_result = await anyio.to_thread.run_sync(
+                self._stored_result, search_uuid, query
+            )
+        if stored_result is not None:
+            trace.finish("replayed")
+            return StreamingResponse(
+                iter([stored_result]), media_type=MEDIA_TYPES[self.stream_format]
             )
-        )
 
         try:
-            client = self.client
-
-            if self.CLIENT == "OLLAMA":
-                llm_model = os.environ["OLLAMA_LLM"]
-            elif self.CLIENT == "HF_TGI":
-                llm_model = os.environ["HF_TGI_LLM"]
-            elif self.CLIENT == "TOGETHER":
-                llm_model = os.environ["TOGETHER_LLM"]
-            else:
-                llm_model = os.environ["OPENAI_LLM"]
-            
-            llm_response = client.chat.completions.create(
-                model=llm_model,
-                messages=[
-                    {"role": "system", "content": system_prompt},  # for mixtral change this to user
-                    {"role": "user", "content": query},   # for mixtral change this to assistant
-                ],
-                max_tokens=4000,
-                stream=True,
-                temperature=0.7,
-            )
-
-            if  generate_related_questions:
-                related_questions_future = self.executor.submit(
-                    self.get_related_questions, query, contexts
+            if self.async_pipeline:
+                response = await self._query_async(
+                    query, search_uuid, generate_related_questions, trace
                 )
             else:
-                related_questions_future = None
+                # The blocking pipeline runs in a worker thread, as sync
+                # handlers do.
+                response = await anyio.to_thread.run_sync(
+                    self._query_sync, query, search_uuid, generate_related_questions, trace
+                )
+        except Rejected as e:
+            trace.finish("shed")
+            return self._error_response(
+                e.status_code, json.dumps(e.body()), e.headers(), "application/json"
+            )
+        except BaseException:
+            trace.finish("error")
+            raise
+        if not isinstance(response, StreamingResponse):
+            trace.finish("error")
+        else:
+            # The first query pays for whatever startup deferred.
+            record_first_query(time.perf_counter() - started)
+        return response
+
+    @staticmethod
+    def _error_response(status_code, body, headers=None, media_type="text/html"):
+        # The handler's response class is StreamingResponse, which photon
+        # would wrap any other response in.
+        return StreamingResponse(
+            iter([body]), status_code=status_code, headers=headers, media_type=media_type
+        )
+
+    @staticmethod
+    def _timed(trace, stage, function, *args):
+        with trace.span(stage):
+            return function(*args)
+
+    @staticmethod
+    async def _timed_async(trace, stage, awaitable):
+        with trace.span(stage):
+            return await awaitable
+
+    def _query_sync(self, query, search_uuid, generate_related_questions, trace):
+        """
+        The thread-based pipeline: blocking search, blocking LLM client and a
+        sync generator that Starlette iterates in its thread pool.
+        """
+        # First, do a search query.
+        with trace.span("search"):
+            contexts = self.search_function(query)
+        with trace.span("enrich"):
+            contexts = self._enrich_contexts(query, contexts)
+        trace.set(contexts=len(contexts))
+
+        # A slot for the answer stream, held until the stream ends.
+        permit = self.llm_limit.acquire()
+
+        # Start the related questions as soon as the contexts are known, so
+        # they are generated in parallel with the answer, unless the answer
+        # brings them along.
+        if generate_related_questions and self.related_questions_mode == "INLINE":
+            related_questions = InlineRelatedQuestions()
+        elif generate_related_questions:
+            related_questions = RelatedQuestions(
+                self.executor.submit(
+                    self._timed, trace, "related_questions",
+                    self.get_related_questions, query, contexts,
+                ),
+                self.related_questions_deadline,
+            )
+        else:
+            related_questions = None
 
+        inline_questions = self._inline_related(related_questions) is not None
+        trace.mark("llm_request")
+        try:
+            provider, llm_response = self.router.stream(
+                lambda provider: self._answer_request(
+                    query, contexts, inline_questions, provider, trace
+                )
+            )
         except Exception as e:
             logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
-            return HTMLResponse("Internal server error.", 503)
+            permit.release()
+            if related_questions is not None:
+                related_questions.cancel()
+            return self._error_response(503, "Internal server error.")
+        trace.set(llm_provider=provider.label)
 
-        return StreamingResponse(
+        disconnected = threading.Event()
+        return CancellableStreamingResponse(
             self.stream_response(
-                contexts, llm_response, related_questions_future, search_uuid
+                contexts, permit.hold(llm_response), related_questions,
+                search_uuid, query, trace, disconnected,
+            ),
+            on_disconnect=lambda: self._cancel_stream(
+                disconnected, llm_response, related_questions, trace
             ),
-            media_type="text/html",
+            media_type=MEDIA_TYPES[self.stream_format],
+        )
+
+    async def _query_async(self, query, search_uuid, generate_related_questions, trace):
+        """
+        The asyncio-native pipeline. Nothing here holds a thread while waiting
+        on the search backend or the LLM.
+        """
+        with trace.span("search"):
+            contexts = await self.async_search_function(query)
+        if self.page_fetcher is not None or self.reranker is not None:
+            with trace.span("enrich"):
+                contexts = await anyio.to_thread.run_sync(
+                    self._enrich_contexts, query, contexts
+                )
+        trace.set(contexts=len(contexts))
+
+        permit = self.llm_limit.acquire()
+
+        if generate_related_questions and self.related_questions_mode == "INLINE":
+            related_questions = InlineRelatedQuestions()
+        elif generate_related_questions:
+            related_questions = RelatedQuestions(
+                asyncio.ensure_future(
+                    self._timed_async(
+                        trace, "related_questions",
+                        self.get_related_questions_async(query, contexts),
+                    )
+                ),
+                self.related_questions_deadline,
+            )
+        else:
+            related_questions = None
+
+        inline_questions = self._inline_related(related_questions) is not None
+        trace.mark("llm_request")
+        try:
+            provider, llm_response = await self.router.stream_async(
+                lambda provider: self._answer_request(
+                    query, contexts, inline_questions, provider, trace
+                )
+            )
+        except Exception as e:
+            logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
+            permit.release()
+            if related_questions is not None:
+                related_questions.cancel()
+            return self._error_response(503, "Internal server error.")
+        trace.set(llm_provider=provider.label)
+        llm_response = permit.hold_async(llm_response)
+
+        # The answer stream itself is stopped by the cancellation of the task
+        # that sends it.
+        return CancellableStreamingResponse(
+            self.stream_response_async(
+                contexts, llm_response, related_questions, search_uuid, query, trace
+            ),
+            on_disconnect=lambda: self._cancel_stream(
+                None, None, related_questions, trace
+            ),
+            media_type=MEDIA_TYPES[self.stream_format],
+        )
+
+    def _cancel_stream(self, disconnected, llm_response, related_questions, trace) -> None:
+        """
+        Stops the work of a stream whose client disconnected: the answer
+        completion, which would otherwise be read and paid for to its end, and
+        the related questions job.
+        """
+        if disconnected is not None:
+            disconnected.set()
+        if "llm_done" not in trace.marks:
+            if llm_response is not None:
+                llm_response.interrupt()
+            STREAM_CANCELLED.labels("answer").inc()
+            budget = trace.attributes.get("answer_budget")
+            if budget:
+                STREAM_TOKENS_SAVED.inc(max(0, budget["max_tokens"] - trace.tokens))
+        if related_questions is not None and related_questions.cancel():
+            STREAM_CANCELLED.labels("related_questions").inc()
+        trace.set(cancelled_after_tokens=trace.tokens)
+
+    @Photon.handler(method="POST", path="/batch")
+    async def batch_function(
+        self,
+        queries: List[str],
+        generate_related_questions: Optional[bool] = True,
+    ) -> StreamingResponse:
+        """
+        Answers many queries, for offline jobs such as cache warming and
+        evaluation runs. Queries that only differ in case and whitespace are
+        answered once. The response is one line of JSON per query, in the
+        order the queries finish:
+            {"index": 0, "query": "...", "sources": [...], "answer": "...", "related": [...]}
+        or, for a query that failed:
+            {"index": 0, "query": "...", "error": "..."}
+
+        Searches and LLM calls run at most BATCH_SEARCH_CONCURRENCY and
+        BATCH_LLM_CONCURRENCY at a time.
+        """
+        if len(queries) > self.batch_max_queries:
+            return self._error_response(
+                413,
+                json.dumps({"error": f"At most {self.batch_max_queries} queries per batch."}),
+                media_type="application/json",
+            )
+        indexes = {}
+        for i, query in enumerate(queries):
+            indexes.setdefault(normalize_query(self._prepare_query(query)), []).append(i)
+        # A dropped batch cancels its queries that are still running.
+        return CancellableStreamingResponse(
+            self._batch_stream(queries, list(indexes.values()), generate_related_questions),
+            media_type="application/x-ndjson",
         )
 
+    async def _batch_stream(self, queries, groups, generate_related_questions) -> AsyncGenerator[str, None]:
+        tasks = {
+            asyncio.ensure_future(
+                self._batch_item(self._prepare_query(queries[group[0]]), generate_related_questions)
+            ): group
+            for group in groups
+        }
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    for i in tasks[task]:
+                        yield json.dumps({"index": i, "query": queries[i], **result}) + "\n"
+        finally:
+            # The client went away; stop the rest of the batch.
+            for task in pending:
+                task.cancel()
+
+    async def _batch_item(self, query, generate_related_questions) -> dict:
+        """
+        Answers one query of a batch, with a non-streamed completion.
+        """
+        trace = Trace(self.trace_sink, self.backend, self.CLIENT)
+        trace.set(query=query, batch=True)
+        try:
+            async with self.batch_search_limit:
+                with trace.span("search"):
+                    if self.async_pipeline:
+                        contexts = await self.async_search_function(query)
+                    else:
+                        contexts = await anyio.to_thread.run_sync(self.search_function, query)
+                if self.page_fetcher is not None or self.reranker is not None:
+                    with trace.span("enrich"):
+                        contexts = await anyio.to_thread.run_sync(
+                            self._enrich_contexts, query, contexts
+                        )
+            trace.set(contexts=len(contexts))
+            inline_questions = (
+                generate_related_questions and self.related_questions_mode == "INLINE"
+            )
+            related_questions = None
+            if generate_related_questions and not inline_questions:
+                related_questions = asyncio.ensure_future(
+                    self._timed_async(
+                        trace, "related_questions",
+                        self._batch_related_questions(query, contexts),
+                    )
+                )
+            try:
+                async with self.batch_llm_limit:
+                    with trace.span("llm"):
+                        provider, response = await self._batch_completion(
+                            lambda provider: self._answer_request(
+                                query, contexts, inline_questions, provider, trace, stream=False
+                            )
+                        )
+            except BaseException:
+                if related_questions is not None:
+                    related_questions.cancel()
+                raise
+            trace.set(llm_provider=provider.label)
+            observe_prompt_usage("answer", provider.label, response.usage, trace)
+            answer = response.choices[0].message.content or ""
+            guard = self._stop_guard()
+            answer = guard.feed(answer) + guard.finish()
+            if guard.stopped:
+                trace.set(answer_stopped=guard.stopped)
+            if inline_questions:
+                inline = InlineRelatedQuestions()
+                answer = inline.feed(answer) + inline.finish()
+                related = inline.result()
+            elif related_questions is not None:
+                related = await related_questions
+            else:
+                related = None
+        except asyncio.CancelledError:
+            trace.finish("cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"encountered error in batch query: {e}\n{traceback.format_exc()}")
+            trace.finish("error")
+            return {"error": str(e) or type(e).__name__}
+        trace.finish("ok")
+        return {
+            "sources": [{k: v for k, v in c.items() if k != "content"} for c in contexts],
+            "answer": answer,
+            "related": related or [],
+        }
+
+    async def _batch_completion(self, build_request):
+        if self.async_pipeline:
+            return await self.router.create_async(build_request)
+        return await anyio.to_thread.run_sync(self.router.create, build_request)
+
+    async def _batch_related_questions(self, query, contexts):
+        async with self.batch_llm_limit:
+            if self.async_pipeline:
+                return await self.get_related_questions_async(query, contexts)
+            return await anyio.to_thread.run_sync(
+                self.get_related_questions, query, contexts
+            )
+
+    def _create_app(self, load_mount):
+        """
+        Adds the admission middleware in front of the photon's routes, so that
+        shed requests never reach the handler and its concurrency semaphore.
+        """
+        app = super()._create_app(load_mount)
+        self._call_init_once()
+        if self.admission is not None:
+            app.add_middleware(
+                AdmissionMiddleware,
+                controller=self.admission,
+                paths=("/query",),
+                key_header=os.getenv("ADMISSION_KEY_HEADER") or None,
+            )
+        if self.warm_connections and self.async_pipeline:
+            @app.on_event("startup")
+            async def warm_up_async_clients():
+                # In the background, so that the server does not wait for it.
+                self._warm_up_task = asyncio.create_task(self._warm_up_async_clients())
+        return app
+
+    def serve(self, sock, log_level: str = "info") -> None:
+        """
+        Serves the photon on a socket that is already bound, as the workers
+        of utils.workers.serve_workers do. Photon.launch can only serve on a
+        port it binds itself, so this mirrors it: the same app, startup and
+        shutdown hooks, health checks, uvicorn settings and graceful exit.
+
+        Args:
+        sock (socket.socket): The listening socket.
+        log_level (str): The log level of the launch info.
+        """
+        self._call_init_once()
+        host, port = sock.getsockname()[:2]
+        first_worker = self.worker_id in (None, "0")
+        if (
+            self.health_check_liveness_tcp_port is not None
+            and self.health_check_liveness_tcp_port != port
+            and first_worker
+        ):
+            # The liveness port can only be bound once per host.
+            self._run_liveness_server()
+
+        app = self._create_app(load_mount=True)
+        self._replace_openapi_if_needed(app)
+
+        @app.on_event("startup")
+        async def uvicorn_startup():
+            logger.info(f"Starting photon worker {self.worker_id} - running startup prep code.")
+
+        @app.on_event("shutdown")
+        async def uvicorn_shutdown():
+            logger.info(f"Shutting down photon worker {self.worker_id} - running shutdown prep code.")
+
+        # Added last, so that they act as fallbacks, as in launch.
+        @app.get("/healthz", include_in_schema=False)
+        def healthz():
+            return {"status": "ok"}
+
+        if (
+            self.health_check_liveness_tcp_port is None
+            or self.health_check_liveness_tcp_port == port
+        ):
+            @app.get("/livez", include_in_schema=False)
+            def livez():
+                return {"status": "ok"}
+
+        @app.get("/favicon.ico", include_in_schema=False)
+        def favicon():
+            path = os.path.join(os.path.dirname(inspect.getfile(Photon)), "favicon.ico")
+            if not os.path.exists(path):
+                return Response(status_code=404)
+            return FileResponse(path)
+
+        config = uvicorn.Config(
+            app,
+            log_config=self._uvicorn_log_config(),
+            timeout_graceful_shutdown=self.timeout_graceful_shutdown,
+            proxy_headers=True,
+            forwarded_allow_ips="*",
+            timeout_keep_alive=DEFAULT_TIMEOUT_KEEP_ALIVE,
+        )
+        server = uvicorn.Server(config)
+        if self.incoming_traffic_grace_period:
+            server.handle_exit = functools.partial(self._handle_exit, server)
+        if first_worker:
+            self._print_launch_info(host, port, log_level)
+        server.run(sockets=[sock])
+
     @Photon.handler(mount=True)
     def ui(self):
         return StaticFiles(directory="ui")
@@ -298,4 +1341,7 @@ class RAG(Photon):
         """
         Redirects "/" to the ui page.
         """
-        return RedirectResponse(url="/ui/index.html")
\ No newline at end of file
+        return RedirectResponse(url="/ui/index.html")
+
+
+record_phase("import", time.perf_counter() - _import_started)
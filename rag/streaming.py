@@ -0,0 +1,575 @@
+import asyncio
+import concurrent.futures
+import collections
+import contextvars
+import json
+import queue
+import re
+import threading
+import time
+from typing import AsyncIterator, Callable, Iterable, Optional
+
+import anyio
+from fastapi.responses import StreamingResponse
+from loguru import logger
+from prometheus_client import Counter, Histogram
+
+from utils.json_stream import JSONObjectStream
+
+# The stream formats understood by the web client. "legacy" is the original
+# free-form text with sentinels between the fixed sections, "events" is one
+# JSON event per line, which lets sections arrive in any order and can be
+# parsed incrementally.
+STREAM_FORMATS = ("legacy", "events")
+
+LLM_SPLIT = "\n\n__LLM_RESPONSE__\n\n"
+RELATED_SPLIT = "\n\n__RELATED_QUESTIONS__\n\n"
+
+# The line the model writes between its answer and the related questions in
+# the "INLINE" related questions mode. It never reaches the client.
+RELATED_MARKER = "<related_questions>"
+# The most related questions sent to the client.
+MAX_RELATED_QUESTIONS = 5
+
+# The version of the "events" protocol, sent as a parameter of its media type.
+# Bump it on any incompatible change to the events below.
+#   sources: the list of contexts, always first.
+#   delta:   a piece of the answer, in order.
+#   related: the list of related questions, at most once, at any point.
+#   error:   {"message": ...}; the answer is incomplete and nothing follows.
+#   done:    the last event of a complete stream.
+EVENTS_PROTOCOL_VERSION = 1
+EVENT_TYPES = ("sources", "delta", "related", "error", "done")
+
+MEDIA_TYPES = {
+    "legacy": "text/html",
+    "events": f"application/x-ndjson; version={EVENTS_PROTOCOL_VERSION}",
+}
+
+STREAM_CHUNKS = Histogram(
+    "stream_chunks_per_response",
+    "Number of chunks written per streamed response.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+STREAM_BYTES = Histogram(
+    "stream_bytes_per_response",
+    "Number of bytes written per streamed response.",
+    buckets=(256, 1024, 4096, 16384, 65536, 262144),
+)
+STREAM_CANCELLED = Counter(
+    "stream_cancelled_total",
+    "Work stopped because the client of a stream disconnected.",
+    ["work"],
+)
+ANSWERS_STOPPED = Counter(
+    "llm_answers_stopped_total",
+    "Answers ended early by the stop guard, by reason.",
+    ["reason"],
+)
+STREAM_TOKENS_SAVED = Counter(
+    "stream_cancelled_tokens_saved_total",
+    "Answer tokens not generated because the client disconnected, estimated"
+    " as the max_tokens of each answer minus the tokens already streamed.",
+)
+
+
+def encode_event(event_type: str, data) -> str:
+    """
+    Encodes one event of the "events" stream format as a line of JSON. Since
+    JSON escapes newlines inside strings, a line is always a whole event, no
+    matter what the model writes.
+    """
+    assert event_type in EVENT_TYPES, event_type
+    return json.dumps({"type": event_type, "data": data}) + "\n"
+
+
+def validate_related_questions(value) -> Optional[list]:
+    """
+    Checks the related questions the model wrote, {"questions": [{"question":
+    ...}, ...]}, and returns them without blanks and duplicates, or None if
+    they do not have that shape.
+    """
+    if not isinstance(value, dict) or not isinstance(value.get("questions"), list):
+        return None
+    questions = []
+    seen = set()
+    for item in value["questions"]:
+        question = item.get("question") if isinstance(item, dict) else item
+        if not isinstance(question, str) or not question.strip():
+            continue
+        question = question.strip()
+        if question.lower() in seen:
+            continue
+        seen.add(question.lower())
+        questions.append({"question": question})
+    return questions[:MAX_RELATED_QUESTIONS]
+
+
+class RelatedQuestions:
+    """
+    The related-questions job of a query, started as soon as the contexts are
+    known and bounded by a deadline so that it never holds the stream open.
+
+    Args:
+    future: A concurrent.futures.Future or an asyncio task running the job.
+    deadline (float): Seconds from now after which the result is dropped.
+    """
+
+    def __init__(self, future, deadline: float):
+        self.future = future
+        self.deadline = time.monotonic() + deadline
+
+    def ready(self) -> bool:
+        return self.future.done()
+
+    def cancel(self) -> bool:
+        """
+        Stops the job, if it is still pending or, for asyncio tasks, running.
+        Returns whether it was stopped.
+        """
+        return self.future.cancel()
+
+    def done_result(self) -> Optional[list]:
+        """
+        Returns the related questions if the job has finished with them,
+        without waiting, else None.
+        """
+        if not self.future.done() or self.future.cancelled() or self.future.exception() is not None:
+            return None
+        return self.future.result()
+
+    def _remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def result(self) -> Optional[list]:
+        """
+        Waits for the related questions until the deadline. Returns None if the
+        job did not make it in time.
+        """
+        try:
+            return self.future.result(timeout=self._remaining())
+        except concurrent.futures.TimeoutError:
+            self.future.cancel()
+            logger.warning("Related questions missed their deadline, dropping them.")
+            return None
+
+    async def result_async(self) -> Optional[list]:
+        """
+        Async version of result, for asyncio tasks.
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.future), self._remaining())
+        except asyncio.TimeoutError:
+            self.future.cancel()
+            logger.warning("Related questions missed their deadline, dropping them.")
+            return None
+
+
+class InlineRelatedQuestions:
+    """
+    The related questions of the "INLINE" mode, which the model writes at the
+    end of its answer, after a RELATED_MARKER line, instead of in a second
+    call that would send the whole prompt again. The answer stream is fed
+    through feed(), which returns the answer text and keeps the trailing
+    section for itself; the section is parsed as it streams in, so the
+    questions are ready as soon as their JSON object is closed.
+
+    It has the interface of RelatedQuestions, so the stream handles both the
+    same way.
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._parser = None
+
+    def feed(self, text: str) -> str:
+        """
+        Consumes a piece of the answer stream and returns the part of it that
+        can be sent as answer text.
+        """
+        if self._parser is not None:
+            self._parser.feed(text)
+            return ""
+        self._pending += text
+        index = self._pending.find(RELATED_MARKER)
+        if index != -1:
+            answer = self._pending[:index].rstrip()
+            self._parser = JSONObjectStream()
+            self._parser.feed(self._pending[index + len(RELATED_MARKER):])
+            self._pending = ""
+            return answer
+        # Hold back what may be the start of the marker, and the whitespace
+        # before it.
+        cut = len(self._pending)
+        for length in range(min(len(RELATED_MARKER) - 1, cut), 0, -1):
+            if self._pending.endswith(RELATED_MARKER[:length]):
+                cut -= length
+                break
+        while cut > 0 and self._pending[cut - 1].isspace():
+            cut -= 1
+        answer, self._pending = self._pending[:cut], self._pending[cut:]
+        return answer
+
+    def finish(self) -> str:
+        """
+        Ends the answer stream and returns the answer text held back, if the
+        marker never came.
+        """
+        answer, self._pending = self._pending, ""
+        return answer
+
+    def ready(self) -> bool:
+        return self._parser is not None and self._parser.done
+
+    def cancel(self) -> bool:
+        return False
+
+    def done_result(self) -> Optional[list]:
+        return validate_related_questions(self._parser.value) if self.ready() else None
+
+    def result(self) -> Optional[list]:
+        """
+        Returns the related questions, or None if the model did not write a
+        valid section.
+        """
+        related = validate_related_questions(self._parser.value) if self._parser else None
+        if related is None:
+            logger.warning("The answer had no valid related questions, dropping them.")
+        return related
+
+    async def result_async(self) -> Optional[list]:
+        return self.result()
+
+
+_WORD = re.compile(r"\w+")
+# A word or the start of a code fence that may go on in the next piece.
+_TRAILING_WORD = re.compile(r"(\w+|`+)$")
+_FENCE = "```"
+
+
+class StopSequenceGuard:
+    """
+    Ends an answer early when the model writes a stop sequence, such as the
+    reference list it was told not to write, or falls into a loop. Self-hosted
+    models do both, and would otherwise generate up to max_tokens.
+
+    Stop sequences are matched across chunk boundaries: the end of the text
+    that could be the start of one is held back until the next piece settles
+    it. Loops are found on words: for every period up to max_period words, the
+    guard counts how many words in a row matched the word that many words
+    before, so each word costs one comparison per period. A loop is a phrase
+    repeated `repeats` times over at least min_words words, so that shorter
+    phrases have to repeat more often. Code repeats itself legitimately, so
+    loops are not looked for inside ``` fences; an answer that loops there
+    still ends at max_tokens.
+
+    Args:
+    stop_sequences (list): Strings that end the answer, which is cut before them.
+    max_period (int): The longest repeated phrase looked for, in words. 0 disables it.
+    repeats (int): The number of times a phrase is repeated in a loop.
+    min_words (int): The fewest words a loop spans.
+    """
+
+    def __init__(self, stop_sequences, max_period: int = 64, repeats: int = 4, min_words: int = 80):
+        self.stop_sequences = [s for s in stop_sequences if s]
+        self.max_period = max_period
+        self.repeats = repeats
+        self.min_words = min_words
+        # Why the answer was ended, or None.
+        self.stopped = None
+        self._hold = max((len(s) for s in self.stop_sequences), default=1) - 1
+        self._pending = ""
+        self._partial_word = ""
+        self._words = collections.deque(maxlen=max_period)
+        self._runs = [0] * (max_period + 1)
+        self._in_code = False
+
+    def feed(self, text: str) -> str:
+        """
+        Consumes a piece of the answer and returns the part of it that can be
+        sent. Once stopped is set, the rest of the answer is dropped.
+        """
+        if self.stopped:
+            return ""
+        text = self._pending + text
+        self._pending = ""
+        cut = min(
+            (i for i in (text.find(s) for s in self.stop_sequences) if i != -1),
+            default=-1,
+        )
+        if cut != -1:
+            self._stop("stop_sequence")
+            return text[:cut]
+        keep = len(text)
+        for length in range(min(self._hold, keep), 0, -1):
+            if any(s.startswith(text[-length:]) for s in self.stop_sequences):
+                keep -= length
+                break
+        text, self._pending = text[:keep], text[keep:]
+        if self.max_period and self._loops(text):
+            self._stop("repetition")
+        return text
+
+    def finish(self) -> str:
+        """
+        Ends the answer and returns the text held back.
+        """
+        text, self._pending = self._pending, ""
+        return "" if self.stopped else text
+
+    def _stop(self, reason: str) -> None:
+        self.stopped = reason
+        ANSWERS_STOPPED.labels(reason).inc()
+
+    def _loops(self, text: str) -> bool:
+        # The last word may go on in the next piece.
+        text = self._partial_word + text
+        match = _TRAILING_WORD.search(text)
+        self._partial_word = match.group() if match else ""
+        if match:
+            text = text[:match.start()]
+        for i, part in enumerate(text.split(_FENCE)):
+            if i:
+                # Prose on either side of a code block is not compared.
+                self._in_code = not self._in_code
+                self._words.clear()
+                self._runs = [0] * (self.max_period + 1)
+            if self._in_code:
+                continue
+            for word in _WORD.findall(part.lower()):
+                words = self._words
+                for period in range(1, len(words) + 1):
+                    if words[-period] == word:
+                        self._runs[period] += 1
+                        if self._runs[period] + period >= max(period * self.repeats, self.min_words):
+                            return True
+                    else:
+                        self._runs[period] = 0
+                words.append(word)
+        return False
+
+
+# A piece that makes ChunkCoalescer send its batch at once, yielded before
+# a stream waits on something other than its upstream.
+FLUSH = object()
+
+
+class ChunkCoalescer:
+    """
+    Batches the small pieces of a stream into fewer, larger chunks. Every piece
+    written to the response is a chunk of its own, with a write and framing
+    overhead; batching a few deltas at a time cuts that without a visible delay.
+
+    A batch is sent once it holds max_bytes or its first piece has waited
+    max_delay seconds. The first `eager` pieces (the sources and the first
+    token) are sent right away, to keep the time to first token low. Both
+    versions also flush on a timer while the next piece is slow to come: the
+    sync one reads the pieces on a thread of their own. A FLUSH piece sends the
+    batch at once.
+
+    One coalescer is used per response; chunks and bytes count what it sent.
+
+    Args:
+    max_bytes (int): Batch size that triggers a flush. 0 sends every piece as is.
+    max_delay (float): Seconds a piece may wait in a batch.
+    eager (int): Number of leading pieces sent without batching.
+    """
+
+    def __init__(self, max_bytes: int = 1024, max_delay: float = 0.03, eager: int = 2):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.eager = eager
+        self.chunks = 0
+        self.bytes = 0
+        self._buffer = []
+        self._size = 0
+        self._started = 0.0
+
+    def _add(self, piece: str) -> bool:
+        """
+        Buffers a piece and returns whether the buffer should be flushed.
+        """
+        if not self._buffer:
+            self._started = time.monotonic()
+        self._buffer.append(piece)
+        self._size += len(piece)
+        if self.chunks < self.eager or self._size >= self.max_bytes:
+            return True
+        return time.monotonic() - self._started >= self.max_delay
+
+    def _flush(self) -> str:
+        chunk = "".join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        self.chunks += 1
+        self.bytes += len(chunk.encode())
+        return chunk
+
+    def observe(self) -> None:
+        """
+        Records the chunks and bytes of the response.
+        """
+        STREAM_CHUNKS.observe(self.chunks)
+        STREAM_BYTES.observe(self.bytes)
+
+    def _take(self, piece) -> bool:
+        """
+        Takes a piece and returns whether the buffer should be flushed.
+        """
+        if piece is FLUSH:
+            return bool(self._buffer)
+        return bool(piece) and self._add(piece)
+
+    def coalesce(self, pieces: Iterable[str]):
+        """
+        Batches the pieces of a sync iterator. Closing this stops reading them
+        once the piece being read has arrived, and then closes pieces, on the
+        reading thread.
+        """
+        if not self.max_bytes:
+            # Nothing is ever held back, so nothing needs a timer.
+            for piece in pieces:
+                if self._take(piece):
+                    yield self._flush()
+            return
+        pieces_queue = queue.SimpleQueue()
+        stop = threading.Event()
+
+        def read():
+            try:
+                for piece in pieces:
+                    pieces_queue.put(("piece", piece))
+                    if stop.is_set():
+                        break
+            except BaseException as e:
+                pieces_queue.put(("error", e))
+            finally:
+                close = getattr(pieces, "close", None)
+                if close is not None:
+                    close()
+                pieces_queue.put(("done", None))
+
+        # With a copy of the context, so that the pieces are generated as if
+        # they were read here.
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(read,), name="coalesce", daemon=True
+        ).start()
+        try:
+            while True:
+                timeout = None
+                if self._buffer:
+                    timeout = max(0.0, self._started + self.max_delay - time.monotonic())
+                try:
+                    kind, piece = pieces_queue.get(timeout=timeout)
+                except queue.Empty:
+                    # The upstream is slow, do not hold back what we have.
+                    yield self._flush()
+                    continue
+                if kind == "done":
+                    break
+                if kind == "error":
+                    # Send what is buffered before the error, so that the
+                    # client gets everything that was generated.
+                    if self._buffer:
+                        yield self._flush()
+                    raise piece
+                if self._take(piece):
+                    yield self._flush()
+        finally:
+            stop.set()
+        if self._buffer:
+            yield self._flush()
+
+    async def coalesce_async(self, pieces: AsyncIterator[str]):
+        """
+        Async version of coalesce.
+        """
+        iterator = pieces.__aiter__()
+        pending = None
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                timeout = None
+                if self._buffer:
+                    timeout = max(0.0, self._started + self.max_delay - time.monotonic())
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    # The upstream is slow, do not hold back what we have.
+                    yield self._flush()
+                    continue
+                task, pending = pending, None
+                try:
+                    piece = task.result()
+                except StopAsyncIteration:
+                    break
+                if self._take(piece):
+                    yield self._flush()
+        except Exception:
+            if self._buffer:
+                yield self._flush()
+            raise
+        finally:
+            if pending is not None:
+                pending.cancel()
+        if self._buffer:
+            yield self._flush()
+
+
+class StreamCancelled(Exception):
+    """
+    The client of the stream disconnected.
+    """
+
+
+class CancellableStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that stops the work behind the stream when its client
+    disconnects. Starlette only cancels the task sending the stream, which
+    leaves a sync generator suspended in its worker thread, and any upstream
+    request it reads, until it happens to be collected.
+
+    on_disconnect is called on the event loop as soon as the disconnect is
+    seen, before the stream is cancelled, to stop what the cancellation does
+    not reach: a read blocked in a worker thread, or a job running elsewhere.
+    Once the stream has stopped, its generator is closed, which runs its
+    cleanup.
+
+    Args:
+    content: The body, a generator or an async generator.
+    on_disconnect (callable): Called without arguments when the client
+        disconnects before the end of the stream.
+    """
+
+    def __init__(self, content, on_disconnect: Optional[Callable[[], None]] = None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.content = content
+        self.on_disconnect = on_disconnect
+        self.disconnected = False
+
+    async def listen_for_disconnect(self, receive) -> None:
+        # Returns on the disconnect, and is cancelled if the stream ends first.
+        await super().listen_for_disconnect(receive)
+        self.disconnected = True
+        if self.on_disconnect is not None:
+            try:
+                self.on_disconnect()
+            except Exception as e:
+                logger.error(f"encountered error while cancelling stream: {e}")
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.disconnected:
+                await self._close_content()
+
+    async def _close_content(self) -> None:
+        try:
+            if hasattr(self.content, "aclose"):
+                await self.content.aclose()
+            elif hasattr(self.content, "close"):
+                # Cleanup may block, on a file or a connection.
+                await anyio.to_thread.run_sync(self.content.close)
+        except Exception as e:
+            logger.error(f"encountered error while closing stream: {e}")
@@ -0,0 +1,214 @@
+import collections
+import concurrent.futures
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from loguru import logger
+
+from retrieval.search import REFERENCE_COUNT
+
+# The constant of reciprocal rank fusion. 60 is the value from the original
+# paper and works well for a handful of result lists.
+RRF_K = 60
+# Until a backend has this many latency samples, hedging uses the fixed delay.
+MIN_LATENCY_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalizes a url for deduplication: scheme, "www.", fragments, trailing
+    slashes and tracking parameters do not make two results different.
+    """
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = urlencode(
+        [(k, v) for k, v in parse_qsl(parts.query) if not k.lower().startswith("utm_")]
+    )
+    return urlunsplit(("", host, parts.path.rstrip("/"), query, ""))
+
+
+def to_context(result: dict) -> dict:
+    """
+    Converts a result of any backend to the {name, url, snippet} format.
+    Google items use title/link, the others already use name/url.
+    """
+    return {
+        "name": result.get("name") or result.get("title", ""),
+        "url": result.get("url") or result.get("link", ""),
+        "snippet": result.get("snippet", ""),
+    }
+
+
+def reciprocal_rank_fusion(result_lists: Dict[str, List[dict]], k: int = RRF_K) -> List[dict]:
+    """
+    Merges the ranked result lists of several backends. Each result scores
+    1 / (k + rank) in every list it appears in; duplicates are detected by
+    normalized url and keep the first snippet seen.
+    """
+    scores = collections.defaultdict(float)
+    merged = {}
+    for results in result_lists.values():
+        for rank, result in enumerate(results):
+            context = to_context(result)
+            key = normalize_url(context["url"])
+            scores[key] += 1.0 / (k + rank + 1)
+            merged.setdefault(key, context)
+    return [merged[key] for key in sorted(merged, key=lambda key: -scores[key])]
+
+
+class LatencyTracker:
+    """
+    Keeps a rolling window of latencies per backend.
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=window)
+        )
+        self._lock = threading.Lock()
+
+    def record(self, backend: str, latency: float) -> None:
+        with self._lock:
+            self._latencies[backend].append(latency)
+
+    def percentile(self, backend: str, percentile: float) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(self._latencies[backend])
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+
+class FederatedSearch:
+    """
+    Queries several search backends concurrently and merges their results.
+
+    A backend that is slower than its usual hedge_percentile latency gets a
+    second, hedged request, and whichever of the two answers first wins. The
+    search returns as soon as min_backends backends have answered with at
+    least reference_count distinct results between them, or when the deadline
+    passes, so that one slow provider does not set the latency of the query.
+
+    The requests run on a pool of their own. The caller waits for them, and
+    it may itself be a job of a shared executor, such as a cache refresh or a
+    pre-warmed search; requests queued behind it on that executor would only
+    start once it gave up.
+
+    Args:
+    backends (dict): Backend name to search function.
+    max_searches (int): The concurrent searches the pool is sized for, each
+        with a request and a hedge per backend.
+    reference_count (int): The number of merged results to return.
+    deadline (float): The maximum number of seconds to wait for backends.
+    hedge_percentile (float): The latency percentile after which to hedge.
+    hedge_after (float): The hedging delay used until a backend has enough
+        latency samples.
+    min_backends (int): The number of backends to wait for before returning early.
+    """
+
+    def __init__(
+        self,
+        backends: Dict[str, Callable[[str], List[dict]]],
+        max_searches: int = 8,
+        reference_count: int = REFERENCE_COUNT,
+        deadline: float = 10.0,
+        hedge_percentile: float = 95,
+        hedge_after: float = 2.0,
+        min_backends: int = 1,
+    ):
+        self.backends = backends
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, max_searches * 2 * len(backends)),
+            thread_name_prefix="federated-search",
+        )
+        self.reference_count = reference_count
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after
+        self.min_backends = min(min_backends, len(backends))
+        self.latencies = LatencyTracker()
+        self.hedges = 0
+
+    def _hedge_delay(self, backend: str) -> float:
+        delay = self.latencies.percentile(backend, self.hedge_percentile)
+        return self.hedge_after if delay is None else delay
+
+    def _timed(self, backend: str, query: str):
+        start = time.monotonic()
+        results = self.backends[backend](query)
+        return results, time.monotonic() - start
+
+    def __call__(self, query: str) -> List[dict]:
+        start = time.monotonic()
+        pending = {}
+        attempts = collections.Counter()
+        for backend in self.backends:
+            pending[self.executor.submit(self._timed, backend, query)] = backend
+            attempts[backend] += 1
+        results = {}
+        failed = set()
+
+        def finished(backend):
+            return backend in results or backend in failed
+
+        while True:
+            unanswered = [b for b in self.backends if not finished(b)]
+            answered = len(self.backends) - len(unanswered)
+            if not unanswered:
+                break
+            if (
+                answered >= self.min_backends
+                and len(reciprocal_rank_fusion(results)) >= self.reference_count
+            ):
+                break
+            now = time.monotonic()
+            if now - start >= self.deadline:
+                logger.warning(f"Federated search deadline passed, missing {unanswered}")
+                break
+            # Wake up at the next hedge point or at the deadline.
+            wake_up = start + self.deadline
+            for backend in unanswered:
+                if attempts[backend] == 1:
+                    hedge_at = start + self._hedge_delay(backend)
+                    if hedge_at <= now:
+                        logger.info(f"Hedging slow search backend {backend}")
+                        pending[self.executor.submit(self._timed, backend, query)] = backend
+                        attempts[backend] += 1
+                        self.hedges += 1
+                    else:
+                        wake_up = min(wake_up, hedge_at)
+            done, _ = concurrent.futures.wait(
+                [f for f, b in pending.items() if not finished(b)],
+                timeout=max(0.0, wake_up - time.monotonic()),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                backend = pending.pop(future)
+                if finished(backend):
+                    continue
+                try:
+                    backend_results, latency = future.result()
+                except Exception as e:
+                    logger.error(f"Search backend {backend} failed: {e}")
+                    backend_results, latency = None, None
+                if backend_results:
+                    self.latencies.record(backend, latency)
+                    results[backend] = backend_results
+                elif backend not in pending.values():
+                    # Empty or failed, and no other attempt in flight.
+                    failed.add(backend)
+
+        # Requests still in flight are not waited for. The ones that have not
+        # started yet are cancelled.
+        for future in pending:
+            future.cancel()
+        return reciprocal_rank_fusion(results)[: self.reference_count]
@@ -0,0 +1,334 @@
+import codecs
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from html.parser import HTMLParser
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from loguru import logger
+
+from utils.http_pool import get_http_client
+
+# Tags whose text is never part of the main content of a page.
+SKIPPED_TAGS = {
+    "script", "style", "noscript", "nav", "header", "footer", "aside", "form",
+    "svg", "iframe", "button", "select", "template",
+}
+# Tags that end a block of text.
+BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "li", "ul", "ol", "table", "tr",
+    "td", "th", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "br",
+    "dd", "dt", "figcaption",
+}
+# Blocks shorter than this many words are navigation crumbs, buttons and the like.
+MIN_BLOCK_WORDS = 6
+
+
+class MainTextExtractor(HTMLParser):
+    """
+    Extracts the readable text of an html page: text outside of scripts,
+    navigation and other boilerplate, split into blocks, keeping only blocks
+    long enough to be prose.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._skip_depth = 0
+        self._blocks = []
+        self._current = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self._end_block()
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self._end_block()
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._current.append(data)
+
+    def _end_block(self):
+        text = re.sub(r"\s+", " ", "".join(self._current)).strip()
+        self._current = []
+        if len(text.split()) >= MIN_BLOCK_WORDS:
+            self._blocks.append(text)
+
+    def text(self) -> str:
+        self._end_block()
+        return "\n".join(self._blocks)
+
+
+def extract_main_text(html: str) -> str:
+    extractor = MainTextExtractor()
+    try:
+        extractor.feed(html)
+        extractor.close()
+    except Exception as e:
+        logger.warning(f"Could not parse page: {e}")
+    return extractor.text()
+
+
+class PageCache:
+    """
+    Fetched pages on disk, one JSON file per url, with the ETag and
+    Last-Modified headers used to revalidate them. Files older than max_age
+    and the oldest ones beyond max_entries are purged from time to time on
+    write.
+
+    Args:
+    directory (str): The directory of the files.
+    max_entries (int): The maximum number of cached pages, or None.
+    max_age (float): Seconds a page is kept after it was last written, or None.
+    """
+
+    # Run the purge once every this many writes.
+    PURGE_EVERY = 100
+
+    def __init__(self, directory: str, max_entries: Optional[int] = 10000, max_age: Optional[float] = 7 * 24 * 60 * 60):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._writes = 0
+        self._write_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # A restarted server starts within the limits.
+        self.purge()
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def get(self, url: str) -> Optional[dict]:
+        try:
+            with open(self._path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, url: str, entry: dict) -> None:
+        path = self._path(url)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not cache page {url}: {e}")
+        with self._write_lock:
+            self._writes += 1
+            purge = self._writes % self.PURGE_EVERY == 0
+        if purge:
+            self.purge()
+
+    def purge(self) -> None:
+        """
+        Deletes the pages older than max_age and, if max_entries is set, the
+        oldest pages above it. Pages are aged by their last write, which is a
+        fetch or a revalidation.
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+        entries.sort(reverse=True)
+        now = time.time()
+        for i, (modified_at, path) in enumerate(entries):
+            too_old = self.max_age is not None and now - modified_at > self.max_age
+            too_many = self.max_entries is not None and i >= self.max_entries
+            if too_old or too_many:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Already purged by another worker.
+                    pass
+
+
+class PageFetcher:
+    """
+    Fetches the top result pages of a search concurrently and adds their main
+    text to the contexts as "content".
+
+    Every fetch is bounded: at most per_host connections per host, max_bytes
+    per page, and one global deadline for the whole stage. Pages that miss the
+    deadline, fail or have no usable text keep only their snippet.
+
+    The fetches run on a pool of their own, as the caller waits for them and
+    may itself be a job of a shared executor.
+
+    Args:
+    max_searches (int): The concurrent fetch stages the pool is sized for,
+        each with top_n fetches.
+    top_n (int): The number of top results to fetch.
+    deadline (float): The number of seconds the whole stage may take.
+    max_bytes (int): The maximum number of bytes read from a page.
+    max_chars (int): The maximum number of characters of text kept per page.
+    per_host (int): The maximum number of concurrent fetches per host.
+    cache_dir (str): The directory of the page cache, or None to disable it.
+    cache_ttl (float): Seconds a cached page is used without revalidation.
+    cache_size (int): The maximum number of cached pages.
+    cache_max_age (float): Seconds a cached page is kept for revalidation.
+    """
+
+    def __init__(
+        self,
+        max_searches: int = 8,
+        top_n: int = 4,
+        deadline: float = 3.0,
+        max_bytes: int = 1024 * 1024,
+        max_chars: int = 4000,
+        per_host: int = 2,
+        cache_dir: Optional[str] = ".page_cache",
+        cache_ttl: float = 24 * 60 * 60,
+        cache_size: int = 10000,
+        cache_max_age: float = 7 * 24 * 60 * 60,
+    ):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, max_searches * top_n), thread_name_prefix="page-fetch"
+        )
+        self.top_n = top_n
+        self.deadline = deadline
+        self.max_bytes = max_bytes
+        self.max_chars = max_chars
+        self.per_host = per_host
+        self.cache = PageCache(cache_dir, cache_size, cache_max_age) if cache_dir else None
+        self.cache_ttl = cache_ttl
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    def _host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_semaphores[host]
+
+    def fetch_contexts(self, contexts: List[dict]) -> List[dict]:
+        """
+        Adds "content" to the top_n contexts whose page could be fetched in time.
+        """
+        deadline_at = time.monotonic() + self.deadline
+        futures = {}
+        for context in contexts[: self.top_n]:
+            url = context.get("url") or context.get("link")
+            if url and url.startswith(("http://", "https://")):
+                futures[self.executor.submit(self.fetch, url, deadline_at)] = context
+        done, not_done = concurrent.futures.wait(futures, timeout=self.deadline)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            try:
+                text = future.result()
+            except Exception as e:
+                logger.warning(f"Could not fetch {futures[future].get('url')}: {e}")
+                continue
+            if text:
+                futures[future]["content"] = text
+        logger.info(
+            f"Fetched {sum(1 for c in futures.values() if 'content' in c)} of"
+            f" {len(futures)} pages, {len(not_done)} missed the deadline"
+        )
+        return contexts
+
+    def fetch(self, url: str, deadline_at: float) -> Optional[str]:
+        """
+        Returns the main text of the page at url, or None.
+        """
+        cached = self.cache.get(url) if self.cache else None
+        if cached and time.time() - cached["fetched_at"] < self.cache_ttl:
+            return cached["text"]
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        semaphore = self._host_semaphore(url)
+        if not semaphore.acquire(timeout=max(0.0, deadline_at - time.monotonic())):
+            return None
+        try:
+            html = self._download(url, headers, deadline_at)
+        finally:
+            semaphore.release()
+        if html is None:
+            return None
+        if html is NOT_MODIFIED:
+            text = cached["text"]
+            etag, last_modified = cached.get("etag"), cached.get("last_modified")
+        else:
+            text, etag, last_modified = html
+            text = extract_main_text(text)[: self.max_chars]
+        if self.cache:
+            self.cache.set(url, {
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "text": text,
+                "fetched_at": time.time(),
+            })
+        return text
+
+    def _download(self, url, headers, deadline_at):
+        """
+        Streams the page body, decoding as it goes, and stops at max_bytes or at
+        the deadline. Returns (html, etag, last_modified), NOT_MODIFIED or None.
+        """
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            return None
+        client = get_http_client("fetch")
+        with client.stream(
+            "GET",
+            url,
+            headers=headers,
+            timeout=httpx.Timeout(remaining),
+            follow_redirects=True,
+        ) as response:
+            if response.status_code == 304:
+                return NOT_MODIFIED
+            if response.status_code != 200:
+                return None
+            content_type = response.headers.get("content-type", "")
+            if content_type and "html" not in content_type and "text" not in content_type:
+                return None
+            try:
+                decoder_class = codecs.getincrementaldecoder(
+                    response.charset_encoding or "utf-8"
+                )
+            except LookupError:
+                decoder_class = codecs.getincrementaldecoder("utf-8")
+            decoder = decoder_class(errors="replace")
+            parts = []
+            size = 0
+            for chunk in response.iter_bytes():
+                # Chunks can be far larger than the limit.
+                chunk = chunk[: self.max_bytes - size]
+                size += len(chunk)
+                parts.append(decoder.decode(chunk))
+                if size >= self.max_bytes:
+                    break
+                if time.monotonic() >= deadline_at:
+                    return None
+            parts.append(decoder.decode(b"", final=True))
+            return (
+                "".join(parts),
+                response.headers.get("etag"),
+                response.headers.get("last-modified"),
+            )
+
+
+# Marker returned by PageFetcher._download when the cached page is still valid.
+NOT_MODIFIED = object()
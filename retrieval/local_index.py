@@ -0,0 +1,457 @@
+"""
+A local search backend over a directory of documents, for SEARCH_BACKEND=LOCAL.
+
+The indexer splits every document into passages and stores, in memory-mappable
+files, an inverted BM25 index and, optionally, a matrix of passage embeddings:
+
+    python -m retrieval.local_index docs/ --index .local_index
+
+Running it again only re-reads and re-embeds the files that changed. Each run
+writes a new generation of the index and then switches to it atomically, so a
+running server picks it up without restarting.
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from retrieval.federated import RRF_K
+from retrieval.fetch import extract_main_text
+from retrieval.rerank import split_passages
+from retrieval.search import REFERENCE_COUNT
+
+INDEX_VERSION = 1
+DEFAULT_EXTENSIONS = (".md", ".markdown", ".txt", ".rst", ".html", ".htm")
+BM25_K1 = 1.2
+BM25_B = 0.75
+# The number of candidates of each ranking that hybrid search fuses.
+HYBRID_CANDIDATES = 100
+# Rows of the embedding matrix scored at once, to bound the float32 copy.
+DENSE_BLOCK_ROWS = 16384
+
+_TOKEN = re.compile(r"\w+")
+_MARKDOWN_TITLE = re.compile(r"^#\s+(.+)$", re.MULTILINE)
+_HTML_TITLE = re.compile(r"<title[^>]*>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+def _read_document(path: str) -> Tuple[str, str]:
+    """
+    Returns the title and text of a document.
+    """
+    with open(path, encoding="utf-8", errors="replace") as f:
+        raw = f.read()
+    if path.lower().endswith((".html", ".htm")):
+        match = _HTML_TITLE.search(raw)
+        return (match.group(1).strip() if match else ""), extract_main_text(raw)
+    match = _MARKDOWN_TITLE.search(raw)
+    return (match.group(1).strip() if match else ""), raw
+
+
+def _document_url(path: str, relative_path: str, base_url: Optional[str]) -> str:
+    if base_url:
+        return base_url.rstrip("/") + "/" + relative_path.replace(os.sep, "/")
+    return Path(path).resolve().as_uri()
+
+
+class _Generation:
+    """
+    One immutable generation of an index on disk, with its arrays memory
+    mapped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, "docs.json")) as f:
+            self.docs = json.load(f)
+        with open(os.path.join(path, "vocab.json")) as f:
+            self.vocab = json.load(f)
+        self.count = len(self.docs)
+        self.texts = self._memmap("texts.bin")
+        self.text_offsets = self._load("text_offsets.npy")
+        self.postings_offsets = self._load("postings_offsets.npy")
+        self.postings_docs = self._load("postings_docs.npy")
+        self.postings_tf = self._load("postings_tf.npy")
+        self.doc_lengths = self._load("doc_lengths.npy")
+        self.embeddings = (
+            self._load("embeddings.npy")
+            if os.path.exists(os.path.join(path, "embeddings.npy")) else None
+        )
+        average_length = float(self.doc_lengths.mean()) if self.count else 1.0
+        # The document length part of the BM25 denominator, per passage.
+        self.length_norm = (
+            BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths / max(average_length, 1.0))
+        ).astype(np.float32)
+
+    def _load(self, name: str):
+        return np.load(os.path.join(self.path, name), mmap_mode="r")
+
+    def _memmap(self, name: str):
+        path = os.path.join(self.path, name)
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(path, dtype=np.uint8, mode="r")
+
+    def text(self, i: int) -> str:
+        return bytes(self.texts[self.text_offsets[i]:self.text_offsets[i + 1]]).decode("utf-8")
+
+
+def _current_generation(index_path: str) -> Optional[str]:
+    try:
+        with open(os.path.join(index_path, "CURRENT")) as f:
+            return os.path.join(index_path, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+class LocalIndex:
+    """
+    Searches a local index with BM25, embeddings or both. Hybrid search fuses
+    the BM25 and embedding rankings with reciprocal rank fusion, like the
+    federated search does across backends. Results have the {name, url,
+    snippet} shape of the remote backends, with the passage as snippet.
+
+    A newer generation written by the indexer is picked up on the next
+    search after reload_interval seconds.
+
+    Args:
+    path (str): The index directory.
+    embedder (Embedder): Embeds queries for the embedding and hybrid modes.
+    mode (str): "BM25", "DENSE" or "HYBRID". Without embeddings in the index,
+        or without an embedder, searches fall back to BM25.
+    reference_count (int): The number of results to return.
+    reload_interval (float): Seconds between checks for a new generation.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        embedder=None,
+        mode: str = "HYBRID",
+        reference_count: int = REFERENCE_COUNT,
+        reload_interval: float = 5.0,
+    ):
+        if mode not in ("BM25", "DENSE", "HYBRID"):
+            raise RuntimeError("LOCAL_SEARCH_MODE must be BM25, DENSE or HYBRID.")
+        self.path = path
+        self.embedder = embedder
+        self.mode = mode
+        self.reference_count = reference_count
+        self.reload_interval = reload_interval
+        self._generation = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh()
+        if self._generation is None:
+            logger.warning(f"No local index at {path}, local search returns nothing.")
+
+    def _refresh(self) -> None:
+        current = _current_generation(self.path)
+        if current is None or (self._generation and self._generation.path == current):
+            return
+        generation = _Generation(current)
+        model = generation.meta.get("embedding_model")
+        if generation.embeddings is not None and self.embedder is not None and model != self.embedder.model_name:
+            logger.warning(
+                f"The local index was embedded with {model}, not {self.embedder.model_name};"
+                " searching it with BM25 only."
+            )
+            generation.embeddings = None
+        self._generation = generation
+        logger.info(f"Loaded local index {current} with {generation.count} passages")
+
+    def _current(self) -> Optional[_Generation]:
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            with self._lock:
+                if now - self._checked_at >= self.reload_interval:
+                    self._checked_at = now
+                    try:
+                        self._refresh()
+                    except Exception as e:
+                        logger.error(f"encountered error while loading local index: {e}")
+        return self._generation
+
+    def _bm25(self, generation: _Generation, query: str) -> np.ndarray:
+        scores = np.zeros(generation.count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = generation.vocab.get(term)
+            if term_id is None:
+                continue
+            start = generation.postings_offsets[term_id]
+            end = generation.postings_offsets[term_id + 1]
+            docs = generation.postings_docs[start:end]
+            tf = generation.postings_tf[start:end].astype(np.float32)
+            df = end - start
+            idf = math.log(1 + (generation.count - df + 0.5) / (df + 0.5))
+            scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + generation.length_norm[docs])
+        return scores
+
+    def _dense(self, generation: _Generation, query: str) -> np.ndarray:
+        query_embedding = self.embedder.embed([query])[0]
+        scores = np.empty(generation.count, dtype=np.float32)
+        for start in range(0, generation.count, DENSE_BLOCK_ROWS):
+            block = generation.embeddings[start:start + DENSE_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query_embedding
+        return scores
+
+    @staticmethod
+    def _top(scores: np.ndarray, k: int, positive: bool = False) -> np.ndarray:
+        if positive:
+            candidates = np.flatnonzero(scores > 0)
+        else:
+            candidates = np.arange(len(scores))
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    def search(self, query: str) -> List[dict]:
+        generation = self._current()
+        if generation is None or not generation.count:
+            return []
+        mode = self.mode
+        if generation.embeddings is None or self.embedder is None:
+            mode = "BM25"
+        if mode == "BM25":
+            ranked = self._top(self._bm25(generation, query), self.reference_count, positive=True)
+        elif mode == "DENSE":
+            ranked = self._top(self._dense(generation, query), self.reference_count)
+        else:
+            fused = collections.defaultdict(float)
+            rankings = (
+                self._top(self._bm25(generation, query), HYBRID_CANDIDATES, positive=True),
+                self._top(self._dense(generation, query), HYBRID_CANDIDATES),
+            )
+            for ranking in rankings:
+                for rank, i in enumerate(ranking):
+                    fused[int(i)] += 1.0 / (RRF_K + rank + 1)
+            ranked = sorted(fused, key=lambda i: -fused[i])[: self.reference_count]
+        return [
+            {
+                "name": generation.docs[i][0],
+                "url": generation.docs[i][1],
+                "snippet": generation.text(i),
+            }
+            for i in ranked
+        ]
+
+
+def _previous_passages(
+    index_path: str, embedding_model: Optional[str], base_url: Optional[str], passage_words: int
+) -> Dict[str, dict]:
+    """
+    Returns the passages of the current generation by file, to reuse those of
+    unchanged files. Nothing is reused if it was built with other settings.
+    """
+    current = _current_generation(index_path)
+    if current is None:
+        return {}
+    try:
+        generation = _Generation(current)
+    except Exception as e:
+        logger.warning(f"Could not read the previous index, rebuilding it: {e}")
+        return {}
+    if (generation.meta.get("version"), generation.meta.get("base_url"), generation.meta.get("passage_words")) != (
+        INDEX_VERSION, base_url, passage_words
+    ):
+        return {}
+    reuse_embeddings = (
+        generation.embeddings is not None
+        and generation.meta.get("embedding_model") == embedding_model
+    )
+    files = {}
+    for relative_path, entry in generation.meta["files"].items():
+        start, end = entry["passages"]
+        files[relative_path] = {
+            "mtime_ns": entry["mtime_ns"],
+            "size": entry["size"],
+            "docs": generation.docs[start:end],
+            "texts": [generation.text(i) for i in range(start, end)],
+            "embeddings": (
+                np.array(generation.embeddings[start:end]) if reuse_embeddings else None
+            ),
+        }
+    return files
+
+
+def build_index(
+    docs_path: str,
+    index_path: str,
+    embedder=None,
+    base_url: Optional[str] = None,
+    passage_words: int = 120,
+    extensions=DEFAULT_EXTENSIONS,
+) -> dict:
+    """
+    Indexes the documents under docs_path into a new generation of the index
+    at index_path, reusing the passages and embeddings of unchanged files.
+    Returns statistics of the run.
+    """
+    embedding_model = embedder.model_name if embedder is not None else None
+    previous = _previous_passages(index_path, embedding_model, base_url, passage_words)
+    files = {}
+    docs = []
+    texts = []
+    embeddings = []
+    to_embed = []
+    stats = collections.Counter()
+    for root, dirnames, filenames in os.walk(docs_path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for filename in sorted(filenames):
+            if not filename.lower().endswith(extensions):
+                continue
+            path = os.path.join(root, filename)
+            relative_path = os.path.relpath(path, docs_path)
+            stat = os.stat(path)
+            old = previous.get(relative_path)
+            start = len(docs)
+            if old and old["mtime_ns"] == stat.st_mtime_ns and old["size"] == stat.st_size:
+                file_docs, file_texts = old["docs"], old["texts"]
+                file_embeddings = old["embeddings"]
+                stats["unchanged"] += 1
+            else:
+                title, text = _read_document(path)
+                file_texts = split_passages(text, passage_words)
+                name = title or Path(filename).stem
+                url = _document_url(path, relative_path, base_url)
+                file_docs = [[name, url]] * len(file_texts)
+                file_embeddings = None
+                stats["indexed"] += 1
+            if embedder is not None and file_embeddings is None and file_texts:
+                to_embed.append((len(embeddings), file_texts))
+            docs.extend(file_docs)
+            texts.extend(file_texts)
+            embeddings.append(file_embeddings)
+            files[relative_path] = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "passages": [start, len(docs)],
+            }
+    stats["removed"] = len(set(previous) - set(files))
+
+    if embedder is not None:
+        pending = [text for _, file_texts in to_embed for text in file_texts]
+        if pending:
+            logger.info(f"Embedding {len(pending)} passages with {embedding_model}")
+            vectors = embedder.embed(pending).astype(np.float16)
+            offset = 0
+            for position, file_texts in to_embed:
+                embeddings[position] = vectors[offset:offset + len(file_texts)]
+                offset += len(file_texts)
+        stats["embedded"] = len(pending)
+
+    generation = f"gen-{time.time_ns()}"
+    path = os.path.join(index_path, generation)
+    os.makedirs(path)
+    _write_passages(path, docs, texts)
+    _write_postings(path, texts)
+    dimension = None
+    if embedder is not None:
+        matrix = [e for e in embeddings if e is not None and len(e)]
+        dimension = matrix[0].shape[1] if matrix else embedder.dimension
+        np.save(
+            os.path.join(path, "embeddings.npy"),
+            np.concatenate(matrix) if matrix else np.zeros((0, dimension), dtype=np.float16),
+        )
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({
+            "version": INDEX_VERSION,
+            "embedding_model": embedding_model,
+            "dimension": dimension,
+            "base_url": base_url,
+            "passage_words": passage_words,
+            "files": files,
+        }, f)
+
+    # Switch to the new generation atomically, then drop the older ones.
+    current = os.path.join(index_path, "CURRENT")
+    with open(current + ".tmp", "w") as f:
+        f.write(generation)
+    os.replace(current + ".tmp", current)
+    for entry in os.listdir(index_path):
+        if entry.startswith("gen-") and entry != generation:
+            shutil.rmtree(os.path.join(index_path, entry), ignore_errors=True)
+    stats["passages"] = len(docs)
+    return dict(stats)
+
+
+def _write_passages(path: str, docs: List[list], texts: List[str]) -> None:
+    encoded = [text.encode("utf-8") for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    with open(os.path.join(path, "texts.bin"), "wb") as f:
+        for e in encoded:
+            f.write(e)
+    np.save(os.path.join(path, "text_offsets.npy"), offsets)
+    with open(os.path.join(path, "docs.json"), "w") as f:
+        json.dump(docs, f)
+
+
+def _write_postings(path: str, texts: List[str]) -> None:
+    """
+    Writes the inverted index in CSR form: the postings of term t are
+    postings_docs[postings_offsets[t]:postings_offsets[t + 1]], with their
+    term frequencies in postings_tf.
+    """
+    vocab = {}
+    terms, docs, tfs = [], [], []
+    lengths = np.zeros(len(texts), dtype=np.int32)
+    for i, text in enumerate(texts):
+        tokens = tokenize(text)
+        lengths[i] = len(tokens)
+        for term, tf in collections.Counter(tokens).items():
+            terms.append(vocab.setdefault(term, len(vocab)))
+            docs.append(i)
+            tfs.append(tf)
+    terms = np.array(terms, dtype=np.int32)
+    order = np.argsort(terms, kind="stable")
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(terms, minlength=len(vocab)), out=offsets[1:])
+    np.save(os.path.join(path, "postings_offsets.npy"), offsets)
+    np.save(os.path.join(path, "postings_docs.npy"), np.array(docs, dtype=np.int32)[order])
+    np.save(
+        os.path.join(path, "postings_tf.npy"),
+        np.minimum(np.array(tfs, dtype=np.int64), np.iinfo(np.uint16).max).astype(np.uint16)[order],
+    )
+    np.save(os.path.join(path, "doc_lengths.npy"), lengths)
+    with open(os.path.join(path, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("docs", help="The directory of documents to index.")
+    parser.add_argument("--index", default=os.getenv("LOCAL_INDEX_PATH", ".local_index"))
+    parser.add_argument("--base-url", default=os.getenv("LOCAL_BASE_URL"), help="The url the documents are served under; file:// urls by default.")
+    parser.add_argument("--passage-words", type=int, default=120)
+    parser.add_argument("--no-embeddings", action="store_true", help="Only build the BM25 index.")
+    args = parser.parse_args()
+
+    embedder = None
+    if not args.no_embeddings:
+        from utils.embeddings import get_embedder
+
+        embedder = get_embedder()
+    os.makedirs(args.index, exist_ok=True)
+    start = time.monotonic()
+    stats = build_index(args.docs, args.index, embedder, args.base_url, args.passage_words)
+    logger.info(f"Indexed {args.docs} into {args.index} in {time.monotonic() - start:.1f}s: {stats}")
+
+
+if __name__ == "__main__":
+    main()
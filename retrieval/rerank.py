@@ -0,0 +1,121 @@
+import re
+from typing import Callable, List
+
+import numpy as np
+from loguru import logger
+
+from utils.embeddings import Embedder
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A rough token count, about four characters per token for English text.
+    """
+    return len(text) // 4 + 1
+
+
+def split_passages(text: str, max_words: int = 80) -> List[str]:
+    """
+    Splits text into passages of whole sentences of at most max_words words.
+    A single sentence longer than that becomes its own passage.
+    """
+    passages = []
+    current = []
+    length = 0
+    for sentence in _SENTENCE_END.split(text.replace("\n", " ")):
+        words = len(sentence.split())
+        if not words:
+            continue
+        if current and length + words > max_words:
+            passages.append(" ".join(current))
+            current, length = [], 0
+        current.append(sentence.strip())
+        length += words
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+class PassageReranker:
+    """
+    Reranks the contexts of a query at the passage level and packs the best
+    passages into a token budget.
+
+    Every context (its fetched page text, or else its snippet) is split into
+    passages, which are embedded in batches together with the query and scored
+    by cosine similarity. Passages are then taken greedily by score, skipping
+    near-duplicates of passages already taken and passages that do not fit in
+    the remaining budget.
+
+    The result keeps only the contexts with at least one selected passage,
+    best first, with their passages as "content". Citations are numbered by
+    position in this list, both in the prompt and in the sources sent to the
+    client, so the numbering stays consistent.
+
+    Args:
+    embedder (Embedder): The embedding model.
+    token_budget (int): The maximum number of tokens of packed passages.
+    passage_words (int): The maximum number of words per passage.
+    dedup_threshold (float): Passages at least this similar to a selected one are dropped.
+    count_tokens (callable): Counts the tokens of a passage.
+    """
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        token_budget: int = 1500,
+        passage_words: int = 80,
+        dedup_threshold: float = 0.92,
+        count_tokens: Callable[[str], int] = estimate_tokens,
+    ):
+        self.embedder = embedder
+        self.token_budget = token_budget
+        self.passage_words = passage_words
+        self.dedup_threshold = dedup_threshold
+        self.count_tokens = count_tokens
+
+    def rerank(self, query: str, contexts: List[dict]) -> List[dict]:
+        owners = []
+        passages = []
+        for i, context in enumerate(contexts):
+            text = context.get("content") or context.get("snippet") or ""
+            for passage in split_passages(text, self.passage_words):
+                owners.append(i)
+                passages.append(passage)
+        if not passages:
+            return contexts
+
+        embeddings = self.embedder.embed([query] + passages)
+        query_embedding, passage_embeddings = embeddings[0], embeddings[1:]
+        scores = passage_embeddings @ query_embedding
+
+        selected = []
+        used_tokens = 0
+        for index in np.argsort(-scores):
+            if selected:
+                similarity = passage_embeddings[selected] @ passage_embeddings[index]
+                if similarity.max() >= self.dedup_threshold:
+                    continue
+            tokens = self.count_tokens(passages[index])
+            if used_tokens + tokens > self.token_budget:
+                continue
+            selected.append(index)
+            used_tokens += tokens
+
+        # Group the selected passages by context, in their original order,
+        # and order the contexts by their best passage.
+        by_context = {}
+        for index in selected:
+            by_context.setdefault(owners[index], []).append(index)
+        reranked = []
+        for i in sorted(by_context, key=lambda i: -scores[by_context[i]].max()):
+            context = dict(contexts[i])
+            context["content"] = " ... ".join(passages[j] for j in sorted(by_context[i]))
+            reranked.append(context)
+        logger.info(
+            f"Packed {len(selected)} of {len(passages)} passages from"
+            f" {len(reranked)} of {len(contexts)} contexts into {used_tokens} tokens"
+        )
+        return reranked
@@ -1,14 +1,18 @@
+import asyncio
 import json
-import requests
+import os
+import httpx
 from fastapi import HTTPException
 from loguru import logger
 from typing import List
 
+from utils.http_pool import get_http_client, warm_up, warm_up_async
+
 # Search engine related. You don't really need to change this.
 BING_SEARCH_V7_ENDPOINT = "https://api.bing.microsoft.com/v7.0/search"
 BING_MKT = "en-US"
 GOOGLE_SEARCH_ENDPOINT = "https://customsearch.googleapis.com/customsearch/v1"
-SERPER_SEARCH_ENDPOINT = "https://google.serper.dev/search"
+SERPER_SEARCH_ENDPOINT = os.getenv("SERPER_SEARCH_ENDPOINT", "https://google.serper.dev/search")
 # Specify the number of references from the search engine you want to use.
 # 8 is usually a good number.
 REFERENCE_COUNT = 8
@@ -17,6 +21,81 @@ REFERENCE_COUNT = 8
 # does not respond within this time, we will return an error.
 DEFAULT_SEARCH_ENGINE_TIMEOUT = 100
 
+SEARCH_ENDPOINTS = {
+    "BING": BING_SEARCH_V7_ENDPOINT,
+    "GOOGLE": GOOGLE_SEARCH_ENDPOINT,
+    "SERPER": SERPER_SEARCH_ENDPOINT,
+}
+
+
+def search_client(backend: str, use_async: bool = False):
+    """
+    Returns the pooled keep-alive http client of a search backend.
+    """
+    return get_http_client(
+        f"search:{backend}", use_async=use_async, timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT
+    )
+
+
+def warm_up_search(backend: str) -> None:
+    """
+    Opens a connection to the endpoint of a remote search backend, if it has one.
+    """
+    if backend in SEARCH_ENDPOINTS:
+        warm_up(search_client(backend), SEARCH_ENDPOINTS[backend])
+
+
+async def warm_up_search_async(backend: str) -> None:
+    """
+    Async version of warm_up_search, for the async client.
+    """
+    if backend in SEARCH_ENDPOINTS:
+        await warm_up_async(search_client(backend, use_async=True), SEARCH_ENDPOINTS[backend])
+
+
+def _bing_contexts(json_content: dict) -> List[dict]:
+    try:
+        contexts = json_content["webPages"]["value"][:REFERENCE_COUNT]
+    except KeyError:
+        logger.error(f"Error parsing bing response: {json_content}")
+        return []
+    return contexts
+
+
+def _google_contexts(json_content: dict) -> List[dict]:
+    try:
+        contexts = json_content["items"][:REFERENCE_COUNT]
+    except KeyError:
+        logger.error(f"Error parsing google response: {json_content}")
+        return []
+    return contexts
+
+
+def _serper_payload(query: str) -> str:
+    return json.dumps({
+        "q": query,
+        "num": (
+            REFERENCE_COUNT
+            if REFERENCE_COUNT % 10 == 0
+            else (REFERENCE_COUNT // 10 + 1) * 10
+        ),
+    })
+
+
+def _serper_contexts(json_content: dict) -> List[dict]:
+    try:
+        
+        # convert to the same format as bing/google
+        contexts = [
+            {"name": c["title"], "url": c["link"], "snippet": c["snippet"]}
+            for c in json_content["organic"][:REFERENCE_COUNT]
+        ]
+    except KeyError:
+        logger.error(f"Error parsing serper response: {json_content}")
+        return []
+    return contexts
+
+
 def search_with_bing(query: str, subscription_key: str) -> List[dict]:
     """
     Search with bing and return the contexts.
@@ -30,23 +109,16 @@ def search_with_bing(query: str, subscription_key: str) -> List[dict]:
     """
     params = {"q": query, "mkt": BING_MKT}
     try:
-        response = requests.get(
+        response = search_client("BING").get(
             BING_SEARCH_V7_ENDPOINT,
             headers={"Ocp-Apim-Subscription-Key": subscription_key},
             params=params,
-            timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
         )
         response.raise_for_status()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error searching with bing: {e}")
         raise HTTPException(500, "Error searching with bing")
-    json_content = response.json()
-    try:
-        contexts = json_content["webPages"]["value"][:REFERENCE_COUNT]
-    except KeyError:
-        logger.error(f"Error parsing bing response: {json_content}")
-        return []
-    return contexts
+    return _bing_contexts(response.json())
 
 
 def search_with_google(query: str, subscription_key: str, cx: str) -> List[dict]:
@@ -68,20 +140,12 @@ def search_with_google(query: str, subscription_key: str, cx: str) -> List[dict]
         "num": REFERENCE_COUNT,
     }
     try:
-        response = requests.get(
-            GOOGLE_SEARCH_ENDPOINT, params=params, timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT
-        )
+        response = search_client("GOOGLE").get(GOOGLE_SEARCH_ENDPOINT, params=params)
         response.raise_for_status()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error searching with google: {e}")
         raise HTTPException(500, "Error searching with google")
-    json_content = response.json()
-    try:
-        contexts = json_content["items"][:REFERENCE_COUNT]
-    except KeyError:
-        logger.error(f"Error parsing google response: {json_content}")
-        return []
-    return contexts
+    return _google_contexts(response.json())
 
 
 def search_with_serper(query: str, subscription_key: str) -> List[dict]:
@@ -95,41 +159,82 @@ def search_with_serper(query: str, subscription_key: str) -> List[dict]:
     Returns:
     List[dict]: A list of search results.
     """
-    payload = json.dumps({
-        "q": query,
-        "num": (
-            REFERENCE_COUNT
-            if REFERENCE_COUNT % 10 == 0
-            else (REFERENCE_COUNT // 10 + 1) * 10
-        ),
-    })
+    payload = _serper_payload(query)
     headers = {"X-API-KEY": subscription_key, "Content-Type": "application/json"}
     try:
         logger.info(
             f"{payload} {headers} {subscription_key} {query} {SERPER_SEARCH_ENDPOINT}"
         )
-        response = requests.post(
+        response = search_client("SERPER").post(
             SERPER_SEARCH_ENDPOINT,
             headers=headers,
-            data=payload,
-            timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
+            content=payload,
         )
         response.raise_for_status()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error searching with serper: {e}")
         raise HTTPException(500, "Error searching with serper")
-    json_content = response.json()
+    return _serper_contexts(response.json())
+
+
+async def async_search_with_bing(query: str, subscription_key: str) -> List[dict]:
+    """
+    Async version of search_with_bing, on the pooled async http client.
+    """
     try:
-        
-        # convert to the same format as bing/google
-        contexts = [
-            {"name": c["title"], "url": c["link"], "snippet": c["snippet"]}
-            for c in json_content["organic"][:REFERENCE_COUNT]
-        ]
-    except KeyError:
-        logger.error(f"Error parsing serper response: {json_content}")
-        return []
-    return contexts
+        response = await search_client("BING", use_async=True).get(
+            BING_SEARCH_V7_ENDPOINT,
+            headers={"Ocp-Apim-Subscription-Key": subscription_key},
+            params={"q": query, "mkt": BING_MKT},
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.error(f"Error searching with bing: {e}")
+        raise HTTPException(500, "Error searching with bing")
+    return _bing_contexts(response.json())
+
+
+async def async_search_with_google(query: str, subscription_key: str, cx: str) -> List[dict]:
+    """
+    Async version of search_with_google, on the pooled async http client.
+    """
+    params = {
+        "key": subscription_key,
+        "cx": cx,
+        "q": query,
+        "num": REFERENCE_COUNT,
+    }
+    try:
+        response = await search_client("GOOGLE", use_async=True).get(GOOGLE_SEARCH_ENDPOINT, params=params)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.error(f"Error searching with google: {e}")
+        raise HTTPException(500, "Error searching with google")
+    return _google_contexts(response.json())
+
+
+async def async_search_with_serper(query: str, subscription_key: str) -> List[dict]:
+    """
+    Async version of search_with_serper, on the pooled async http client.
+    """
+    headers = {"X-API-KEY": subscription_key, "Content-Type": "application/json"}
+    try:
+        response = await search_client("SERPER", use_async=True).post(
+            SERPER_SEARCH_ENDPOINT,
+            headers=headers,
+            content=_serper_payload(query),
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.error(f"Error searching with serper: {e}")
+        raise HTTPException(500, "Error searching with serper")
+    return _serper_contexts(response.json())
+
+
+async def async_search_with_duckduckgo(query):
+    # duckduckgo_search has no native async transport worth using, so the
+    # blocking client runs in a worker thread.
+    return await asyncio.to_thread(search_with_duckduckgo, query)
 
 def convert_ddg_to_google_format(ddg_results):
     google_format_results = []
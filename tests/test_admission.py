@@ -0,0 +1,42 @@
+import asyncio
+
+from utils.admission import ConcurrencyLimit
+
+
+def test_hold_releases_and_closes_the_stream():
+    limit = ConcurrencyLimit("test")
+    closed = []
+
+    def chunks():
+        try:
+            yield from range(10)
+        finally:
+            closed.append(True)
+
+    held = limit.acquire().hold(chunks())
+    assert next(held) == 0
+    assert limit.active == 1
+    held.close()
+    assert closed and limit.active == 0
+
+
+def test_hold_async_releases_and_closes_the_stream():
+    limit = ConcurrencyLimit("test")
+    closed = []
+
+    async def chunks():
+        try:
+            for i in range(10):
+                yield i
+        finally:
+            closed.append(True)
+
+    async def run():
+        held = limit.acquire().hold_async(chunks())
+        assert await held.__anext__() == 0
+        assert limit.active == 1
+        await held.aclose()
+        # Before the event loop closes the abandoned generator itself.
+        assert closed and limit.active == 0
+
+    asyncio.run(run())
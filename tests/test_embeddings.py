@@ -0,0 +1,44 @@
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+
+from utils import embeddings
+from utils.embeddings import Embedder, get_embedder
+
+
+class SlowModel:
+    """
+    Counts the forward passes running at once.
+    """
+
+    def __init__(self):
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def encode(self, texts, **kwargs):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        return np.zeros((len(texts), 4))
+
+
+def test_get_embedder_is_shared(monkeypatch):
+    monkeypatch.setenv("EMBEDDING_MODEL", "test/shared-model")
+    assert get_embedder() is get_embedder()
+    monkeypatch.setenv("EMBEDDING_BATCH_SIZE", "8")
+    assert get_embedder().batch_size == 8
+
+
+def test_one_forward_pass_per_model(monkeypatch):
+    model = SlowModel()
+    monkeypatch.setitem(embeddings._models, "test/slow-model", model)
+    embedders = [Embedder("test/slow-model", batch_size=batch_size) for batch_size in (8, 16, 32)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        list(executor.map(lambda embedder: embedder.embed(["text"]), embedders))
+    assert model.most_running == 1
@@ -0,0 +1,100 @@
+import concurrent.futures
+import itertools
+import time
+
+from retrieval.federated import FederatedSearch, reciprocal_rank_fusion
+
+
+def backend(name, count=4, delay=0.0):
+    """
+    A stub search backend returning count results of its own.
+    """
+    def search(query):
+        time.sleep(delay)
+        return [
+            {"name": f"{name} {i}", "url": f"https://{name}.example.com/{i}", "snippet": query}
+            for i in range(count)
+        ]
+
+    return search
+
+
+def test_nested_in_a_busy_shared_executor():
+    # Every worker of the shared executor runs a search that waits for its
+    # fan-out, as cache refreshes and pre-warmed searches do.
+    federated = FederatedSearch({"a": backend("a"), "b": backend("b")}, deadline=2.0)
+    shared = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    start = time.monotonic()
+    futures = [shared.submit(federated, "query") for _ in range(2)]
+    results = [f.result() for f in futures]
+    shared.shutdown()
+    assert time.monotonic() - start < 1.0
+    assert all(len(r) == 8 for r in results)
+
+
+def test_dedup_by_normalized_url():
+    def variants(query):
+        return [
+            {"name": "Page", "url": "https://www.example.com/page/", "snippet": "first"},
+            {"name": "Other", "url": "https://example.com/other", "snippet": ""},
+        ]
+
+    def google(query):
+        # Google items use title/link.
+        return [
+            {"title": "Page", "link": "http://example.com/page?utm_source=x#top", "snippet": "second"},
+            {"title": "Other", "link": "https://EXAMPLE.com/other?id=1", "snippet": ""},
+        ]
+
+    results = FederatedSearch({"a": variants, "b": google}, reference_count=8)("query")
+    assert [r["url"] for r in results] == [
+        "https://www.example.com/page/",
+        "https://example.com/other",
+        "https://EXAMPLE.com/other?id=1",
+    ]
+    # The first snippet seen is kept.
+    assert results[0]["snippet"] == "first"
+
+
+def test_rrf_ranks_results_found_by_several_backends_first():
+    merged = reciprocal_rank_fusion({
+        "a": [{"url": "https://a.com"}, {"url": "https://both.com"}, {"url": "https://c.com"}],
+        "b": [{"url": "https://b.com"}, {"url": "https://both.com/"}],
+    })
+    assert [r["url"] for r in merged] == [
+        "https://both.com",
+        "https://a.com",
+        "https://b.com",
+        "https://c.com",
+    ]
+
+
+def test_hedge_past_the_latency_percentile():
+    calls = itertools.count()
+
+    def slow_once(query):
+        # The first request stalls, the hedged one answers at once.
+        if next(calls) == 0:
+            time.sleep(2.0)
+        return backend("a")(query)
+
+    federated = FederatedSearch({"a": slow_once}, hedge_after=5.0)
+    for _ in range(20):
+        federated.latencies.record("a", 0.05)
+    start = time.monotonic()
+    results = federated("query")
+    assert time.monotonic() - start < 1.0
+    assert federated.hedges == 1
+    assert len(results) == 4
+
+
+def test_returns_once_reference_count_results_are_in():
+    federated = FederatedSearch(
+        {"fast": backend("fast", count=4), "slow": backend("slow", delay=2.0)},
+        reference_count=4,
+    )
+    start = time.monotonic()
+    results = federated("query")
+    assert time.monotonic() - start < 1.0
+    assert [r["name"] for r in results] == ["fast 0", "fast 1", "fast 2", "fast 3"]
+    assert federated.hedges == 0
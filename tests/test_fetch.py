@@ -0,0 +1,120 @@
+import concurrent.futures
+import os
+import time
+
+import pytest
+
+from benchmark.fake_backends import FakeBackendConfig, _page, start_fake_backend
+from retrieval.fetch import MainTextExtractor, PageCache, PageFetcher, extract_main_text
+
+
+@pytest.fixture
+def fake():
+    config = FakeBackendConfig(page_latency=0.0)
+    server = start_fake_backend(config)
+    server.config = config
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_extractor_drops_boilerplate():
+    extractor = MainTextExtractor()
+    extractor.feed(_page("7", 0).decode())
+    extractor.close()
+    text = extractor.text()
+    assert "Page 7 paragraph 0" in text
+    assert "tracking" not in text
+    assert "Products" not in text
+    assert "Copyright" not in text
+
+
+def test_extractor_drops_short_blocks():
+    text = extract_main_text("<div>Read more</div><p>" + "word " * 10 + "</p>")
+    assert text == ("word " * 10).strip()
+
+
+def test_missed_deadline_keeps_snippet(fake):
+    fake.config.page_latency = 1.0
+    fetcher = PageFetcher(deadline=0.2, cache_dir=None)
+    contexts = [{"url": f"{fake.url}/page/{i}", "snippet": "s"} for i in range(2)]
+    start = time.monotonic()
+    fetcher.fetch_contexts(contexts)
+    assert time.monotonic() - start < 0.8
+    assert all("content" not in c for c in contexts)
+
+
+def test_fetch_adds_content(fake):
+    fetcher = PageFetcher(top_n=2, cache_dir=None)
+    contexts = [{"url": f"{fake.url}/page/{i}", "snippet": "s"} for i in range(3)]
+    fetcher.fetch_contexts(contexts)
+    assert contexts[0]["content"].startswith("Page 0 paragraph 0")
+    assert contexts[1]["content"].startswith("Page 1 paragraph 0")
+    assert "content" not in contexts[2]
+
+
+def test_max_bytes_truncates(fake):
+    fake.config.page_bytes = 200000
+    fetcher = PageFetcher(max_bytes=2000, max_chars=10 ** 6, cache_dir=None)
+    text = fetcher.fetch(f"{fake.url}/page/1", time.monotonic() + 5)
+    assert "Page 1 paragraph 0" in text
+    assert len(text) < 2000
+    full = PageFetcher(max_bytes=10 ** 6, max_chars=10 ** 6, cache_dir=None)
+    assert len(full.fetch(f"{fake.url}/page/1", time.monotonic() + 5)) > 100000
+
+
+def test_not_modified_reuses_cached_text(fake, tmp_path):
+    url = f"{fake.url}/page/3"
+    fetcher = PageFetcher(cache_dir=str(tmp_path), cache_ttl=0)
+    text = fetcher.fetch(url, time.monotonic() + 5)
+    assert "Page 3 paragraph 0" in text
+
+    # A revalidation answered with a 304 returns the cached text, not a new
+    # download.
+    entry = fetcher.cache.get(url)
+    entry["text"] = "cached text"
+    fetcher.cache.set(url, entry)
+    assert fetcher.fetch(url, time.monotonic() + 5) == "cached text"
+    assert fake.requests["page"] == 2
+
+    # Without an ETag there is nothing to revalidate with.
+    fake.config.page_etag = False
+    fetcher.cache.set(url, {**entry, "etag": None})
+    assert "Page 3 paragraph 0" in fetcher.fetch(url, time.monotonic() + 5)
+
+
+def test_fresh_cache_skips_the_request(fake, tmp_path):
+    url = f"{fake.url}/page/4"
+    fetcher = PageFetcher(cache_dir=str(tmp_path))
+    first = fetcher.fetch(url, time.monotonic() + 5)
+    assert fetcher.fetch(url, time.monotonic() + 5) == first
+    assert fake.requests["page"] == 1
+
+
+def test_nested_in_a_busy_shared_executor(fake):
+    # The fetch stage runs in a job of a shared executor whose workers are
+    # all busy with the same.
+    fetcher = PageFetcher(deadline=2.0, cache_dir=None)
+    shared = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+    def fetch_stage():
+        contexts = [{"url": f"{fake.url}/page/{i}", "snippet": "s"} for i in range(2)]
+        return fetcher.fetch_contexts(contexts)
+
+    start = time.monotonic()
+    results = [f.result() for f in [shared.submit(fetch_stage) for _ in range(2)]]
+    shared.shutdown()
+    assert time.monotonic() - start < 1.0
+    assert all("content" in c for contexts in results for c in contexts)
+
+
+def test_cache_purges_old_and_excess_pages(tmp_path):
+    cache = PageCache(str(tmp_path), max_entries=3, max_age=60)
+    now = time.time()
+    for i in range(5):
+        cache.set(f"https://example.com/{i}", {"text": str(i)})
+        # Page 0 is past max_age, the others were written one second apart.
+        os.utime(cache._path(f"https://example.com/{i}"), (now, now - 120 if i == 0 else now - 10 + i))
+    cache.purge()
+    assert [i for i in range(5) if cache.get(f"https://example.com/{i}")] == [2, 3, 4]
@@ -0,0 +1,40 @@
+import time
+
+from rag.prewarm import Prewarmer, _Bucket
+
+
+def test_bucket_paces_and_never_refills_without_rate():
+    bucket = _Bucket(10.0, 1.0)
+    assert bucket.wait() == 0.0
+    bucket.take(1)
+    assert 0 < bucket.wait() <= 0.1
+
+    empty = _Bucket(0.0, 0.0)
+    assert empty.wait() == float("inf")
+    assert not empty.available()
+
+
+def test_prewarms_searches_and_answers():
+    searched = []
+
+    def search(query):
+        searched.append(query)
+        return [{"snippet": query}]
+
+    prewarmer = Prewarmer(
+        search, lambda query, contexts: (f"answer to {query}", 10), lambda: 0, qps=100
+    )
+    prewarmer.submit([{"question": "first?"}, {"question": "second?"}, {"question": "third?"}])
+    prewarmer.executor.shutdown(wait=True)
+    assert sorted(searched) == ["first?", "second?"]
+    assert prewarmer.claim("First?") == "answer to first?"
+    assert prewarmer.claim("third?") is None
+
+
+def test_waits_for_foreground_load():
+    prewarmer = Prewarmer(lambda query: [], None, lambda: 10, qps=100, max_pause=0.2)
+    start = time.monotonic()
+    prewarmer.submit([{"question": "first?"}])
+    prewarmer.executor.shutdown(wait=True)
+    assert time.monotonic() - start >= 0.2
+    assert prewarmer.claim("first?") is None
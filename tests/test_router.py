@@ -0,0 +1,156 @@
+import asyncio
+import time
+
+import pytest
+
+from llm.router import LLMRouter, NoProviderAvailable, Provider
+
+
+class FakeStream:
+    def __init__(self, chunks, delay=0.0):
+        self.chunks = chunks
+        self.delay = delay
+        self.closed = False
+
+    def __iter__(self):
+        time.sleep(self.delay)
+        yield from self.chunks
+
+    async def _aiter(self):
+        await asyncio.sleep(self.delay)
+        for chunk in self.chunks:
+            yield chunk
+
+    def __aiter__(self):
+        return self._aiter()
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    """
+    Stands in for an openai client: answers with its name, fails with
+    error, and streams chunks after delay.
+    """
+
+    def __init__(self, name, error=None, delay=0.0):
+        self.name = name
+        self.error = error
+        self.delay = delay
+        self.calls = 0
+        self.chat = self
+        self.completions = self
+
+    def create(self, model, stream=False, **request):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        if stream:
+            return FakeStream([f"{self.name}-1", f"{self.name}-2"], self.delay)
+        return self.name
+
+
+class FakeAsyncClient(FakeClient):
+    async def create(self, model, stream=False, **request):
+        return FakeClient.create(self, model, stream, **request)
+
+
+def provider(client, **health):
+    use_async = isinstance(client, FakeAsyncClient)
+    return Provider("OPENAI", "model", lambda use_async=False: client, use_async, **health)
+
+
+def test_ranks_by_score_keeping_configured_order_for_ties():
+    slow, fast = FakeClient("slow"), FakeClient("fast")
+    router = LLMRouter("test", [provider(slow), provider(fast)])
+    assert router.create(lambda p: {})[1] == "slow"
+
+    for _ in range(5):
+        router.providers[0].record_success(2.0)
+        router.providers[1].record_success(0.5)
+    assert router.create(lambda p: {})[1] == "fast"
+
+
+def test_create_records_latency():
+    router = LLMRouter("test", [provider(FakeClient("a"))])
+    for _ in range(5):
+        router.create(lambda p: {})
+    assert 0 < router.providers[0].score() < 0.1
+
+
+def test_circuit_opens_half_opens_and_closes():
+    failing = FakeClient("failing", error=RuntimeError("down"))
+    backup = FakeClient("backup")
+    router = LLMRouter("test", [provider(failing, failure_threshold=2, cooldown=0.1), provider(backup)])
+    flaky = router.providers[0]
+
+    # Failures fail over to the next provider, until the circuit opens.
+    assert router.create(lambda p: {})[1] == "backup"
+    assert router.create(lambda p: {})[1] == "backup"
+    assert flaky.circuit_open()
+    router.create(lambda p: {})
+    assert failing.calls == 2
+
+    # After the cooldown, a single trial request is let through.
+    time.sleep(0.15)
+    assert flaky.available()
+    assert not flaky.available()
+    flaky.release()
+
+    # A failed trial opens the circuit again, a successful one closes it.
+    router.create(lambda p: {})
+    assert failing.calls == 3 and flaky.circuit_open()
+    time.sleep(0.15)
+    failing.error = None
+    assert router.create(lambda p: {})[1] == "failing"
+    assert not flaky.circuit_open()
+
+
+def test_failed_request_build_gives_back_the_trial():
+    failing = FakeClient("failing", error=RuntimeError("down"))
+    router = LLMRouter("test", [provider(failing, failure_threshold=1, cooldown=0.0)])
+    with pytest.raises(NoProviderAvailable):
+        router.create(lambda p: {})
+
+    def build_request(p):
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        router.stream(build_request)
+    assert router.providers[0].available()
+
+
+def test_stream_fails_over_before_the_first_token():
+    stalled = FakeClient("stalled", delay=1.0)
+    broken = FakeClient("broken", error=RuntimeError("down"))
+    router = LLMRouter(
+        "test", [provider(stalled), provider(broken), provider(FakeClient("ok"))], first_token_deadline=0.2
+    )
+    start = time.perf_counter()
+    chosen, stream = router.stream(lambda p: {})
+    assert time.perf_counter() - start < 0.8
+    assert list(stream) == ["ok-1", "ok-2"]
+    assert chosen is router.providers[2]
+    assert stalled.calls == 1 and broken.calls == 1
+
+
+def test_stream_async_fails_over_before_the_first_token():
+    stalled = FakeAsyncClient("stalled", delay=1.0)
+    router = LLMRouter(
+        "test", [provider(stalled), provider(FakeAsyncClient("ok"))], first_token_deadline=0.2
+    )
+
+    async def run():
+        chosen, stream = await router.stream_async(lambda p: {})
+        return chosen, [chunk async for chunk in stream]
+
+    chosen, chunks = asyncio.run(run())
+    assert chosen is router.providers[1]
+    assert chunks == ["ok-1", "ok-2"]
+
+
+def test_no_provider_available():
+    router = LLMRouter("test", [provider(FakeClient("a", error=RuntimeError("down")))])
+    with pytest.raises(NoProviderAvailable):
+        router.create(lambda p: {})
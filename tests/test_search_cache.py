@@ -0,0 +1,74 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from cache.search_cache import SearchCache
+
+
+@pytest.fixture
+def executor():
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+def test_hits_misses_and_coalescing(executor):
+    cache = SearchCache(executor)
+    calls = []
+    release = threading.Event()
+
+    def search(query):
+        calls.append(query)
+        release.wait(5)
+        return [{"snippet": query}]
+
+    futures = [executor.submit(cache.search, "SERPER", "Who  said it", search) for _ in range(4)]
+    time.sleep(0.2)
+    release.set()
+    assert all(f.result() == [{"snippet": "Who  said it"}] for f in futures)
+    assert calls == ["Who  said it"]
+    assert cache.search("SERPER", "who said it", search) == [{"snippet": "Who  said it"}]
+    assert (cache.hits, cache.misses, cache.coalesced) == (1, 4, 3)
+
+
+def test_counters_are_exact_across_threads(executor):
+    cache = SearchCache(executor)
+    cache.search("SERPER", "query", lambda query: [{"snippet": query}])
+    for f in [executor.submit(cache.search, "SERPER", "query", None) for _ in range(2000)]:
+        f.result()
+    assert cache.hits == 2000
+
+
+def test_async_search_shares_the_sqlite_cache(executor, tmp_path):
+    path = str(tmp_path / "shared.db")
+    calls = []
+
+    async def search(query):
+        calls.append(query)
+        await asyncio.sleep(0.2)
+        return [{"snippet": query}]
+
+    async def run():
+        cache = SearchCache(executor, shared_path=path)
+        first = await asyncio.gather(*(cache.search_async("SERPER", "query", search) for _ in range(3)))
+        return cache, first
+
+    cache, first = asyncio.run(run())
+    assert first == [[{"snippet": "query"}]] * 3
+    assert calls == ["query"]
+    assert (cache.misses, cache.coalesced) == (3, 2)
+
+    # Another worker's cache finds the entry in the same database.
+    other = SearchCache(executor, shared_path=path)
+    assert other.search("SERPER", "Query", None) == [{"snippet": "query"}]
+    assert other.hits == 1
+
+
+def test_empty_results_are_not_cached(executor):
+    cache = SearchCache(executor)
+    cache.search("SERPER", "query", lambda query: [])
+    assert cache.search("SERPER", "query", lambda query: [{"snippet": query}]) == [{"snippet": "query"}]
+    assert cache.misses == 2
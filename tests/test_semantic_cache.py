@@ -0,0 +1,86 @@
+import hashlib
+import os
+
+import numpy as np
+
+from cache.semantic_cache import SemanticCache
+
+
+class HashEmbedder:
+    """
+    Gives every distinct text its own random unit vector, so that only a
+    query asked again is similar enough to hit.
+    """
+
+    def __init__(self, dimension=16):
+        self.dimension = dimension
+
+    def embed(self, texts):
+        rows = []
+        for text in texts:
+            seed = int(hashlib.sha1(text.encode()).hexdigest()[:8], 16)
+            row = np.random.default_rng(seed).standard_normal(self.dimension)
+            rows.append(row / np.linalg.norm(row))
+        return np.array(rows, dtype="float32")
+
+
+def entries(path):
+    with open(os.path.join(path, "entries.jsonl")) as f:
+        return f.read().splitlines()
+
+
+def test_hit_and_miss():
+    cache = SemanticCache(HashEmbedder())
+    assert cache.lookup("who said it") is None
+    cache.add("who said it", "answer")
+    assert cache.lookup("who said it") == "answer"
+    assert cache.lookup("something else") is None
+
+
+def test_reopen_keeps_entries(tmp_path):
+    path = str(tmp_path)
+    cache = SemanticCache(HashEmbedder(), max_entries=4, path=path)
+    for i in range(6):
+        cache.add(f"query {i}", f"answer {i}")
+    del cache
+
+    cache = SemanticCache(HashEmbedder(), max_entries=4, path=path)
+    assert cache.lookup("query 0") is None
+    assert cache.lookup("query 5") == "answer 5"
+    assert cache.lookup("query 2") == "answer 2"
+    # The entries file is compacted to the live entries.
+    assert len(entries(path)) == 4
+
+
+def test_reopen_with_another_capacity_starts_empty(tmp_path):
+    path = str(tmp_path)
+    cache = SemanticCache(HashEmbedder(), max_entries=4, path=path)
+    for i in range(3):
+        cache.add(f"query {i}", f"answer {i}")
+    del cache
+
+    cache = SemanticCache(HashEmbedder(), max_entries=8, path=path)
+    assert cache.lookup("query 1") is None
+    assert entries(path) == []
+    cache.add("query 9", "answer 9")
+    del cache
+
+    # The old entries do not come back in the slots of the new index.
+    cache = SemanticCache(HashEmbedder(), max_entries=8, path=path)
+    assert cache.lookup("query 9") == "answer 9"
+    assert cache.lookup("query 1") is None
+    assert len(entries(path)) == 1
+
+
+def test_reopen_with_another_dimension_starts_empty(tmp_path):
+    path = str(tmp_path)
+    cache = SemanticCache(HashEmbedder(16), max_entries=4, path=path)
+    cache.add("query 1", "answer 1")
+    del cache
+
+    cache = SemanticCache(HashEmbedder(32), max_entries=4, path=path)
+    assert cache.lookup("query 1") is None
+    cache.add("query 2", "answer 2")
+    assert cache.lookup("query 2") == "answer 2"
+    assert cache.lookup("query 1") is None
+    assert len(entries(path)) == 1
@@ -0,0 +1,188 @@
+import json
+import threading
+import time
+
+import pytest
+
+from rag.streaming import (
+    FLUSH,
+    RELATED_MARKER,
+    ChunkCoalescer,
+    InlineRelatedQuestions,
+    StopSequenceGuard,
+)
+from utils.json_stream import JSONObjectStream
+
+
+def feed_words(guard, text, size=3):
+    """
+    Feeds text a few characters at a time, like a stream of tokens.
+    """
+    sent = "".join(guard.feed(text[i:i + size]) for i in range(0, len(text), size))
+    return sent + guard.finish()
+
+
+def test_stop_sequence_across_chunks():
+    guard = StopSequenceGuard(["\nReferences:\n"])
+    sent = feed_words(guard, "The answer [citation:1].\nReferences:\n1. example.com")
+    assert sent == "The answer [citation:1]."
+    assert guard.stopped == "stop_sequence"
+
+
+def test_real_loop_is_cut():
+    guard = StopSequenceGuard([])
+    sentence = "I am sorry, but I cannot find more information about this topic. "
+    sent = feed_words(guard, "Here is what I found. " + sentence * 30)
+    assert guard.stopped == "repetition"
+    assert sent.count(sentence) < 12
+
+
+def test_repeated_word_is_cut():
+    guard = StopSequenceGuard([])
+    feed_words(guard, "the " * 200)
+    assert guard.stopped == "repetition"
+
+
+def test_repetitive_prose_is_kept():
+    guard = StopSequenceGuard([])
+    text = "".join(f"Step {i}: add one to the counter and check it. " for i in range(40))
+    assert feed_words(guard, text) == text
+    assert guard.stopped is None
+
+
+def test_repetitive_code_is_kept():
+    guard = StopSequenceGuard([])
+    text = "Unrolled:\n```python\n" + "x = x + 1\n" * 100 + "```\nThat adds one hundred."
+    assert feed_words(guard, text) == text
+    assert guard.stopped is None
+
+
+def test_loop_after_code_is_cut():
+    guard = StopSequenceGuard([])
+    feed_words(guard, "```\n" + "x = x + 1\n" * 12 + "```\n" + "and so on and so forth " * 40)
+    assert guard.stopped == "repetition"
+
+
+def test_table_is_kept():
+    guard = StopSequenceGuard([])
+    rows = "".join(f"| {i} | yes | no | n/a |\n" for i in range(30))
+    text = "| n | a | b | c |\n| --- | --- | --- | --- |\n" + rows
+    assert feed_words(guard, text) == text
+    assert guard.stopped is None
+
+
+def timed_chunks(coalescer, pieces):
+    """
+    Returns each chunk the coalescer sends with the time it was sent.
+    """
+    start = time.monotonic()
+    return [(chunk, time.monotonic() - start) for chunk in coalescer.coalesce(pieces)]
+
+
+def test_coalescer_flushes_while_upstream_pauses():
+    def pieces():
+        yield from ["sources", "first", " second", " last answer piece"]
+        time.sleep(1.0)
+        yield " after the pause"
+
+    chunks = timed_chunks(ChunkCoalescer(max_delay=0.05), pieces())
+    assert [chunk for chunk, _ in chunks[:2]] == ["sources", "first"]
+    assert chunks[2][0] == " second last answer piece"
+    assert chunks[2][1] < 0.5
+    assert chunks[3][0] == " after the pause"
+
+
+def test_coalescer_flushes_the_answer_before_a_blocking_wait():
+    def pieces():
+        yield from ["sources", "first", " the end of the answer."]
+        # The end of the answer is sent before the related questions are
+        # awaited, however long max_delay is.
+        yield FLUSH
+        time.sleep(1.0)
+        yield "related"
+
+    chunks = timed_chunks(ChunkCoalescer(max_delay=30), pieces())
+    assert [chunk for chunk, _ in chunks] == ["sources", "first", " the end of the answer.", "related"]
+    assert chunks[2][1] < 0.5
+
+
+def test_coalescer_batches_and_sends_everything_before_an_error():
+    def pieces():
+        yield from ["a", "b", "c", "d"]
+        raise RuntimeError("upstream failed")
+
+    coalescer = ChunkCoalescer(max_delay=30)
+    sent = []
+    with pytest.raises(RuntimeError):
+        for chunk in coalescer.coalesce(pieces()):
+            sent.append(chunk)
+    assert sent == ["a", "b", "cd"]
+
+
+def test_closing_the_coalescer_closes_the_pieces():
+    closed = threading.Event()
+
+    def pieces():
+        try:
+            while True:
+                yield "piece"
+                time.sleep(0.01)
+        finally:
+            closed.set()
+
+    chunks = ChunkCoalescer(max_bytes=1).coalesce(pieces())
+    assert next(chunks) == "piece"
+    chunks.close()
+    assert closed.wait(1)
+
+
+def test_json_object_with_braces_and_quotes_in_strings():
+    text = 'Sure: {not json} ```json\n{"a": "x } \\" {", "b": [1, {"c": "]"}]}\n``` done'
+    # One character at a time, so that every split point is crossed.
+    parser = JSONObjectStream()
+    assert not any(parser.feed(char) for char in text[:-10])
+    assert parser.feed(text[-10:]) is True
+    assert parser.value == {"a": 'x } " {', "b": [1, {"c": "]"}]}
+
+
+def test_json_object_too_long_ends_the_search():
+    parser = JSONObjectStream(max_chars=32)
+    assert parser.feed('{"a": "' + "x" * 64) is True
+    assert parser.value is None
+
+
+def feed_inline(related, text, size=3):
+    sent = "".join(related.feed(text[i:i + size]) for i in range(0, len(text), size))
+    return sent + related.finish()
+
+
+def test_inline_marker_split_across_chunks():
+    related = InlineRelatedQuestions()
+    answer = "The answer [citation:1]."
+    text = answer + "\n\n" + RELATED_MARKER + '\n{"questions": [{"question": "Why?"}]}'
+    # The size puts a chunk boundary inside the marker.
+    assert feed_inline(related, text, size=5) == answer
+    assert related.ready()
+    assert related.result() == [{"question": "Why?"}]
+
+
+def test_inline_drops_malformed_and_duplicate_questions():
+    related = InlineRelatedQuestions()
+    section = {"questions": ["One?", {"question": " one? "}, {"question": ""}, 3, {"q": "x"}, {"question": "Two?"}]}
+    feed_inline(related, "Answer.\n" + RELATED_MARKER + json.dumps(section))
+    assert related.result() == [{"question": "One?"}, {"question": "Two?"}]
+
+    related = InlineRelatedQuestions()
+    feed_inline(related, "Answer.\n" + RELATED_MARKER + '{"questions": [{"question": "One?"}')
+    assert not related.ready()
+    assert related.result() is None
+
+
+def test_inline_without_marker_sends_everything():
+    related = InlineRelatedQuestions()
+    # Ends with what looks like the start of the marker, held back until the end.
+    text = "An answer with no questions. " + RELATED_MARKER[:5]
+    assert feed_inline(related, text) == text
+    assert not related.ready()
+    assert related.done_result() is None
+    assert related.result() is None
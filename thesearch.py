@@ -1,8 +1,16 @@
-from dotenv import load_dotenv
-load_dotenv(override=True)
+from utils.config import load_config
+load_config()
+
+import os
 
 from rag.rag import RAG
+from utils.workers import serve_workers
 
 if __name__ == "__main__":
-    rag = RAG()
-    rag.launch(port=8383)
\ No newline at end of file
+    workers = int(os.getenv("WORKERS", 1))
+    if workers > 1:
+        # Each worker builds its own photon after the fork.
+        serve_workers(lambda sock: RAG().serve(sock), "0.0.0.0", 8383, workers)
+    else:
+        rag = RAG()
+        rag.launch(port=8383)
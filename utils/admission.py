@@ -0,0 +1,324 @@
+import asyncio
+import json
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+from limits import parse_many
+from limits.storage import MemoryStorage
+from limits.strategies import MovingWindowRateLimiter
+from loguru import logger
+from prometheus_client import Counter, Gauge
+
+ADMISSION_DECISIONS = Counter(
+    "admission_decisions_total",
+    "Admission decisions for /query, by result.",
+    ["result"],
+)
+ADMISSION_QUEUE = Gauge(
+    "admission_queue_length",
+    "Requests waiting for admission.",
+)
+ADMISSION_ACTIVE = Gauge(
+    "admission_active_requests",
+    "Requests admitted and not finished.",
+)
+
+
+class Rejected(Exception):
+    """
+    A request that is shed, with the status code and Retry-After to send.
+    """
+
+    def __init__(self, status_code: int, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+
+    def headers(self) -> dict:
+        return {"Retry-After": str(self.retry_after)}
+
+    def body(self) -> dict:
+        return {"error": self.reason}
+
+
+class AdmissionController:
+    """
+    Bounds the number of requests in progress. Up to max_concurrency requests
+    run at once, up to max_queue more wait at most max_wait seconds for a slot,
+    and the rest are shed with a 503 right away. Waiting requests are admitted
+    round-robin across clients, so one busy client cannot starve the others.
+
+    Each client can also be rate limited with `limits` rate strings such as
+    "5/second;60/minute", shedding with a 429. The moving window strategy
+    allows short bursts up to the per-window budget, like a token bucket.
+
+    The controller lives on the event loop; acquire and release must be called
+    from it.
+
+    Args:
+    max_concurrency (int): Requests in progress at once.
+    max_queue (int): Requests allowed to wait for a slot.
+    max_wait (float): Seconds a request may wait for a slot.
+    rate_limit (str): Per-client rate limit, or None.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        max_queue: int = 64,
+        max_wait: float = 5.0,
+        rate_limit: Optional[str] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.rate_limits = parse_many(rate_limit) if rate_limit else []
+        self._limiter = MovingWindowRateLimiter(MemoryStorage())
+        self._active = 0
+        self._queued = 0
+        # Waiters by client, in round-robin order.
+        self._waiters = OrderedDict()
+
+    def _check_rate(self, client: str) -> None:
+        for item in self.rate_limits:
+            if not self._limiter.hit(item, client):
+                reset_time, _ = self._limiter.get_window_stats(item, client)
+                ADMISSION_DECISIONS.labels("rate_limited").inc()
+                raise Rejected(429, reset_time - time.time(), "Too many requests.")
+
+    async def acquire(self, client: str) -> None:
+        """
+        Waits for a slot for the client. Raises Rejected if the request is shed.
+        """
+        self._check_rate(client)
+        if self._active < self.max_concurrency and not self._queued:
+            self._admit()
+            return
+        if self._queued >= self.max_queue:
+            ADMISSION_DECISIONS.labels("queue_full").inc()
+            raise Rejected(503, self.max_wait, "The server is overloaded.")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(client, deque()).append(waiter)
+        self._queued += 1
+        ADMISSION_QUEUE.set(self._queued)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up; pass it on.
+                self.release()
+            else:
+                waiter.cancel()
+                self._remove(client, waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            ADMISSION_DECISIONS.labels("timed_out").inc()
+            raise Rejected(503, self.max_wait, "The server is overloaded.")
+
+    def _admit(self) -> None:
+        self._active += 1
+        ADMISSION_ACTIVE.set(self._active)
+        ADMISSION_DECISIONS.labels("admitted").inc()
+
+    def _remove(self, client: str, waiter) -> None:
+        waiters = self._waiters.get(client)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self._queued -= 1
+            ADMISSION_QUEUE.set(self._queued)
+            if not waiters:
+                del self._waiters[client]
+
+    def release(self) -> None:
+        """
+        Frees a slot, handing it to the next waiting client if any.
+        """
+        self._active -= 1
+        while self._waiters:
+            client, waiters = next(iter(self._waiters.items()))
+            waiter = waiters.popleft()
+            self._queued -= 1
+            # Move the client to the back of the round.
+            del self._waiters[client]
+            if waiters:
+                self._waiters[client] = waiters
+            if not waiter.done():
+                self._admit()
+                waiter.set_result(None)
+                break
+        ADMISSION_QUEUE.set(self._queued)
+        ADMISSION_ACTIVE.set(self._active)
+
+
+class AdmissionMiddleware:
+    """
+    An ASGI middleware that admits requests to the given paths through an
+    AdmissionController. It runs before the handler, so shed requests are
+    answered without touching the pipeline, and an admitted request holds its
+    slot until the whole response, including the stream, has been sent.
+
+    Clients are keyed by the key_header if it is set and present, otherwise by
+    their address.
+    """
+
+    def __init__(self, app, controller: AdmissionController, paths=("/query",), key_header: Optional[str] = None):
+        self.app = app
+        self.controller = controller
+        self.paths = set(paths)
+        self.key_header = key_header.lower().encode() if key_header else None
+
+    def _client_key(self, scope) -> str:
+        if self.key_header:
+            for name, value in scope.get("headers", []):
+                if name == self.key_header:
+                    return value.decode("latin-1").split(",")[0].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.controller.acquire(self._client_key(scope))
+        except Rejected as e:
+            await send_rejection(send, e)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release()
+
+
+async def send_rejection(send, rejected: Rejected) -> None:
+    body = json.dumps(rejected.body()).encode()
+    await send({
+        "type": "http.response.start",
+        "status": rejected.status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(rejected.retry_after).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class Permit:
+    """
+    A slot of a ConcurrencyLimit. Releasing it is idempotent, and a permit
+    that is dropped without being released, e.g. with a response stream that
+    was never started, is released when it is garbage collected.
+    """
+
+    def __init__(self, limit: "ConcurrencyLimit"):
+        self._limit = limit
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._limit._release()
+
+    def __del__(self):
+        self.release()
+
+    def hold(self, iterator):
+        """
+        Iterates over iterator and releases the permit when it is done.
+        """
+        try:
+            yield from iterator
+        finally:
+            self.release()
+
+    async def hold_async(self, iterator):
+        """
+        Async version of hold. Unlike yield from, async for does not pass
+        aclose on to the iterator, so closing this closes it explicitly, and
+        with it the upstream stream.
+        """
+        try:
+            async for item in iterator:
+                yield item
+        finally:
+            try:
+                aclose = getattr(iterator, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            finally:
+                self.release()
+
+
+class ConcurrencyLimit:
+    """
+    A non-blocking limit on the concurrent calls to one upstream, such as an
+    LLM provider or a search backend. A call over the limit is shed at once
+    instead of queueing in front of an upstream that is already saturated.
+    Safe to use from threads and the event loop alike.
+
+    Args:
+    name (str): The upstream, for errors and logs.
+    limit (int): Concurrent calls allowed. 0 means no limit.
+    retry_after (float): Seconds suggested to shed clients.
+    """
+
+    def __init__(self, name: str, limit: int = 0, retry_after: float = 1.0):
+        self.name = name
+        self.limit = limit
+        self.retry_after = retry_after
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Permit:
+        """
+        Returns a permit, or raises Rejected if the upstream is at its limit.
+        """
+        with self._lock:
+            if self.limit and self._active >= self.limit:
+                ADMISSION_DECISIONS.labels(f"{self.name}_saturated").inc()
+                logger.warning(f"{self.name} is at its concurrency limit, shedding.")
+                raise Rejected(503, self.retry_after, "The server is overloaded.")
+            self._active += 1
+        return Permit(self)
+
+    def _release(self) -> None:
+        with self._lock:
+            self._active -= 1
+
+    @property
+    def active(self) -> int:
+        # The calls holding a permit, counted even without a limit.
+        return self._active
+
+    def wrap(self, function):
+        """
+        Wraps a blocking function so that each call holds a permit.
+        """
+        def limited(*args, **kwargs):
+            permit = self.acquire()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                permit.release()
+
+        return limited
+
+    def wrap_async(self, function):
+        """
+        Wraps an async function so that each call holds a permit.
+        """
+        async def limited(*args, **kwargs):
+            permit = self.acquire()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                permit.release()
+
+        return limited
+
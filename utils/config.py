@@ -0,0 +1,28 @@
+import os
+import threading
+
+from dotenv import load_dotenv
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load_config() -> None:
+    """
+    Loads the .env file into the environment. Every entry point calls this
+    before anything reads the environment, but the file is only read and
+    parsed once per process; later calls return immediately.
+
+    Values from .env override the environment, unless LLAMASEARCH_NO_DOTENV
+    is set, in which case the file is not read at all. Harnesses that
+    configure the photon through its environment, like benchmark.run, set it
+    so that a developer's .env cannot point them at real backends.
+    """
+    global _loaded
+    if _loaded:
+        return
+    with _lock:
+        if not _loaded:
+            if not os.getenv("LLAMASEARCH_NO_DOTENV"):
+                load_dotenv(override=True)
+            _loaded = True
@@ -0,0 +1,82 @@
+import os
+import threading
+from typing import List
+
+from loguru import logger
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+_models = {}
+# One forward pass per model at a time, whichever Embedder runs it: torch
+# already uses every core for a batch, concurrent passes would only fight
+# over them.
+_encode_locks = {}
+_embedders = {}
+_lock = threading.Lock()
+
+
+class Embedder:
+    """
+    Embeds texts in batches on CPU with a sentence-transformers model. The
+    model is loaded on first use, so that importing this module stays cheap.
+
+    Args:
+    model_name (str): The sentence-transformers model to use.
+    batch_size (int): The number of texts encoded per forward pass.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_EMBEDDING_MODEL, batch_size: int = 32):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        with _lock:
+            self._encode_lock = _encode_locks.setdefault(model_name, threading.Lock())
+
+    @property
+    def model(self):
+        model = _models.get(self.model_name)
+        if model is None:
+            with _lock:
+                model = _models.get(self.model_name)
+                if model is None:
+                    from sentence_transformers import SentenceTransformer
+
+                    logger.info(f"Loading embedding model {self.model_name}")
+                    model = SentenceTransformer(self.model_name, device="cpu")
+                    _models[self.model_name] = model
+        return model
+
+    @property
+    def dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts: List[str]):
+        """
+        Returns a float32 numpy matrix with one L2-normalized row per text, so
+        that dot products are cosine similarities.
+        """
+        model = self.model
+        with self._encode_lock:
+            return model.encode(
+                texts,
+                batch_size=self.batch_size,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            ).astype("float32", copy=False)
+
+
+def get_embedder() -> Embedder:
+    """
+    Returns the embedder configured by EMBEDDING_MODEL and EMBEDDING_BATCH_SIZE,
+    shared by every caller.
+    """
+    key = (
+        os.getenv("EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL),
+        int(os.getenv("EMBEDDING_BATCH_SIZE", 32)),
+    )
+    embedder = _embedders.get(key)
+    if embedder is None:
+        embedder = Embedder(model_name=key[0], batch_size=key[1])
+        with _lock:
+            embedder = _embedders.setdefault(key, embedder)
+    return embedder
@@ -0,0 +1,80 @@
+import os
+import threading
+
+import httpx
+from loguru import logger
+
+# Connection pool settings shared by every outgoing http client.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP2 = os.getenv("HTTP2", "false").lower() in ("1", "true", "yes", "on")
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_http_client(name: str, use_async: bool = False, timeout=None):
+    """
+    Returns the process-wide pooled http client registered under name, creating
+    it on first use. Every search endpoint and LLM provider gets its own
+    client, so its keep-alive connections are reused across queries instead of
+    paying a TCP and TLS handshake each time.
+
+    Args:
+    name (str): The name of the endpoint or provider.
+    use_async (bool): Whether to return an httpx.AsyncClient.
+    timeout: The default timeout of the client, used only on creation.
+
+    Returns:
+    httpx.Client or httpx.AsyncClient: The shared client.
+    """
+    key = (name, use_async)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client_class = httpx.AsyncClient if use_async else httpx.Client
+            client = client_class(
+                timeout=timeout,
+                limits=pool_limits(),
+                http2=HTTP2,
+            )
+            _clients[key] = client
+        return client
+
+
+def warm_up(client: httpx.Client, url: str) -> None:
+    """
+    Opens a connection to url on a pooled sync client, so that the first query
+    does not pay for the handshake. Any response, even an error status, leaves
+    a warm connection in the pool. Failures are only logged.
+    """
+    try:
+        client.head(url, timeout=10)
+        logger.info(f"Warmed up connection to {url}")
+    except Exception as e:
+        logger.warning(f"Could not warm up connection to {url}: {e}")
+
+
+async def warm_up_async(client: httpx.AsyncClient, url: str) -> None:
+    """
+    Async version of warm_up. The connections of an async client belong to
+    the event loop that opened them, so this must run on the loop that
+    serves the queries.
+    """
+    try:
+        await client.head(url, timeout=10)
+        logger.info(f"Warmed up connection to {url}")
+    except Exception as e:
+        logger.warning(f"Could not warm up connection to {url}: {e}")
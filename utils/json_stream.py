@@ -0,0 +1,88 @@
+import json
+from typing import Optional
+
+
+class JSONObjectStream:
+    """
+    Finds the first JSON object in streamed text and parses it as soon as its
+    closing brace arrives. Text around the object, such as prose or markdown
+    code fences, is skipped. Braces are matched character by character with
+    strings and escapes tracked, and the object is then parsed with json, so a
+    malformed object is rejected instead of patched up; scanning then resumes
+    after it.
+
+    Args:
+    max_chars (int): The longest object accepted. Longer ones end the search.
+    """
+
+    def __init__(self, max_chars: int = 16384):
+        self.max_chars = max_chars
+        self.value = None
+        self.done = False
+        self._chars = []
+        self._size = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> bool:
+        """
+        Consumes more text. Returns whether the object has been found.
+        """
+        i = 0
+        while i < len(text) and not self.done:
+            if self._depth == 0:
+                start = text.find("{", i)
+                if start == -1:
+                    return False
+                i = start
+            # Scan up to the end of the object, or of the text.
+            begin = i
+            while i < len(text):
+                char = text[i]
+                i += 1
+                if self._in_string:
+                    if self._escape:
+                        self._escape = False
+                    elif char == "\\":
+                        self._escape = True
+                    elif char == '"':
+                        self._in_string = False
+                elif char == '"':
+                    self._in_string = True
+                elif char == "{" or char == "[":
+                    self._depth += 1
+                elif char == "}" or char == "]":
+                    self._depth -= 1
+                    if self._depth == 0:
+                        break
+            self._chars.append(text[begin:i])
+            self._size += i - begin
+            if self._depth == 0:
+                self._close()
+            elif self._size > self.max_chars:
+                self.done = True
+        return self.done
+
+    def _close(self) -> None:
+        candidate = "".join(self._chars)
+        self._chars = []
+        self._size = 0
+        self._in_string = False
+        self._escape = False
+        try:
+            value = json.loads(candidate)
+        except json.JSONDecodeError:
+            return
+        if isinstance(value, dict):
+            self.value = value
+            self.done = True
+
+
+def parse_json_object(text: str) -> Optional[dict]:
+    """
+    Returns the first JSON object in text, or None.
+    """
+    parser = JSONObjectStream()
+    parser.feed(text)
+    return parser.value
@@ -1,7 +1,7 @@
 from langfuse.callback import CallbackHandler
 import os
-from dotenv import load_dotenv
-load_dotenv(override=True)
+from utils.config import load_config
+load_config()
 
 lengfuse_secret_key = os.getenv('LANGFUSE_SECRET_KEY')
 lengfuse_public_key = os.getenv('LANGFUSE_PUBLIC_KEY')
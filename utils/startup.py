@@ -0,0 +1,89 @@
+import os
+import threading
+from typing import Dict, Optional
+
+from loguru import logger
+from prometheus_client import Gauge
+
+# Phases of a cold start:
+#   import:       importing rag.rag and everything it imports at module level
+#   init:         RAG.init, building the backends, routers and caches
+#   ready:        from the start of the process to the end of init
+#   first_query:  from the first query to its response starting, which pays
+#                 for whatever startup deferred (imports, clients, connections)
+STARTUP_SECONDS = Gauge(
+    "startup_seconds",
+    "Seconds each phase of the process startup took.",
+    ["phase"],
+)
+
+_phases: Dict[str, float] = {}
+_first_query_recorded = False
+_lock = threading.Lock()
+
+
+def process_uptime() -> Optional[float]:
+    """
+    Returns the seconds since the process started, interpreter startup
+    included, or None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces, the fields after it don't.
+            fields = f.read().rpartition(")")[2].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    # starttime is the 22nd field, in clock ticks since boot.
+    started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    return max(0.0, uptime - started)
+
+
+def record_phase(phase: str, seconds: float) -> None:
+    """
+    Records how long a phase of startup took.
+    """
+    with _lock:
+        _phases[phase] = seconds
+    STARTUP_SECONDS.labels(phase).set(seconds)
+
+
+def record_ready() -> None:
+    """
+    Records the time from the start of the process to now, and logs the
+    startup report.
+    """
+    uptime = process_uptime()
+    if uptime is not None:
+        record_phase("ready", uptime)
+    logger.info(f"Startup: {format_report()}")
+
+
+def record_first_query(seconds: float) -> None:
+    """
+    Records the latency of the first query of the process, once, and logs the
+    startup report with it.
+    """
+    global _first_query_recorded
+    with _lock:
+        if _first_query_recorded:
+            return
+        _first_query_recorded = True
+    record_phase("first_query", seconds)
+    logger.info(f"Startup: {format_report()}")
+
+
+def startup_phases() -> Dict[str, float]:
+    """
+    Returns the recorded startup phases and their seconds.
+    """
+    with _lock:
+        return dict(_phases)
+
+
+def format_report() -> str:
+    return ", ".join(
+        f"{phase} {seconds:.3f}s" for phase, seconds in startup_phases().items()
+    )
+
@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+from loguru import logger
+from prometheus_client import Counter, Histogram
+
+# Stages of a query, in pipeline order:
+#   lookup:            result store and semantic cache lookup
+#   search:            search backend call, including the search cache
+#   enrich:            page fetching and passage reranking
+#   prompt:            building the llm messages
+#   llm_first_token:   from the llm request to its first token
+#   llm:               a whole non-streamed llm call, in /batch
+#   related_questions: the related questions job
+#   stream:            from the start to the end of the response stream
+#   total:             the whole request
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds",
+    "Duration of each stage of a query.",
+    ["stage", "backend", "client"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40),
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "rag_llm_tokens_per_second",
+    "Answer streaming rate after the first token.",
+    ["backend", "client"],
+    buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 400),
+)
+QUERY_OUTCOMES = Counter(
+    "rag_queries_total",
+    "Queries by outcome.",
+    ["outcome", "backend", "client"],
+)
+
+
+class Trace:
+    """
+    The timings of one query. Every span is observed in the stage histogram
+    as soon as it ends; the whole trace is handed to the sink by finish.
+
+    Args:
+    sink (TraceSink): Where the finished trace goes.
+    backend (str): The search backend, a metric label.
+    client (str): The llm client, a metric label.
+    trace_id (str): The id of the trace, by default a random one.
+    """
+
+    def __init__(self, sink: "TraceSink", backend: str, client: str, trace_id: Optional[str] = None):
+        self.sink = sink
+        self.backend = backend
+        self.client = client
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans = []
+        self.attributes = {}
+        self.marks = {}
+        self._tokens = 0
+        self._first_token_at = 0.0
+        self._last_token_at = 0.0
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def record(self, stage: str, start: float, end: float) -> None:
+        """
+        Records a span from perf_counter timestamps.
+        """
+        STAGE_SECONDS.labels(stage, self.backend, self.client).observe(end - start)
+        with self._lock:
+            self.spans.append({
+                "stage": stage,
+                "start": self.started_at + (start - self._start),
+                "duration": end - start,
+            })
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, start, time.perf_counter())
+
+    def set(self, **attributes) -> None:
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def mark(self, name: str) -> None:
+        """
+        Marks a point in time that a later span starts from.
+        """
+        self.marks[name] = time.perf_counter()
+
+    def token(self) -> None:
+        """
+        Counts a streamed llm token. The first one ends the llm_first_token
+        span, which starts at the "llm_request" mark.
+        """
+        now = time.perf_counter()
+        if self._tokens == 0:
+            self._first_token_at = now
+            if "llm_request" in self.marks:
+                self.record("llm_first_token", self.marks["llm_request"], now)
+        self._tokens += 1
+        self._last_token_at = now
+
+    @property
+    def tokens(self) -> int:
+        """
+        The number of llm tokens streamed so far.
+        """
+        return self._tokens
+
+    def _observe_tokens(self) -> None:
+        if not self._tokens:
+            return
+        self.set(llm_tokens=self._tokens)
+        if self._tokens > 1 and self._last_token_at > self._first_token_at:
+            rate = (self._tokens - 1) / (self._last_token_at - self._first_token_at)
+            LLM_TOKENS_PER_SECOND.labels(self.backend, self.client).observe(rate)
+            self.set(llm_tokens_per_second=rate)
+
+    def finish(self, outcome: str = "ok") -> None:
+        """
+        Ends the trace. Only the first call counts.
+        """
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self.record("total", self._start, time.perf_counter())
+        self._observe_tokens()
+        QUERY_OUTCOMES.labels(outcome, self.backend, self.client).inc()
+        with self._lock:
+            trace = {
+                "trace_id": self.trace_id,
+                "started_at": self.started_at,
+                "backend": self.backend,
+                "client": self.client,
+                "outcome": outcome,
+                "attributes": dict(self.attributes),
+                "spans": list(self.spans),
+            }
+        try:
+            self.sink.emit(trace)
+        except Exception as e:
+            logger.error(f"encountered error while emitting trace: {e}")
+
+
+class TraceSink:
+    """
+    The interface of a trace sink.
+    """
+
+    def emit(self, trace: dict) -> None:
+        raise NotImplementedError
+
+
+class NullTraceSink(TraceSink):
+    """
+    Drops traces. Metrics are still exported.
+    """
+
+    def emit(self, trace: dict) -> None:
+        pass
+
+
+class JSONLTraceSink(TraceSink):
+    """
+    Appends traces to a local JSON lines file, one trace per line.
+
+    Args:
+    path (str): The file to append to.
+    """
+
+    def __init__(self, path: str = "traces.jsonl"):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, trace: dict) -> None:
+        line = json.dumps(trace) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+class LangfuseTraceSink(TraceSink):
+    """
+    Sends traces to Langfuse, with one span per stage. The client batches and
+    uploads in the background.
+    """
+
+    def __init__(self):
+        from langfuse import Langfuse
+
+        self.langfuse = Langfuse(
+            secret_key=os.getenv("LANGFUSE_SECRET_KEY"),
+            public_key=os.getenv("LANGFUSE_PUBLIC_KEY"),
+            host=os.getenv("LANGFUSE_CLOUD"),
+        )
+
+    def emit(self, trace: dict) -> None:
+        def timestamp(t):
+            return datetime.fromtimestamp(t, tz=timezone.utc)
+
+        attributes = trace["attributes"]
+        langfuse_trace = self.langfuse.trace(
+            id=trace["trace_id"],
+            name="query",
+            input=attributes.get("query"),
+            timestamp=timestamp(trace["started_at"]),
+            metadata={k: v for k, v in attributes.items() if k != "query"},
+            tags=[trace["backend"], trace["client"], trace["outcome"]],
+        )
+        for span in trace["spans"]:
+            langfuse_trace.span(
+                name=span["stage"],
+                start_time=timestamp(span["start"]),
+                end_time=timestamp(span["start"] + span["duration"]),
+            )
+
+
+def get_trace_sink() -> TraceSink:
+    """
+    Returns the trace sink configured by TRACE_SINK: "NONE" (the default),
+    "JSONL" (to TRACE_PATH) or "LANGFUSE".
+    """
+    sink = os.getenv("TRACE_SINK", "NONE").upper()
+    if sink == "NONE":
+        return NullTraceSink()
+    elif sink == "JSONL":
+        return JSONLTraceSink(os.getenv("TRACE_PATH", "traces.jsonl"))
+    elif sink == "LANGFUSE":
+        return LangfuseTraceSink()
+    else:
+        raise RuntimeError("TRACE_SINK must be NONE, JSONL or LANGFUSE.")
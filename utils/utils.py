@@ -7,7 +7,6 @@ stop_words = [
     "[end]",
     "\nReferences:\n",
     "\nSources:\n",
-    "End.",
 ]
 
 handler_max_concurrency=16 
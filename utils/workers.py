@@ -0,0 +1,119 @@
+import os
+import signal
+import socket
+import time
+from typing import Callable, Dict
+
+from loguru import logger
+
+# A worker that exits sooner than this after its start is restarted only
+# after the same delay, so that a worker that cannot start does not spin.
+RESTART_BACKOFF = 1.0
+# After this many such early exits in a row, the server is stopped.
+MAX_EARLY_EXITS = 5
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """
+    Binds the listening socket the workers share.
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve_workers(serve: Callable[[socket.socket], None], host: str, port: int, workers: int) -> None:
+    """
+    Serves with several pre-forked worker processes sharing one port, so that
+    the per-request Python work is no longer bound to a single GIL. The
+    socket is bound here, then each worker is forked and calls serve(sock);
+    the kernel hands every new connection to one of the workers waiting on
+    it. serve must build all of its state (threads, connections, caches)
+    after the fork, and the caller must not start threads before it.
+
+    Each worker gets its index in the WORKER_ID environment variable. A
+    worker that exits is restarted, unless it keeps exiting right after its
+    start, in which case the server is stopped and RuntimeError raised.
+    SIGTERM and SIGINT are passed on to the workers, and this returns once
+    all of them are gone.
+
+    Args:
+    serve (Callable[[socket.socket], None]): Serves on the socket until told
+        to stop, in a worker.
+    host (str): The address to listen on.
+    port (int): The port to listen on.
+    workers (int): The number of worker processes.
+    """
+    sock = bind_socket(host, port)
+    children: Dict[int, int] = {}
+    started: Dict[int, float] = {}
+    early_exits: Dict[int, int] = {}
+    stopping = False
+    failed = False
+
+    def spawn(worker_id: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                os.environ["WORKER_ID"] = str(worker_id)
+                serve(sock)
+            except BaseException as e:
+                logger.error(f"Worker {worker_id} failed: {e!r}")
+                code = 1
+            finally:
+                # Skips the parent's exit handlers, which are not the
+                # worker's to run.
+                os._exit(code)
+        children[pid] = worker_id
+        started[worker_id] = time.monotonic()
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Serving on {host}:{port} with {workers} workers")
+    for worker_id in range(workers):
+        spawn(worker_id)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_id = children.pop(pid, None)
+        if worker_id is None or stopping:
+            continue
+        logger.warning(
+            f"Worker {worker_id} exited with status {os.waitstatus_to_exitcode(status)},"
+            " restarting it."
+        )
+        uptime = time.monotonic() - started[worker_id]
+        if uptime < RESTART_BACKOFF:
+            early_exits[worker_id] = early_exits.get(worker_id, 0) + 1
+            if early_exits[worker_id] >= MAX_EARLY_EXITS:
+                logger.error(f"Worker {worker_id} keeps exiting at startup, stopping.")
+                failed = True
+                stop(signal.SIGTERM, None)
+                continue
+            time.sleep(RESTART_BACKOFF - uptime)
+        else:
+            early_exits[worker_id] = 0
+        if not stopping:
+            spawn(worker_id)
+    sock.close()
+    if failed:
+        raise RuntimeError("The workers could not be started.")
@@ -5,49 +5,166 @@ import { fetchStream } from "@/app/utils/fetch-stream";
 const LLM_SPLIT = "__LLM_RESPONSE__";
 const RELATED_SPLIT = "__RELATED_QUESTIONS__";
 
-export const parseStreaming = async (
-  controller: AbortController,
-  query: string,
-  search_uuid: string,
+// The versions of the "events" protocol this client understands.
+const EVENTS_MEDIA_TYPE = "application/x-ndjson";
+const EVENTS_PROTOCOL_VERSIONS = ["1"];
+
+// A citation such as [[citation:12]] is never longer than this, so text
+// further back than this from the end of the answer can be rendered for good.
+const CITATION_WINDOW = 32;
+
+const renderCitations = (text: string) =>
+  text
+    .replace(/\[\[([cC])itation/g, "[citation")
+    .replace(/[cC]itation:(\d+)]]/g, "citation:$1]")
+    .replace(/\[\[([cC]itation:\d+)]](?!])/g, `[$1]`)
+    .replace(/\[[cC]itation:(\d+)]/g, "[citation]($1)");
+
+/**
+ * Renders the answer as it streams in. Only the new text is run through the
+ * citation regexes; the tail that may hold an unfinished citation is kept
+ * back until more text arrives or the answer ends.
+ */
+class MarkdownRenderer {
+  private rendered = "";
+  private pending = "";
+
+  constructor(private onMarkdown: (value: string) => void) {}
+
+  append(text: string) {
+    this.pending += text;
+    const window = this.pending.length - CITATION_WINDOW;
+    let cut = this.pending.indexOf("[", Math.max(0, window));
+    // Keep the opening brackets of a citation together.
+    while (cut > 0 && this.pending[cut - 1] === "[") {
+      cut--;
+    }
+    if (cut === -1) {
+      this.rendered += renderCitations(this.pending);
+      this.pending = "";
+    } else if (cut > 0) {
+      this.rendered += renderCitations(this.pending.slice(0, cut));
+      this.pending = this.pending.slice(cut);
+    }
+    this.onMarkdown(this.rendered + renderCitations(this.pending));
+  }
+
+  flush() {
+    this.rendered += renderCitations(this.pending);
+    this.pending = "";
+    this.onMarkdown(this.rendered);
+  }
+}
+
+const isEventStream = (response: Response) => {
+  const [mediaType, ...params] = (
+    response.headers.get("Content-Type") || ""
+  ).split(";");
+  if (mediaType.trim() !== EVENTS_MEDIA_TYPE) {
+    return false;
+  }
+  const version = params
+    .map((param) => param.trim().split("="))
+    .find(([key]) => key === "version")?.[1];
+  if (version && !EVENTS_PROTOCOL_VERSIONS.includes(version)) {
+    console.warn(`Unsupported stream protocol version ${version}`);
+  }
+  return true;
+};
+
+/**
+ * Parses the "events" format: one JSON event per line. Each chunk is decoded
+ * once and only complete lines are parsed, so the work per chunk does not
+ * grow with the length of the answer.
+ */
+const parseEvents = (
+  response: Response,
   onSources: (value: Source[]) => void,
   onMarkdown: (value: string) => void,
   onRelates: (value: Relate[]) => void,
   onError?: (status: number) => void,
 ) => {
   const decoder = new TextDecoder();
-  let uint8Array = new Uint8Array();
+  const markdown = new MarkdownRenderer(onMarkdown);
+  let buffer = "";
+  let relatesEmitted = false;
+  let finished = false;
+  const finish = () => {
+    if (finished) {
+      return;
+    }
+    finished = true;
+    markdown.flush();
+    if (!relatesEmitted) {
+      onRelates([]);
+    }
+  };
+  const handleLine = (line: string) => {
+    if (!line.trim()) {
+      return;
+    }
+    let event: { type: string; data: any };
+    try {
+      event = JSON.parse(line);
+    } catch (e) {
+      console.error("Malformed stream event", e);
+      return;
+    }
+    switch (event.type) {
+      case "sources":
+        onSources(event.data || []);
+        break;
+      case "delta":
+        markdown.append(event.data);
+        break;
+      case "related":
+        relatesEmitted = true;
+        onRelates(event.data || []);
+        break;
+      case "error":
+        finish();
+        onError?.(500);
+        break;
+      case "done":
+        finish();
+        break;
+      default:
+        // Unknown events are ignored, so that the server can add new ones.
+        break;
+    }
+  };
+  fetchStream(
+    response,
+    (chunk) => {
+      buffer += decoder.decode(chunk, { stream: true });
+      const lines = buffer.split("\n");
+      buffer = lines.pop()!;
+      lines.forEach(handleLine);
+    },
+    () => {
+      handleLine(buffer + decoder.decode());
+      finish();
+    },
+  );
+};
+
+/**
+ * Parses the "legacy" format: the sources, the answer and the related
+ * questions as free-form text separated by sentinels.
+ */
+const parseLegacy = (
+  response: Response,
+  onSources: (value: Source[]) => void,
+  onMarkdown: (value: string) => void,
+  onRelates: (value: Relate[]) => void,
+) => {
+  const decoder = new TextDecoder();
   let chunks = "";
   let sourcesEmitted = false;
-  const response = await fetch(`/query`, {
-    method: "POST",
-    headers: {
-      "Content-Type": "application/json",
-      Accept: "*./*",
-    },
-    signal: controller.signal,
-    body: JSON.stringify({
-      query,
-      search_uuid,
-    }),
-  });
-  if (response.status !== 200) {
-    onError?.(response.status);
-    return;
-  }
-  const markdownParse = (text: string) => {
-    onMarkdown(
-      text
-        .replace(/\[\[([cC])itation/g, "[citation")
-        .replace(/[cC]itation:(\d+)]]/g, "citation:$1]")
-        .replace(/\[\[([cC]itation:\d+)]](?!])/g, `[$1]`)
-        .replace(/\[[cC]itation:(\d+)]/g, "[citation]($1)"),
-    );
-  };
   fetchStream(
     response,
     (chunk) => {
-      uint8Array = new Uint8Array([...uint8Array, ...chunk]);
-      chunks = decoder.decode(uint8Array, { stream: true });
+      chunks += decoder.decode(chunk, { stream: true });
       if (chunks.includes(LLM_SPLIT)) {
         const [sources, rest] = chunks.split(LLM_SPLIT);
         if (!sourcesEmitted) {
@@ -60,9 +177,9 @@ export const parseStreaming = async (
         sourcesEmitted = true;
         if (rest.includes(RELATED_SPLIT)) {
           const [md] = rest.split(RELATED_SPLIT);
-          markdownParse(md);
+          onMarkdown(renderCitations(md));
         } else {
-          markdownParse(rest);
+          onMarkdown(renderCitations(rest));
         }
       }
     },
@@ -76,3 +193,35 @@ export const parseStreaming = async (
     },
   );
 };
+
+export const parseStreaming = async (
+  controller: AbortController,
+  query: string,
+  search_uuid: string,
+  onSources: (value: Source[]) => void,
+  onMarkdown: (value: string) => void,
+  onRelates: (value: Relate[]) => void,
+  onError?: (status: number) => void,
+) => {
+  const response = await fetch(`/query`, {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+      Accept: "*./*",
+    },
+    signal: controller.signal,
+    body: JSON.stringify({
+      query,
+      search_uuid,
+    }),
+  });
+  if (response.status !== 200) {
+    onError?.(response.status);
+    return;
+  }
+  if (isEventStream(response)) {
+    parseEvents(response, onSources, onMarkdown, onRelates, onError);
+  } else {
+    parseLegacy(response, onSources, onMarkdown, onRelates);
+  }
+};